@@ -3,92 +3,384 @@ import dotenv
 dotenv.load_dotenv()
 
 # slack app deps
-import os, datetime
-from slack_bolt import App
-from slack_sdk import WebClient
-from flask import Flask, request, jsonify
+import atexit, os, threading
+from slack_bolt import App, BoltResponse
+from flask import Flask, Response, request, jsonify
 from slack_bolt.adapter.flask import SlackRequestHandler
 
 # RAG app deps
-import qdrant_client, uuid
 from llama_index import VectorStoreIndex, Document, StorageContext, ServiceContext, set_global_handler
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.schema import TextNode, NodeRelationship, RelatedNodeInfo
-from llama_index.prompts import PromptTemplate
-from llama_index.postprocessor import FixedRecencyPostprocessor
+from llama_index.schema import TextNode
+from llama_index.utils import get_tokenizer
 
-set_global_handler("simple")
+# our own helpers, one module each
+from dispatch import Dispatcher # answers questions in the background so Slack gets its ack right away
+from dedup import SeenStore # remembers events we've already handled, since Slack redelivers them
+from windows import ConversationWindows, NeighborExpander # turns messages into linked nodes, and follows the links when answering
+from ingest import IngestBuffer # embeds and stores messages in batches
+from message_sync import MessageSync # applies edits and deletes to what we've stored
+from query_engines import QueryEnginePool # query engines built once at startup, not per question
+from users import UserDirectory # caches user names so we don't ask Slack every time
+from thread_cache import ThreadCache # replies in threads, kept up to date from events
+from storage import CollectionConfig, ensure_collection, make_client # the Qdrant client, and the collection with its payload indexes
+from indexer import RemoteIngest, RemoteWindows, RemoteSync # sends messages to a separate indexer process instead of storing them ourselves
+from retrieval import SlackRetriever, ScopedQuery # searches Qdrant with recency built in, in the channels a question may see
+from channels import ChannelScope, bot_channels_from_env, find_channels # which channels we join, and which each question searches
+from bootstrap import BootstrapCache # who the bot is and which channels it's in, saved so restarts don't ask Slack
+from keyword_index import keyword_index_from_env # finds messages with the exact ids and names in a question
+from answer_cache import AnswerCache # answers to questions people keep asking
+from embedding_cache import cached_service_context, embedding_cache_stats # embeds each piece of text only once
+from context_packing import ContextPacker # chooses which messages fit in the prompt
+from retention import retention_from_env # deletes and summarizes old messages
+from streaming import StreamingMessage # shows an answer in Slack while it's being written
+from slack_client import PacedWebClient # paces Slack calls to their rate limits, over kept-open connections
+from metrics import Metrics, MetricsHandler, PayloadLog, TimedPostprocessor # how long each stage takes, for /metrics
+from wal import LogConsumer, EventReplay, claim_log, drain_abandoned # keeps messages on disk until they're stored
 
-PREVIOUS_NODE = None
+set_global_handler("simple")
 
 # initialize qdrant client
-client = qdrant_client.QdrantClient(
-    path="./qdrant_data"
-)
+# set QDRANT_URL to use a Qdrant server, which lets you run more than one web worker
+client = make_client()
+# create the collection ourselves so the when_ts payload field gets an index
+# EMBEDDING_DIM has to match your embedding model; OpenAI's default has 1536 dimensions
+# QDRANT_QUANTIZATION, QDRANT_ON_DISK and the QDRANT_HNSW_ settings choose how a new collection
+# stores its vectors, for when there are too many to keep in RAM; see storage.py
+collection_config = CollectionConfig.from_env()
+ensure_collection(client, "slack_messages", int(os.environ.get("EMBEDDING_DIM", 1536)), collection_config)
 vector_store = QdrantVectorStore(client=client, collection_name="slack_messages")
 storage_context = StorageContext.from_defaults(vector_store=vector_store)
 
-index = VectorStoreIndex([],storage_context=storage_context)
+# embeddings are cached in EMBEDDING_CACHE_DB, so text we've seen before isn't embedded again
+index = VectorStoreIndex([],storage_context=storage_context,service_context=cached_service_context())
+
+# how long each stage of handling a message takes, served on /metrics
+# llama_index tells us about embedding, search and LLM calls through its callbacks
+metrics = Metrics()
+index.service_context.callback_manager.add_handler(MetricsHandler(metrics))
+# one in every 1/EVENT_LOG_SAMPLE incoming events is printed (cut short), instead of all of them
+payload_log = PayloadLog(rate=float(os.environ.get("EVENT_LOG_SAMPLE", 0.01)))
+
+# new messages wait here until there are INGEST_BATCH_SIZE of them or the oldest
+# has waited INGEST_MAX_DELAY seconds, then they're embedded and stored together
+# with INDEXER_SOCKET set, they're sent to indexer.py to do that instead
+if os.environ.get("INDEXER_SOCKET"):
+    ingest_buffer = RemoteIngest(os.environ["INDEXER_SOCKET"])
+else:
+    ingest_buffer = IngestBuffer(
+        index,
+        max_batch=int(os.environ.get("INGEST_BATCH_SIZE", 32)),
+        max_delay=float(os.environ.get("INGEST_MAX_DELAY", 2.0)),
+        max_pending=int(os.environ.get("INGEST_MAX_PENDING", 1000))
+    )
+
+# every stored message also goes into a keyword index (KEYWORD_INDEX_DB, "" turns it off),
+# so questions about a ticket id or hostname find the messages that mention it
+# with INDEXER_SOCKET set, the indexer adds to it and we only search it
+keyword_index = keyword_index_from_env()
+if keyword_index is not None and not os.environ.get("INDEXER_SOCKET"):
+    ingest_buffer.listeners.append(keyword_index.add)
+    ingest_buffer.delete_listeners.append(keyword_index.delete)
+
+# RETENTION_DAYS, RETENTION_CHANNEL_DAYS and COMPACT_AFTER_DAYS forget (or summarize) old
+# messages on a background thread; with INDEXER_SOCKET set, the indexer does that instead
+retention = None
+if not os.environ.get("INDEXER_SOCKET"):
+    retention = retention_from_env(client, "slack_messages", index.service_context, vector_store)
+    if retention is not None:
+        retention.start()
+
+# INGEST_WINDOW_SIZE=1 (the default) stores each message on its own; with more than
+# one, messages are stored in overlapping conversation windows instead (see windows.py)
+# either way each node is linked to the ones before and after it in its channel or thread
+# with INDEXER_SOCKET set, messages are sent to the indexer as they are, and it builds the
+# windows and applies edits and deletes: it sees every worker's messages, so windows aren't
+# split between workers and their links are in order
+INGEST_WINDOW_SIZE = int(os.environ.get("INGEST_WINDOW_SIZE", 1))
+def conversation_windows():
+    return ConversationWindows(
+        size=INGEST_WINDOW_SIZE,
+        overlap=int(os.environ.get("INGEST_WINDOW_OVERLAP", min(2, INGEST_WINDOW_SIZE - 1))),
+        max_gap_seconds=float(os.environ.get("INGEST_WINDOW_GAP", 900))
+    )
+if os.environ.get("INDEXER_SOCKET"):
+    windows = RemoteWindows(ingest_buffer)
+    message_sync = RemoteSync(ingest_buffer)
+else:
+    windows = conversation_windows()
+    # edited and deleted messages are changed in place, found by their channel and timestamp
+    message_sync = MessageSync(client, "slack_messages", windows, ingest_buffer)
+
+# with WAL_DIR set, messages, edits and deletes are written to a log there before Slack
+# gets its ack (see log_events), and stored from the log, so a crash or an embedding API
+# outage doesn't lose them (see wal.py); with INDEXER_SOCKET set, the indexer stores them instead
+# each worker claims a log of its own in WAL_DIR
+event_log = None
+if os.environ.get("WAL_DIR") and not os.environ.get("INDEXER_SOCKET"):
+    event_log = claim_log(os.environ["WAL_DIR"], fsync_interval=float(os.environ.get("WAL_FSYNC_INTERVAL", 0)))
 
 # Initialize your app with your bot token and signing secret
-app = App(
+# listeners must return quickly: Slack retries any event it doesn't see acked within 3 seconds
+# SLACK_API_URL points the bot at a different Slack API, like the one in fake_slack.py
+# calls are paced to Slack's rate limits; SLACK_RATE_LIMIT_SCALE raises them for a fake Slack
+slack_client = PacedWebClient(
     token=os.environ.get("SLACK_BOT_TOKEN"),
-    signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
+    base_url=os.environ.get("SLACK_API_URL", PacedWebClient.BASE_URL),
+    limit_scale=float(os.environ.get("SLACK_RATE_LIMIT_SCALE", 1))
+)
+# who we are and which channels we've joined, kept in BOOTSTRAP_CACHE so starting again doesn't wait for Slack
+bootstrap = BootstrapCache.from_env()
+# get my own ID; asking auth_test (when it isn't cached) also checks the token
+bot_user_id = bootstrap.auth(slack_client)["user_id"]
+app = App(
+    client=slack_client,
+    signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
+    process_before_response=False,
+    # so Bolt doesn't call auth_test again as it starts; it asks once, with the first event
+    token_verification_enabled=False
 )
 handler = SlackRequestHandler(app)
 flask_app = Flask(__name__)
 
-# join the test channel so you can listen to messages
-channel_list = app.client.conversations_list().data
-channel = next((channel for channel in channel_list.get('channels') if channel.get("name") == "bot-testing"), None)
-channel_id = channel.get('id')
-app.client.conversations_join(channel=channel_id)
+# event ids and (channel, ts) pairs we've already handled
+# set DEDUP_DB to a file path to keep them across restarts and share them between workers
+seen = SeenStore(
+    max_size=int(os.environ.get("DEDUP_MAX_SIZE", 10000)),
+    ttl=int(os.environ.get("DEDUP_TTL", 3600)),
+    sqlite_path=os.environ.get("DEDUP_DB")
+)
+
+# this runs after Bolt has checked the request signature, before any listener
+# if Slack is retrying an event we already have, ack it and do nothing else
+@app.middleware
+def skip_duplicate_events(request, body, next):
+    event_id = body.get('event_id')
+    if event_id and seen.check_and_add("event:" + event_id):
+        retry_num = request.headers.get('x-slack-retry-num', ['0'])[0]
+        print(f"Skipping duplicate event {event_id} (retry {retry_num})")
+        return BoltResponse(status=200, body="")
+    return next()
 
-# get my own ID
-auth_response = app.client.auth_test()
-print(auth_response)
-bot_user_id = auth_response["user_id"]
+# Bolt acks an event once the middleware is done, before the listeners run, so with a
+# write-ahead log this is where messages, edits and deletes go into it; a crash after
+# the ack can't lose them. The listeners below leave storing them to the log's consumer
+@app.middleware
+def log_events(body, next):
+    if event_log is not None and body.get('type') == 'event_callback':
+        record = loggable(body['event'], body.get('team_id'))
+        if record is not None:
+            event_log.append(record)
+    return next()
+
+# join the channels in BOT_CHANNELS (default bot-testing, * for all of them) so you can listen to messages
+# with lots of channels that takes a while, so it happens in the background
+def join_channels():
+    names, all_channels = bot_channels_from_env()
+    try:
+        channel_ids = bootstrap.channels(app.client, names, all_channels, find_channels)
+        print(f"Listening in {len(channel_ids)} channels")
+    except Exception as e:
+        print("Could not join channels:", e)
+threading.Thread(target=join_channels, name="join-channels", daemon=True).start()
+
+# everybody's names, loaded in the background at startup and kept fresh by user_change events
+users = UserDirectory(
+    app.client,
+    ttl=int(os.environ.get("USER_CACHE_TTL", 3600)),
+    max_size=int(os.environ.get("USER_CACHE_SIZE", 10000))
+)
+def warm_users():
+    try:
+        users.warm()
+    except Exception as e:
+        print("Could not preload users, will look them up as we go:", e)
+threading.Thread(target=warm_users, name="warm-users", daemon=True).start()
 
 # get a user's username and display name from their user id
 def get_user_name(user_id):
-    user_info = app.client.users_info(user=user_id)
-    user_name = user_info['user']['name']
-    user_display_name = user_info['user']['profile']['display_name']
-    return user_name, user_display_name
+    with metrics.span("user_lookup"):
+        return users.get(user_id)
+
+# the same for whoever sent a message; messages from bots and integrations have no user
+def get_author(message):
+    with metrics.span("user_lookup"):
+        return users.author(message)
+
+# the prompt we give the LLM; who_is_asking and replies_stanza are filled in for each question
+QA_TEMPLATE = (
+    "Your context is a series of chat messages. Each one is tagged with 'who:' \n"
+    "indicating who was speaking and 'when:' indicating when they said it, \n"
+    "followed by a line break and then what they said.\n"
+    "Some of them are a stretch of conversation, with each line starting with the name of whoever said it.\n"
+    "The messages are sorted by recency, so the most recent one is first in the list.\n"
+    "The most recent messages should take precedence over older ones.\n"
+    "---------------------\n"
+    "{context_str}"
+    "\n---------------------\n"
+    "The person who is asking the question is called '{who_is_asking}'.\n"
+    "{replies_stanza}\n"
+    "You are a helpful AI assistant who has been listening to everything everyone has been saying. \n"
+    "Given the most relevant chat messages above, please answer this question: {query_str}\n"
+)
+
+# one query engine per worker, built once at startup instead of once per question
+ANSWER_WORKERS = int(os.environ.get("ANSWER_WORKERS", 4))
+# RETRIEVAL_MODE is similarity (the default), window or decay; see retrieval.py
+retriever = SlackRetriever(
+    client,
+    "slack_messages",
+    index.service_context.embed_model,
+    similarity_top_k=int(os.environ.get("CONTEXT_CANDIDATES", 40)),
+    mode=os.environ.get("RETRIEVAL_MODE", "similarity"),
+    window_seconds=float(os.environ["RECENCY_WINDOW_DAYS"]) * 86400 if os.environ.get("RECENCY_WINDOW_DAYS") else None,
+    half_life_seconds=float(os.environ.get("RECENCY_HALF_LIFE_DAYS", 7)) * 86400,
+    recency_weight=float(os.environ.get("RECENCY_WEIGHT", 0.3)),
+    search_params=collection_config.search_params(),
+    keyword_index=keyword_index,
+    keyword_top_k=int(os.environ.get("KEYWORD_CANDIDATES", 20)),
+    callback_manager=index.service_context.callback_manager
+)
+# with STREAM_ANSWERS=1 we post a placeholder right away and fill in the answer as the LLM
+# writes it, updating the message at most every STREAM_UPDATE_INTERVAL seconds
+STREAM_ANSWERS = os.environ.get("STREAM_ANSWERS", "").lower() in ("1", "true", "yes")
+STREAM_UPDATE_INTERVAL = float(os.environ.get("STREAM_UPDATE_INTERVAL", 1.0))
+# the tokenizer is loaded the first time we count something (it may have to be downloaded), not at startup
+def count_tokens(text):
+    return len(get_tokenizer()(text))
+# we fetch CONTEXT_CANDIDATES messages and send the best of them that fit in CONTEXT_TOKENS
+context_packer = ContextPacker(
+    count_tokens=count_tokens,
+    token_budget=int(os.environ.get("CONTEXT_TOKENS", 3000))
+)
+# CONTEXT_NEIGHBORS links either side of each match are added too, before packing
+CONTEXT_NEIGHBORS = int(os.environ.get("CONTEXT_NEIGHBORS", 1))
+postprocessors = [context_packer]
+if CONTEXT_NEIGHBORS:
+    postprocessors.insert(0, NeighborExpander(client, "slack_messages", hops=CONTEXT_NEIGHBORS))
+query_engines = QueryEnginePool(
+    index, QA_TEMPLATE, size=ANSWER_WORKERS, retriever=retriever, streaming=STREAM_ANSWERS,
+    node_postprocessors=[TimedPostprocessor(postprocessors, metrics)]
+)
+
+# a question close enough to one already answered in the same channel or thread gets the same answer
+# answers are dropped when new messages would change them, or after ANSWER_CACHE_TTL seconds
+# both caches only hear about the messages that reach this process, so with more than one
+# worker (WEB_CONCURRENCY) they'd miss the ones Slack sends to the others and go stale; they're
+# turned off then. With INDEXER_SOCKET, the indexer builds the nodes, so we can't tell which
+# answers a new message would change, and the answer cache is off too
+SHARED_WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1)) > 1
+ANSWER_CACHE_MB = 0 if SHARED_WORKERS or os.environ.get("INDEXER_SOCKET") else int(os.environ.get("ANSWER_CACHE_MB", 16))
+answer_cache = AnswerCache(
+    index.service_context.embed_model,
+    threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95)),
+    ttl=int(os.environ.get("ANSWER_CACHE_TTL", 3600)),
+    max_bytes=ANSWER_CACHE_MB * 1024 * 1024
+)
+ingest_buffer.listeners.append(answer_cache.invalidate)
+
+# threads the bot is talking in; only the newest replies that fit in THREAD_CONTEXT_TOKENS go in the prompt
+threads = ThreadCache(
+    max_threads=0 if SHARED_WORKERS else int(os.environ.get("THREAD_CACHE_SIZE", 500)),
+    max_replies=int(os.environ.get("THREAD_CACHE_REPLIES", 200)),
+    count_tokens=count_tokens
+)
+THREAD_CONTEXT_TOKENS = int(os.environ.get("THREAD_CONTEXT_TOKENS", 2000))
+
+# SEARCH_SCOPE says which channels a question searches: channel (just its own, the default),
+# allowed (its own and SEARCH_CHANNELS) or all; see channels.py
+channel_scope = ChannelScope.from_env()
+
+# fetch every reply in a thread from Slack, a page at a time
+def fetch_thread(channel, thread_ts):
+    messages = []
+    cursor = None
+    with metrics.span("thread_fetch"):
+        while True:
+            page = app.client.conversations_replies(channel=channel, ts=thread_ts, cursor=cursor, limit=200)
+            messages.extend(page['messages'])
+            cursor = page.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return messages
+
+# one line of the replies stanza
+def render_reply(reply):
+    return get_author(reply)[0] + ": " + (reply.get('text') or "")
 
 # given a query and a message, answer the question and return the response
-def answer_question(query, message, replies=None):
-    who_is_asking = get_user_name(message.get('user'))[0]
+# with stream_to, the answer is shown in that StreamingMessage as it's written
+def answer_question(query, message, replies=None, stream_to=None):
+    # embed the question once, for both the cache and the search
+    scope = (message.get('channel'), message.get('thread_ts'))
+    embedding = index.service_context.embed_model.get_query_embedding(query)
+    cached = answer_cache.lookup(scope, embedding)
+    if cached is not None:
+        return cached
+    who_is_asking = get_author(message)[0]
     replies_stanza = ""
     if (replies is not None):
         replies_stanza = "In addition to the context above, the question you're about to answer has been discussed in the following chain of replies:\n"
-        for reply in replies['messages']:
-            replies_stanza += get_user_name(reply.get('user'))[0] + ": " + reply.get('text') + "\n"
-    template = (
-        "Your context is a series of chat messages. Each one is tagged with 'who:' \n"
-        "indicating who was speaking and 'when:' indicating when they said it, \n"
-        "followed by a line break and then what they said. There can be up to 20 chat messages.\n"
-        "The messages are sorted by recency, so the most recent one is first in the list.\n"
-        "The most recent messages should take precedence over older ones.\n"
-        "---------------------\n"
-        "{context_str}"
-        "\n---------------------\n"
-        "The person who is asking the question is called '" + who_is_asking + "'.\n"
-        + replies_stanza + "\n"
-        "You are a helpful AI assistant who has been listening to everything everyone has been saying. \n"
-        "Given the most relevant chat messages above, please answer this question: {query_str}\n"
-    )
-    qa_template = PromptTemplate(template)                                
-    postprocessor = FixedRecencyPostprocessor(
-        top_k=20, 
-        date_key="when", # the key in the metadata to find the date
-        service_context=ServiceContext.from_defaults()
-    )
-    query_engine = index.as_query_engine(similarity_top_k=20, node_postprocessors=[postprocessor])
-    query_engine.update_prompts(
-        {"response_synthesizer:text_qa_template": qa_template}
+        for line in threads.tail(replies, render_reply, THREAD_CONTEXT_TOKENS):
+            replies_stanza += line + "\n"
+    # only search the channels this question may see
+    query_bundle = ScopedQuery(
+        query, embedding=embedding, channel_ids=channel_scope.channels_for(message.get('channel')), team_id=message.get('team')
     )
-    return query_engine.query(query)
+    if stream_to is None:
+        response = query_engines.query(query_bundle, who_is_asking=who_is_asking, replies_stanza=replies_stanza)
+    else:
+        response = query_engines.stream(query_bundle, who_is_asking=who_is_asking, replies_stanza=replies_stanza)
+        # we read the stream ourselves, so tell the response what it said
+        response.response_txt = stream_to.consume(response.response_gen)
+    answer_cache.store(scope, embedding, response)
+    return response
+
+# questions wait here for a worker; if too many pile up we say we're busy instead
+dispatcher = Dispatcher(
+    workers=ANSWER_WORKERS,
+    max_queue=int(os.environ.get("ANSWER_QUEUE_SIZE", 16))
+)
+BUSY_REPLY = "I'm a bit busy right now, try asking me again in a minute!"
+# what a streamed answer is replaced with if answering it fails partway
+FAILED_REPLY = "Sorry, something went wrong while I was answering that. Try asking me again?"
+
+# answer a question and post the answer, streaming it if STREAM_ANSWERS is on
+# returns the message we posted
+def post_answer(query, message, replies=None, thread_ts=None):
+    channel = message.get('channel')
+    if STREAM_ANSWERS:
+        with metrics.span("slack_post"):
+            streamed = StreamingMessage(app.client, channel, thread_ts=thread_ts, interval=STREAM_UPDATE_INTERVAL).start()
+        try:
+            response = answer_question(query, message, replies, stream_to=streamed)
+        except Exception:
+            # don't leave the placeholder, or half an answer with its cursor, up for good
+            with metrics.span("slack_post"):
+                streamed.finish(FAILED_REPLY)
+            raise
+        with metrics.span("slack_post"):
+            return streamed.finish(str(response))
+    response = answer_question(query, message, replies)
+    with metrics.span("slack_post"):
+        posted = app.client.chat_postMessage(
+            channel=channel,
+            text=str(response),
+            thread_ts=thread_ts
+        )
+    return posted['message']
+
+# answer a question that mentioned the bot, in the channel it was asked in
+def answer_in_channel(query, message):
+    post_answer(query, message)
+
+# answer a follow-up in a thread, using the rest of the thread as extra context
+def answer_in_thread(query, message):
+    channel = message.get('channel')
+    thread_ts = message.get('thread_ts')
+    replies = threads.get_or_seed(channel, thread_ts, lambda: fetch_thread(channel, thread_ts))
+    posted = post_answer(query, message, replies, thread_ts=thread_ts)
+    # we don't get events for our own messages, so add our answer to the thread ourselves
+    threads.append(channel, dict(posted, thread_ts=thread_ts))
 
 
 # this is the challenge route required by Slack
@@ -100,81 +392,189 @@ def slack_challenge():
         print("Received challenge")
         return jsonify({"challenge": request.json["challenge"]})
     else:
-        print("Incoming event:")
-        print(request.json)
+        payload_log.log("Incoming event:", request.json)
     return handler.handle(request)
 
+# how deep the question queue is, how long questions wait for a worker, and how the caches are doing
+def collect_stats():
+    return {
+        "dispatch": dispatcher.stats(),
+        "dedup": seen.stats(),
+        "ingest": ingest_buffer.stats(),
+        "users": users.stats(),
+        "threads": threads.stats(),
+        "answers": answer_cache.stats(),
+        "context": context_packer.stats(),
+        "windows": windows.stats(),
+        "sync": message_sync.stats(),
+        "retention": retention.stats() if retention is not None else None,
+        "keywords": keyword_index.stats() if keyword_index is not None else None,
+        "embeddings": embedding_cache_stats(index.service_context),
+        "events": payload_log.stats(),
+        "slack": app.client.stats(),
+        "bootstrap": bootstrap.stats(),
+        "wal": event_consumer.stats() if event_log is not None else None
+    }
+
+@flask_app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(collect_stats())
+
+# the stage timings as Prometheus histograms, plus the numbers from /stats
+@flask_app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(collect_stats()), mimetype="text/plain; version=0.0.4")
+
+# the new version of an edited message, with its channel, or None if there's nothing to store:
+# link previews and reply counts change the message too, but not its text;
+# our own streamed answers aren't stored at all
+def edited_message(event):
+    message = dict(event['message'], channel=event['channel'])
+    if message.get('text') == event.get('previous_message', {}).get('text') or message.get('user') == bot_user_id:
+        return None
+    return message
+
+# the last version of a deleted message, with its channel
+def deleted_message(event):
+    return dict(event.get('previous_message') or {}, channel=event['channel'], ts=event['deleted_ts'])
+
+# if message contains a "blocks" key
+#   then look for a "block" with the type "rich text"
+#       if you find it 
+#       then look inside that block for an "elements" key
+#           if you find it 
+#               then examine each one of those for an "elements" key
+#               if you find it
+#                   then look inside each "element" for one with type "user"
+#                   if you find it  
+#                   and if that user matches the bot_user_id 
+#                   then it's a message for the bot
+# returns the question, or None if it isn't one
+def mentioned_query(message):
+    for block in message.get('blocks') or []:
+        if block.get('type') == 'rich_text':
+            for rich_text_section in block.get('elements'):
+                for element in rich_text_section.get('elements'):
+                    if element.get('type') == 'user' and element.get('user_id') == bot_user_id:
+                        for element in rich_text_section.get('elements'):
+                            if element.get('type') == 'text':
+                                return element.get('text')
+    return None
+
+# a reply in a thread the bot started, which we treat as a question too
+def replies_to_bot(message):
+    return bool(message.get('thread_ts')) and message.get('parent_user_id') == bot_user_id
+
+# the message subtypes app.message() hears
+MESSAGE_SUBTYPES = (None, "bot_message", "thread_broadcast", "file_share")
+
+# what the write-ahead log keeps for an event: the messages reply() would store, and
+# the edits and deletes sync_edit() and sync_delete() would apply; None for anything else
+def loggable(event, team_id):
+    if event.get('type') != 'message':
+        return None
+    if event.get('subtype') == 'message_changed':
+        message = edited_message(event)
+        return {"kind": "edit", "message": message} if message is not None else None
+    if event.get('subtype') == 'message_deleted':
+        return {"kind": "delete", "message": deleted_message(event)}
+    if event.get('subtype') not in MESSAGE_SUBTYPES or mentioned_query(event) is not None or replies_to_bot(event):
+        return None
+    # the same message can reach us more than once
+    if seen.check_and_add(f"logged:{event.get('channel')}:{event.get('ts')}"):
+        return None
+    # which workspace it's from, so each workspace only searches its own messages
+    return {"kind": "message", "message": dict(event, team=event.get('team') or team_id)}
+
+# someone edited a message, so store the new text in place of the old
+# app.message() doesn't get these; they're message events with a subtype
+@app.event({"type": "message", "subtype": "message_changed"})
+def sync_edit(event):
+    message = edited_message(event)
+    if message is None:
+        return
+    if message.get('thread_ts'):
+        threads.append(event['channel'], message)
+        answer_cache.forget_thread(event['channel'], message['thread_ts'])
+    # with a write-ahead log, log_events has logged it, and the consumer applies it
+    if event_log is not None:
+        return
+    # answers built from the old text are out of date
+    answer_cache.forget_sources(message_sync.edit(message))
+
+# someone deleted a message, so forget it
+@app.event({"type": "message", "subtype": "message_deleted"})
+def sync_delete(event):
+    message = deleted_message(event)
+    if message.get('thread_ts'):
+        threads.remove(event['channel'], message['thread_ts'], message['ts'])
+        answer_cache.forget_thread(event['channel'], message['thread_ts'])
+    if event_log is not None:
+        return
+    answer_cache.forget_sources(message_sync.delete(message))
+
+# somebody changed their name or profile, so update our copy
+@app.event("user_change")
+def refresh_user(event):
+    users.update(event['user'])
+
 # this handles any incoming message the bot can hear
-# right now it's only in one channel so it's every message in that channel
+# that's every message in every channel we joined
 @app.message()
-def reply(message, say):
-    global PREVIOUS_NODE
-    # if message contains a "blocks" key
-    #   then look for a "block" with the type "rich text"
-    #       if you find it 
-    #       then look inside that block for an "elements" key
-    #           if you find it 
-    #               then examine each one of those for an "elements" key
-    #               if you find it
-    #                   then look inside each "element" for one with type "user"
-    #                   if you find it  
-    #                   and if that user matches the bot_user_id 
-    #                   then it's a message for the bot
-    if message.get('blocks'):
-        for block in message.get('blocks'):
-            if block.get('type') == 'rich_text':
-                for rich_text_section in block.get('elements'):
-                    for element in rich_text_section.get('elements'):
-                        if element.get('type') == 'user' and element.get('user_id') == bot_user_id:
-                            for element in rich_text_section.get('elements'):
-                                if element.get('type') == 'text':
-                                    # the user is asking the bot a question
-                                    query = element.get('text')
-                                    response = answer_question(query,message)
-                                    say(str(response))
-                                    return
+def reply(message, say, context):
+    # the same message can reach us more than once; only handle it the first time
+    if seen.check_and_add(f"message:{message.get('channel')}:{message.get('ts')}"):
+        return
+    # keep any thread we're caching up to date
+    if message.get('thread_ts'):
+        threads.append(message.get('channel'), message)
+    with metrics.span("mention_detection"):
+        query = mentioned_query(message)
+    if query is not None:
+        # the user is asking the bot a question
+        dispatcher.submit(answer_in_channel, query, message, on_busy=lambda: say(BUSY_REPLY))
+        return
     # if it's not a question, it might be a threaded reply
     # if it's a reply to the bot, we treat it as if it were a question
-    if message.get('thread_ts'):
-        if message.get('parent_user_id') == bot_user_id:
-            query = message.get('text')
-            replies = app.client.conversations_replies(
-                channel=message.get('channel'),
-                ts=message.get('thread_ts')
-            )
-            response = answer_question(query,message,replies)
-            #say(str(response))
-            app.client.chat_postMessage(
-                channel=message.get('channel'),
-                text=str(response),
-                thread_ts=message.get('thread_ts')
-            )
-            return
+    if replies_to_bot(message):
+        query = message.get('text')
+        dispatcher.submit(answer_in_thread, query, message, on_busy=lambda: say(BUSY_REPLY, thread_ts=message.get('thread_ts')))
+        return
     # if it's not any kind of question, we store it in the index along with all relevant metadata
-    user_name, user_display_name = get_user_name(message.get('user'))
-
-    # format timestamp as YYYY-MM-DD HH:MM:SS
-    dt_object = datetime.datetime.fromtimestamp(float(message.get('ts')))
-    formatted_time = dt_object.strftime('%Y-%m-%d %H:%M:%S')
+    # answers already given in this thread didn't know about this reply
+    if message.get('thread_ts'):
+        answer_cache.forget_thread(message.get('channel'), message.get('thread_ts'))
+    # with a write-ahead log, log_events has logged it, and the consumer stores it
+    if event_log is not None:
+        return
 
-    # format full message
+    # create the node (or update the window) this message belongs in, linked to the ones before it
+    # ids come from the channel and timestamps, so storing one again is a harmless upsert
     text = message.get('text')
+    # which workspace it's from, so each workspace only searches its own messages
+    message = dict(message, team=message.get('team') or context.team_id)
+    user_name, user_display_name = get_author(message)
+    for node in windows.add(message, user_name):
+        ingest_buffer.add(node)
+    print("Queued message:", text)
 
-    # create a node and apply metadata
-    node = TextNode(
-        text=text,
-        id_=str(uuid.uuid4()),
-        metadata={
-            "who": user_name,
-            "when": formatted_time
-        }
-    )
-    if PREVIOUS_NODE is not None:
-        node.relationships[NodeRelationship.PREVIOUS] = RelatedNodeInfo(node_id=PREVIOUS_NODE.node_id)
-        PREVIOUS_NODE = node
-
-    index.insert_nodes([node])
-    print("Stored message:", text)
+# stores what's in the write-ahead log, starting from where the last run got to
+# a whole WAL_BATCH_SIZE batch is embedded and stored at once, so a backlog clears quickly
+if event_log is not None:
+    WAL_BATCH_SIZE = int(os.environ.get("WAL_BATCH_SIZE", 256))
+    def event_replay(windows, message_sync):
+        return EventReplay(windows, message_sync, ingest_buffer, lambda message: get_author(message)[0],
+                           answer_cache.forget_sources, batch_size=WAL_BATCH_SIZE)
+    event_consumer = LogConsumer(event_log, event_replay(windows, message_sync), batch_size=WAL_BATCH_SIZE).start()
+    # registered after the ingest buffer's, so it runs first and can still store
+    atexit.register(event_consumer.close)
+    # and the logs of workers that are gone, from when WEB_CONCURRENCY was higher
+    # each gets windows of its own: its messages are older than the ones coming in now,
+    # and adding them to the live windows would mix them into today's conversations
+    def abandoned_replay():
+        drained = conversation_windows()
+        return event_replay(drained, MessageSync(client, "slack_messages", drained, ingest_buffer))
+    drain_abandoned(os.environ["WAL_DIR"], int(os.environ.get("WEB_CONCURRENCY", 1)), abandoned_replay, batch_size=WAL_BATCH_SIZE)
 
 if __name__ == "__main__":
     flask_app.run(port=3000)
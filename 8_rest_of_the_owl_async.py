@@ -0,0 +1,555 @@
+# the same bot as 8_rest_of_the_owl.py, rewritten for asyncio
+# the Flask version ties up a whole thread for every question while it waits on
+# the LLM. Here waiting is cheap, so one process can have lots of questions in
+# flight at once, and Slack lookups that don't depend on each other happen at
+# the same time. It's an ASGI app, so you run it with an ASGI server:
+#
+#   pip install uvicorn
+#   uvicorn app:asgi_app --port 3000
+
+# env first
+import dotenv
+dotenv.load_dotenv()
+
+# slack app deps
+import asyncio, json, os
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.response import BoltResponse
+from slack_bolt.adapter.asgi.async_handler import AsyncSlackRequestHandler
+
+# RAG app deps
+from llama_index import VectorStoreIndex, StorageContext, set_global_handler
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from llama_index.utils import get_tokenizer
+
+# our own helpers, shared with the Flask version
+from dispatch import AsyncDispatcher # answers questions as asyncio tasks, with a limit on how many
+from dedup import SeenStore # remembers events we've already handled, since Slack redelivers them
+from windows import ConversationWindows, NeighborExpander # turns messages into linked nodes, and follows the links when answering
+from ingest import IngestBuffer # embeds and stores messages in batches
+from message_sync import MessageSync # applies edits and deletes to what we've stored
+from query_engines import QueryEnginePool # query engines built once at startup, not per question
+from users import AsyncUserDirectory, bot_name # caches user names so we don't ask Slack every time
+from thread_cache import ThreadCache # replies in threads, kept up to date from events
+from storage import CollectionConfig, ensure_collection, make_client, make_async_client # Qdrant clients and the collection
+from indexer import RemoteIngest, RemoteWindows, RemoteSync # sends messages to a separate indexer process instead of storing them ourselves
+from retrieval import SlackRetriever, ScopedQuery # searches Qdrant with recency built in, in the channels a question may see
+from channels import ChannelScope, afind_channels, bot_channels_from_env # which channels we join, and which each question searches
+from bootstrap import BootstrapCache # who the bot is and which channels it's in, saved so restarts don't ask Slack
+from keyword_index import keyword_index_from_env # finds messages with the exact ids and names in a question
+from answer_cache import AnswerCache # answers to questions people keep asking
+from embedding_cache import cached_service_context, embedding_cache_stats # embeds each piece of text only once
+from context_packing import ContextPacker # chooses which messages fit in the prompt
+from retention import retention_from_env # deletes and summarizes old messages
+from streaming import AsyncStreamingMessage # shows an answer in Slack while it's being written
+from slack_client import PacedAsyncWebClient # paces Slack calls to their rate limits, over kept-open connections
+from metrics import Metrics, MetricsHandler, PayloadLog, TimedPostprocessor # how long each stage takes, for /metrics
+from wal import LogConsumer, EventReplay, claim_log, drain_abandoned # keeps messages on disk until they're stored
+
+set_global_handler("simple")
+
+# initialize qdrant clients
+# searches use the async client when there's a Qdrant server (QDRANT_URL);
+# the embedded store only has a sync client, so searches run on a worker thread
+client = make_client()
+aclient = make_async_client()
+# QDRANT_QUANTIZATION, QDRANT_ON_DISK and the QDRANT_HNSW_ settings choose how a new collection
+# stores its vectors, for when there are too many to keep in RAM; see storage.py
+collection_config = CollectionConfig.from_env()
+ensure_collection(client, "slack_messages", int(os.environ.get("EMBEDDING_DIM", 1536)), collection_config)
+vector_store = QdrantVectorStore(client=client, collection_name="slack_messages")
+storage_context = StorageContext.from_defaults(vector_store=vector_store)
+
+# embeddings are cached in EMBEDDING_CACHE_DB, so text we've seen before isn't embedded again
+index = VectorStoreIndex([],storage_context=storage_context,service_context=cached_service_context())
+
+# how long each stage of handling a message takes, served on /metrics
+metrics = Metrics()
+index.service_context.callback_manager.add_handler(MetricsHandler(metrics))
+# one in every 1/EVENT_LOG_SAMPLE incoming events is printed (cut short)
+payload_log = PayloadLog(rate=float(os.environ.get("EVENT_LOG_SAMPLE", 0.01)))
+
+# storing messages happens on the ingest buffer's own thread, same as the Flask version
+if os.environ.get("INDEXER_SOCKET"):
+    ingest_buffer = RemoteIngest(os.environ["INDEXER_SOCKET"])
+else:
+    ingest_buffer = IngestBuffer(
+        index,
+        max_batch=int(os.environ.get("INGEST_BATCH_SIZE", 32)),
+        max_delay=float(os.environ.get("INGEST_MAX_DELAY", 2.0)),
+        max_pending=int(os.environ.get("INGEST_MAX_PENDING", 1000))
+    )
+
+# every stored message also goes into a keyword index (KEYWORD_INDEX_DB, "" turns it off),
+# so questions about a ticket id or hostname find the messages that mention it
+# with INDEXER_SOCKET set, the indexer adds to it and we only search it
+keyword_index = keyword_index_from_env()
+if keyword_index is not None and not os.environ.get("INDEXER_SOCKET"):
+    ingest_buffer.listeners.append(keyword_index.add)
+    ingest_buffer.delete_listeners.append(keyword_index.delete)
+
+# RETENTION_DAYS, RETENTION_CHANNEL_DAYS and COMPACT_AFTER_DAYS forget (or summarize) old
+# messages on a background thread; with INDEXER_SOCKET set, the indexer does that instead
+retention = None
+if not os.environ.get("INDEXER_SOCKET"):
+    retention = retention_from_env(client, "slack_messages", index.service_context, vector_store)
+    if retention is not None:
+        retention.start()
+
+# INGEST_WINDOW_SIZE=1 (the default) stores each message on its own; with more than
+# one, messages are stored in overlapping conversation windows instead (see windows.py)
+# either way each node is linked to the ones before and after it in its channel or thread
+# with INDEXER_SOCKET set, messages are sent to the indexer as they are, and it builds the
+# windows and applies edits and deletes: it sees every worker's messages, so windows aren't
+# split between workers and their links are in order
+INGEST_WINDOW_SIZE = int(os.environ.get("INGEST_WINDOW_SIZE", 1))
+def conversation_windows():
+    return ConversationWindows(
+        size=INGEST_WINDOW_SIZE,
+        overlap=int(os.environ.get("INGEST_WINDOW_OVERLAP", min(2, INGEST_WINDOW_SIZE - 1))),
+        max_gap_seconds=float(os.environ.get("INGEST_WINDOW_GAP", 900))
+    )
+if os.environ.get("INDEXER_SOCKET"):
+    windows = RemoteWindows(ingest_buffer)
+    message_sync = RemoteSync(ingest_buffer)
+else:
+    windows = conversation_windows()
+    # edited and deleted messages are changed in place, found by their channel and timestamp
+    message_sync = MessageSync(client, "slack_messages", windows, ingest_buffer)
+
+# with WAL_DIR set, messages, edits and deletes are written to a log there before Slack
+# gets its ack (see log_events), and stored from the log by a consumer thread started in
+# startup(), so a crash or an embedding API outage doesn't lose them (see wal.py)
+# each worker claims a log of its own in WAL_DIR
+event_log = None
+event_consumer = None
+if os.environ.get("WAL_DIR") and not os.environ.get("INDEXER_SOCKET"):
+    event_log = claim_log(os.environ["WAL_DIR"], fsync_interval=float(os.environ.get("WAL_FSYNC_INTERVAL", 0)))
+
+# Initialize your app with your bot token and signing secret
+app = AsyncApp(
+    client=PacedAsyncWebClient(
+        token=os.environ.get("SLACK_BOT_TOKEN"),
+        base_url=os.environ.get("SLACK_API_URL", PacedAsyncWebClient.BASE_URL),
+        limit_scale=float(os.environ.get("SLACK_RATE_LIMIT_SCALE", 1))
+    ),
+    signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
+    process_before_response=False
+)
+# Slack sends events to "/", like the Flask version
+bolt_handler = AsyncSlackRequestHandler(app, path="/")
+
+# event ids and (channel, ts) pairs we've already handled
+seen = SeenStore(
+    max_size=int(os.environ.get("DEDUP_MAX_SIZE", 10000)),
+    ttl=int(os.environ.get("DEDUP_TTL", 3600)),
+    sqlite_path=os.environ.get("DEDUP_DB")
+)
+
+# print a sample of the events we get
+@app.middleware
+async def log_payloads(request, body, next):
+    payload_log.log("Incoming event:", body)
+    return await next()
+
+# if Slack is retrying an event we already have, ack it and do nothing else
+@app.middleware
+async def skip_duplicate_events(request, body, next):
+    event_id = body.get('event_id')
+    if event_id and seen.check_and_add("event:" + event_id):
+        retry_num = request.headers.get('x-slack-retry-num', ['0'])[0]
+        print(f"Skipping duplicate event {event_id} (retry {retry_num})")
+        return BoltResponse(status=200, body="")
+    return await next()
+
+# Bolt acks an event once the middleware is done, so with a write-ahead log this is where
+# messages, edits and deletes go into it, like the Flask version; waiting for the fsync
+# happens on a thread
+@app.middleware
+async def log_events(body, next):
+    if event_log is not None and body.get('type') == 'event_callback':
+        record = loggable(body['event'], body.get('team_id'))
+        if record is not None:
+            await asyncio.to_thread(event_log.append, record)
+    return await next()
+
+# everybody's names; warmed up in startup()
+users = AsyncUserDirectory(
+    app.client,
+    ttl=int(os.environ.get("USER_CACHE_TTL", 3600)),
+    max_size=int(os.environ.get("USER_CACHE_SIZE", 10000))
+)
+
+# get a user's username and display name from their user id
+async def get_user_name(user_id):
+    with metrics.span("user_lookup"):
+        return await users.get(user_id)
+
+# the same for whoever sent a message; messages from bots and integrations have no user
+async def get_author(message):
+    with metrics.span("user_lookup"):
+        return await users.author(message)
+
+# who we are and which channels we've joined, kept in BOOTSTRAP_CACHE so starting again doesn't wait for Slack
+bootstrap = BootstrapCache.from_env()
+
+# we can't await at import time, so anything that talks to Slack at startup happens here
+bot_user_id = None
+async def startup():
+    global bot_user_id, event_consumer
+    bot_user_id = (await bootstrap.aauth(app.client))["user_id"]
+    if event_log is not None:
+        # the consumer runs on its own thread, and looks up user names back on this loop
+        loop = asyncio.get_running_loop()
+        batch_size = int(os.environ.get("WAL_BATCH_SIZE", 256))
+        def event_replay(windows, message_sync):
+            return EventReplay(windows, message_sync, ingest_buffer,
+                               lambda message: asyncio.run_coroutine_threadsafe(get_author(message), loop).result()[0],
+                               answer_cache.forget_sources, batch_size=batch_size)
+        event_consumer = LogConsumer(event_log, event_replay(windows, message_sync), batch_size=batch_size).start()
+        # and the logs of workers that are gone, from when WEB_CONCURRENCY was higher
+        # each gets windows of its own: its messages are older than the ones coming in now,
+        # and adding them to the live windows would mix them into today's conversations
+        def abandoned_replay():
+            drained = conversation_windows()
+            return event_replay(drained, MessageSync(client, "slack_messages", drained, ingest_buffer))
+        drain_abandoned(os.environ["WAL_DIR"], int(os.environ.get("WEB_CONCURRENCY", 1)), abandoned_replay, batch_size=batch_size)
+    # joining BOT_CHANNELS (default bot-testing, * for all of them) can take a while, so it happens in the background
+    asyncio.create_task(join_channels())
+    asyncio.create_task(warm_users())
+
+async def join_channels():
+    names, all_channels = bot_channels_from_env()
+    try:
+        channel_ids = await bootstrap.achannels(app.client, names, all_channels, afind_channels)
+        print(f"Listening in {len(channel_ids)} channels")
+    except Exception as e:
+        print("Could not join channels:", e)
+
+async def warm_users():
+    try:
+        await users.warm()
+    except Exception as e:
+        print("Could not preload users, will look them up as we go:", e)
+
+# the prompt we give the LLM; who_is_asking and replies_stanza are filled in for each question
+QA_TEMPLATE = (
+    "Your context is a series of chat messages. Each one is tagged with 'who:' \n"
+    "indicating who was speaking and 'when:' indicating when they said it, \n"
+    "followed by a line break and then what they said.\n"
+    "Some of them are a stretch of conversation, with each line starting with the name of whoever said it.\n"
+    "The messages are sorted by recency, so the most recent one is first in the list.\n"
+    "The most recent messages should take precedence over older ones.\n"
+    "---------------------\n"
+    "{context_str}"
+    "\n---------------------\n"
+    "The person who is asking the question is called '{who_is_asking}'.\n"
+    "{replies_stanza}\n"
+    "You are a helpful AI assistant who has been listening to everything everyone has been saying. \n"
+    "Given the most relevant chat messages above, please answer this question: {query_str}\n"
+)
+
+# waiting is cheap here, so we can answer many more questions at once than the Flask version
+ANSWER_CONCURRENCY = int(os.environ.get("ANSWER_CONCURRENCY", 32))
+retriever = SlackRetriever(
+    client,
+    "slack_messages",
+    index.service_context.embed_model,
+    similarity_top_k=int(os.environ.get("CONTEXT_CANDIDATES", 40)),
+    mode=os.environ.get("RETRIEVAL_MODE", "similarity"),
+    window_seconds=float(os.environ["RECENCY_WINDOW_DAYS"]) * 86400 if os.environ.get("RECENCY_WINDOW_DAYS") else None,
+    half_life_seconds=float(os.environ.get("RECENCY_HALF_LIFE_DAYS", 7)) * 86400,
+    recency_weight=float(os.environ.get("RECENCY_WEIGHT", 0.3)),
+    search_params=collection_config.search_params(),
+    keyword_index=keyword_index,
+    keyword_top_k=int(os.environ.get("KEYWORD_CANDIDATES", 20)),
+    aclient=aclient,
+    callback_manager=index.service_context.callback_manager
+)
+# STREAM_ANSWERS=1 posts a placeholder and fills in the answer as it's written
+STREAM_ANSWERS = os.environ.get("STREAM_ANSWERS", "").lower() in ("1", "true", "yes")
+STREAM_UPDATE_INTERVAL = float(os.environ.get("STREAM_UPDATE_INTERVAL", 1.0))
+# the tokenizer is loaded the first time we count something (it may have to be downloaded), not at startup
+def count_tokens(text):
+    return len(get_tokenizer()(text))
+# we fetch CONTEXT_CANDIDATES messages and send the best of them that fit in CONTEXT_TOKENS
+context_packer = ContextPacker(
+    count_tokens=count_tokens,
+    token_budget=int(os.environ.get("CONTEXT_TOKENS", 3000))
+)
+# CONTEXT_NEIGHBORS links either side of each match are added too, before packing
+CONTEXT_NEIGHBORS = int(os.environ.get("CONTEXT_NEIGHBORS", 1))
+postprocessors = [context_packer]
+if CONTEXT_NEIGHBORS:
+    postprocessors.insert(0, NeighborExpander(client, "slack_messages", hops=CONTEXT_NEIGHBORS))
+query_engines = QueryEnginePool(
+    index, QA_TEMPLATE, size=ANSWER_CONCURRENCY, retriever=retriever, streaming=STREAM_ANSWERS,
+    node_postprocessors=[TimedPostprocessor(postprocessors, metrics)]
+)
+
+# a question close enough to one already answered in the same channel or thread gets the same answer
+# both caches only hear about the messages that reach this process, so with more than one
+# worker (WEB_CONCURRENCY) they'd miss the ones Slack sends to the others and go stale; they're
+# turned off then. With INDEXER_SOCKET, the indexer builds the nodes, so we can't tell which
+# answers a new message would change, and the answer cache is off too
+SHARED_WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1)) > 1
+ANSWER_CACHE_MB = 0 if SHARED_WORKERS or os.environ.get("INDEXER_SOCKET") else int(os.environ.get("ANSWER_CACHE_MB", 16))
+answer_cache = AnswerCache(
+    index.service_context.embed_model,
+    threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95)),
+    ttl=int(os.environ.get("ANSWER_CACHE_TTL", 3600)),
+    max_bytes=ANSWER_CACHE_MB * 1024 * 1024
+)
+ingest_buffer.listeners.append(answer_cache.invalidate)
+
+# threads the bot is talking in; only the newest replies that fit in THREAD_CONTEXT_TOKENS go in the prompt
+threads = ThreadCache(
+    max_threads=0 if SHARED_WORKERS else int(os.environ.get("THREAD_CACHE_SIZE", 500)),
+    max_replies=int(os.environ.get("THREAD_CACHE_REPLIES", 200)),
+    count_tokens=count_tokens
+)
+THREAD_CONTEXT_TOKENS = int(os.environ.get("THREAD_CONTEXT_TOKENS", 2000))
+
+# SEARCH_SCOPE: channel (the default), allowed (plus SEARCH_CHANNELS) or all; see channels.py
+channel_scope = ChannelScope.from_env()
+
+# fetch every reply in a thread from Slack, a page at a time
+async def fetch_thread(channel, thread_ts):
+    messages = []
+    cursor = None
+    with metrics.span("thread_fetch"):
+        while True:
+            page = await app.client.conversations_replies(channel=channel, ts=thread_ts, cursor=cursor, limit=200)
+            messages.extend(page['messages'])
+            cursor = page.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return messages
+
+# given a query and a message, answer the question and return the response
+async def answer_question(query, message, replies=None, stream_to=None):
+    scope = (message.get('channel'), message.get('thread_ts'))
+    embedding = await index.service_context.embed_model.aget_query_embedding(query)
+    cached = answer_cache.lookup(scope, embedding)
+    if cached is not None:
+        return cached
+    # look up the asker and everyone in the thread at the same time, not one after another
+    user_ids = {message.get('user')} | {reply.get('user') for reply in replies or []}
+    user_ids = [user_id for user_id in user_ids if user_id]
+    names = dict(zip(user_ids, await asyncio.gather(*(get_user_name(user_id) for user_id in user_ids))))
+    who_is_asking = names[message['user']][0] if message.get('user') else bot_name(message)
+    replies_stanza = ""
+    if (replies is not None):
+        replies_stanza = "In addition to the context above, the question you're about to answer has been discussed in the following chain of replies:\n"
+        render_reply = lambda reply: (names.get(reply.get('user')) or (bot_name(reply),))[0] + ": " + (reply.get('text') or "")
+        for line in threads.tail(replies, render_reply, THREAD_CONTEXT_TOKENS):
+            replies_stanza += line + "\n"
+    query_bundle = ScopedQuery(
+        query, embedding=embedding, channel_ids=channel_scope.channels_for(message.get('channel')), team_id=message.get('team')
+    )
+    if stream_to is None:
+        response = await query_engines.aquery(query_bundle, who_is_asking=who_is_asking, replies_stanza=replies_stanza)
+    else:
+        # the search and the start of the stream run on a thread, then we read the stream as it arrives
+        response = await asyncio.to_thread(
+            query_engines.stream, query_bundle, who_is_asking=who_is_asking, replies_stanza=replies_stanza
+        )
+        response.response_txt = await stream_to.consume(response.response_gen)
+    answer_cache.store(scope, embedding, response)
+    return response
+
+# questions run as tasks; if too many pile up we say we're busy instead
+dispatcher = AsyncDispatcher(
+    concurrency=ANSWER_CONCURRENCY,
+    max_queue=int(os.environ.get("ANSWER_QUEUE_SIZE", 64))
+)
+BUSY_REPLY = "I'm a bit busy right now, try asking me again in a minute!"
+# what a streamed answer is replaced with if answering it fails partway
+FAILED_REPLY = "Sorry, something went wrong while I was answering that. Try asking me again?"
+
+# answer a question and post the answer, streaming it if STREAM_ANSWERS is on
+async def post_answer(query, message, replies=None, thread_ts=None):
+    channel = message.get('channel')
+    if STREAM_ANSWERS:
+        with metrics.span("slack_post"):
+            streamed = await AsyncStreamingMessage(app.client, channel, thread_ts=thread_ts, interval=STREAM_UPDATE_INTERVAL).start()
+        try:
+            response = await answer_question(query, message, replies, stream_to=streamed)
+        except Exception:
+            # don't leave the placeholder, or half an answer with its cursor, up for good
+            with metrics.span("slack_post"):
+                await streamed.finish(FAILED_REPLY)
+            raise
+        with metrics.span("slack_post"):
+            return await streamed.finish(str(response))
+    response = await answer_question(query, message, replies)
+    with metrics.span("slack_post"):
+        posted = await app.client.chat_postMessage(
+            channel=channel,
+            text=str(response),
+            thread_ts=thread_ts
+        )
+    return posted['message']
+
+# answer a question that mentioned the bot, in the channel it was asked in
+async def answer_in_channel(query, message):
+    await post_answer(query, message)
+
+# answer a follow-up in a thread, using the rest of the thread as extra context
+async def answer_in_thread(query, message):
+    channel = message.get('channel')
+    thread_ts = message.get('thread_ts')
+    replies = await threads.aget_or_seed(channel, thread_ts, lambda: fetch_thread(channel, thread_ts))
+    posted = await post_answer(query, message, replies, thread_ts=thread_ts)
+    # we don't get events for our own messages, so add our answer to the thread ourselves
+    threads.append(channel, dict(posted, thread_ts=thread_ts))
+
+def stats():
+    return {
+        "dispatch": dispatcher.stats(),
+        "dedup": seen.stats(),
+        "ingest": ingest_buffer.stats(),
+        "users": users.stats(),
+        "threads": threads.stats(),
+        "answers": answer_cache.stats(),
+        "context": context_packer.stats(),
+        "windows": windows.stats(),
+        "sync": message_sync.stats(),
+        "retention": retention.stats() if retention is not None else None,
+        "keywords": keyword_index.stats() if keyword_index is not None else None,
+        "embeddings": embedding_cache_stats(index.service_context),
+        "events": payload_log.stats(),
+        "slack": app.client.stats(),
+        "bootstrap": bootstrap.stats(),
+        "wal": event_consumer.stats() if event_consumer is not None else None
+    }
+
+# which events are stored, the same as the Flask version
+def edited_message(event):
+    message = dict(event['message'], channel=event['channel'])
+    if message.get('text') == event.get('previous_message', {}).get('text') or message.get('user') == bot_user_id:
+        return None
+    return message
+
+def deleted_message(event):
+    return dict(event.get('previous_message') or {}, channel=event['channel'], ts=event['deleted_ts'])
+
+def mentioned_query(message):
+    for block in message.get('blocks') or []:
+        if block.get('type') == 'rich_text':
+            for rich_text_section in block.get('elements'):
+                for element in rich_text_section.get('elements'):
+                    if element.get('type') == 'user' and element.get('user_id') == bot_user_id:
+                        for element in rich_text_section.get('elements'):
+                            if element.get('type') == 'text':
+                                return element.get('text')
+    return None
+
+def replies_to_bot(message):
+    return bool(message.get('thread_ts')) and message.get('parent_user_id') == bot_user_id
+
+MESSAGE_SUBTYPES = (None, "bot_message", "thread_broadcast", "file_share")
+
+def loggable(event, team_id):
+    if event.get('type') != 'message':
+        return None
+    if event.get('subtype') == 'message_changed':
+        message = edited_message(event)
+        return {"kind": "edit", "message": message} if message is not None else None
+    if event.get('subtype') == 'message_deleted':
+        return {"kind": "delete", "message": deleted_message(event)}
+    if event.get('subtype') not in MESSAGE_SUBTYPES or mentioned_query(event) is not None or replies_to_bot(event):
+        return None
+    if seen.check_and_add(f"logged:{event.get('channel')}:{event.get('ts')}"):
+        return None
+    return {"kind": "message", "message": dict(event, team=event.get('team') or team_id)}
+
+# someone edited a message, so store the new text in place of the old
+# looking up what's stored talks to Qdrant, so it runs on a thread
+@app.event({"type": "message", "subtype": "message_changed"})
+async def sync_edit(event):
+    message = edited_message(event)
+    if message is None:
+        return
+    if message.get('thread_ts'):
+        threads.append(event['channel'], message)
+        answer_cache.forget_thread(event['channel'], message['thread_ts'])
+    # with a write-ahead log, log_events has logged it, and the consumer applies it
+    if event_log is not None:
+        return
+    answer_cache.forget_sources(await asyncio.to_thread(message_sync.edit, message))
+
+# someone deleted a message, so forget it
+@app.event({"type": "message", "subtype": "message_deleted"})
+async def sync_delete(event):
+    message = deleted_message(event)
+    if message.get('thread_ts'):
+        threads.remove(event['channel'], message['thread_ts'], message['ts'])
+        answer_cache.forget_thread(event['channel'], message['thread_ts'])
+    if event_log is not None:
+        return
+    answer_cache.forget_sources(await asyncio.to_thread(message_sync.delete, message))
+
+# somebody changed their name or profile, so update our copy
+@app.event("user_change")
+async def refresh_user(event):
+    users.update(event['user'])
+
+# this handles any incoming message the bot can hear
+@app.message()
+async def reply(message, say, context):
+    # the same message can reach us more than once; only handle it the first time
+    if seen.check_and_add(f"message:{message.get('channel')}:{message.get('ts')}"):
+        return
+    # keep any thread we're caching up to date
+    if message.get('thread_ts'):
+        threads.append(message.get('channel'), message)
+    # look for a mention of the bot, the same way the Flask version does
+    with metrics.span("mention_detection"):
+        query = mentioned_query(message)
+    if query is not None:
+        # the user is asking the bot a question
+        await dispatcher.submit(answer_in_channel, query, message, on_busy=lambda: say(BUSY_REPLY))
+        return
+    # if it's a reply to the bot, we treat it as if it were a question
+    if replies_to_bot(message):
+        query = message.get('text')
+        await dispatcher.submit(answer_in_thread, query, message, on_busy=lambda: say(BUSY_REPLY, thread_ts=message.get('thread_ts')))
+        return
+    # if it's not any kind of question, we store it in the index along with all relevant metadata
+    if message.get('thread_ts'):
+        answer_cache.forget_thread(message.get('channel'), message.get('thread_ts'))
+    # with a write-ahead log, log_events has logged it, and the consumer stores it
+    if event_log is not None:
+        return
+    message = dict(message, team=message.get('team') or context.team_id)
+    user_name, user_display_name = await get_author(message)
+    # adding can block briefly if the ingest buffer (or the indexer) is backed up, so keep it off the event loop
+    for node in await asyncio.to_thread(windows.add, message, user_name):
+        await asyncio.to_thread(ingest_buffer.add, node)
+    print("Queued message:", message.get('text'))
+
+# the ASGI app: Slack events go to Bolt, and /stats and /metrics are answered here
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                await startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                # the consumer still needs this loop for user names, so it stops on a thread
+                if event_consumer is not None:
+                    await asyncio.to_thread(event_consumer.close)
+                await asyncio.to_thread(ingest_buffer.close)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    elif scope["type"] == "http" and scope["path"] == "/stats":
+        body = json.dumps(stats()).encode()
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+    elif scope["type"] == "http" and scope["path"] == "/metrics":
+        body = metrics.render(stats()).encode()
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain; version=0.0.4")]})
+        await send({"type": "http.response.body", "body": body})
+    else:
+        await bolt_handler(scope, receive, send)
@@ -0,0 +1,163 @@
+# remembers answers to questions people keep asking
+# "when is the launch?" gets asked over and over, and every time it costs a
+# retrieval and an LLM call. We keep recent answers along with the embedding of
+# the question; a new question whose embedding is close enough to a cached one,
+# asked in the same channel (or thread), gets the cached answer.
+#
+# An answer goes stale when a new message comes in that would have been one of
+# its sources: one at least as similar to the question as the least similar
+# message the answer was built from, or when one of its sources is deleted.
+# Answers also expire after ttl seconds, and the least recently used ones are
+# dropped when we go over max_bytes
+import collections, threading, time
+import numpy as np
+from llama_index.schema import MetadataMode
+
+
+def _unit(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class CachedAnswer:
+    def __init__(self, scope, vector, answer, min_source_score, expires, sources=()):
+        self.scope = scope
+        self.vector = vector
+        self.answer = answer
+        # how similar a new message has to be to the question to make this answer stale
+        self.min_source_score = min_source_score
+        self.expires = expires
+        # ids of the messages it was built from
+        self.sources = frozenset(sources)
+        # roughly what this entry costs us: the vector, the text, the source ids and some overhead
+        self.size = vector.nbytes + len(answer.encode()) + 40 * len(self.sources) + 200
+
+
+class AnswerCache:
+    def __init__(self, embed_model, threshold=0.95, ttl=3600, max_bytes=16 * 1024 * 1024):
+        # used to embed new messages that arrive without an embedding
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # entry id -> CachedAnswer, least recently used first
+        self.entries = collections.OrderedDict()
+        self.ids = iter(range(2 ** 62))
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evicted = 0
+        self.expired = 0
+        self.invalidated = 0
+
+    # a cached answer for this question in this scope, or None
+    # scope is (channel, thread_ts), with thread_ts None for questions asked in the channel
+    def lookup(self, scope, query_embedding):
+        vector = _unit(query_embedding)
+        now = time.time()
+        with self.lock:
+            best_id, best_score = None, self.threshold
+            for entry_id, entry in list(self.entries.items()):
+                if entry.expires <= now:
+                    self._remove(entry_id)
+                    self.expired += 1
+                    continue
+                if entry.scope != scope:
+                    continue
+                score = float(np.dot(vector, entry.vector))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best_id)
+            self.hits += 1
+            return self.entries[best_id].answer
+
+    # remember the answer to a question, along with the scores of the messages it came from
+    def store(self, scope, query_embedding, response):
+        answer = str(response)
+        sources = getattr(response, "source_nodes", [])
+        # SlackRetriever keeps each message's similarity to the question, since its scores can be
+        # fused ranks or blended with recency; neighbors it brought in along the way don't count
+        scores = [source.node.metadata["similarity"] for source in sources if "similarity" in source.node.metadata]
+        if not scores:
+            scores = [source.score for source in sources if source.score is not None]
+        # with no sources to compare against, any new message makes it stale
+        min_source_score = min(scores) if scores else -1.0
+        entry = CachedAnswer(scope, _unit(query_embedding), answer, min_source_score, time.time() + self.ttl,
+                             [source.node.node_id for source in sources])
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            self.entries[next(self.ids)] = entry
+            self.bytes += entry.size
+            self.stores += 1
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evicted += 1
+
+    def _remove(self, entry_id):
+        entry = self.entries.pop(entry_id)
+        self.bytes -= entry.size
+
+    # drop answers that new messages would have changed; nodes without embeddings get embedded here
+    # retrieval searches every channel, so a new message can make an answer anywhere stale
+    def invalidate(self, nodes):
+        with self.lock:
+            if not self.entries:
+                return 0
+        missing = [node for node in nodes if node.embedding is None]
+        if missing:
+            texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in missing]
+            for node, embedding in zip(missing, self.embed_model.get_text_embedding_batch(texts)):
+                node.embedding = embedding
+        messages = np.stack([_unit(node.embedding) for node in nodes])
+        with self.lock:
+            entry_ids = list(self.entries)
+            if not entry_ids:
+                return 0
+            questions = np.stack([self.entries[entry_id].vector for entry_id in entry_ids])
+            # how similar each new message is to each cached question
+            closest = (questions @ messages.T).max(axis=1)
+            stale = [entry_id for entry_id, score in zip(entry_ids, closest)
+                     if score >= self.entries[entry_id].min_source_score]
+            for entry_id in stale:
+                self._remove(entry_id)
+            self.invalidated += len(stale)
+            return len(stale)
+
+    # messages were deleted, so answers built from them are out of date
+    def forget_sources(self, node_ids):
+        node_ids = set(node_ids)
+        with self.lock:
+            stale = [entry_id for entry_id, entry in self.entries.items() if entry.sources & node_ids]
+            for entry_id in stale:
+                self._remove(entry_id)
+            self.invalidated += len(stale)
+
+    # a thread got a new reply, so answers in it were given without that reply
+    def forget_thread(self, channel, thread_ts):
+        with self.lock:
+            stale = [entry_id for entry_id, entry in self.entries.items() if entry.scope == (channel, thread_ts)]
+            for entry_id in stale:
+                self._remove(entry_id)
+            self.invalidated += len(stale)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evicted": self.evicted,
+                "expired": self.expired,
+                "invalidated": self.invalidated,
+            }
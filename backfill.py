@@ -0,0 +1,291 @@
+# backfill: read the history of a channel and store it in the index
+# the bot only learns from messages it sees live, so a fresh deployment starts
+# out knowing nothing. This pages through conversations_history (and the replies
+# of every thread) and stores the messages the same way the bot does, embedding
+# them in big batches. It saves its place after every page, so if it's
+# interrupted, running it again picks up where it left off. Messages are grouped
+# into conversation windows (INGEST_WINDOW_SIZE etc., like the bot) and linked to
+# the ones around them, and go into the keyword index too. --reindex starts every channel again from the beginning,
+# to store messages kept before we recorded their channel and team; with
+# --all-channels, it then deletes those old copies
+#
+#   python backfill.py --channel bot-testing
+#   python backfill.py --all-channels --concurrency 8
+#   python backfill.py --all-channels --reindex
+#   python backfill.py --fake    # offline, against a fake Slack and fake models
+import dotenv
+dotenv.load_dotenv()
+
+import argparse, json, os, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+import qdrant_client
+from qdrant_client.http import models
+from llama_index import ServiceContext
+from llama_index.schema import MetadataMode, NodeRelationship, RelatedNodeInfo
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+
+from windows import ConversationWindows, conversation_for
+from storage import LockedClient, ensure_collection, make_client
+from embedding_cache import cached_service_context, embedding_cache_stats
+from keyword_index import KeywordIndex, keyword_index_from_env
+from users import UserDirectory
+from channels import find_channels
+from slack_client import PacedWebClient
+
+# the kinds of message app.message() hands to the bot; joins, topic changes etc. aren't stored
+STORED_SUBTYPES = (None, "bot_message", "file_share", "thread_broadcast")
+
+
+# would the bot have stored this message if it had seen it live?
+def should_store(message, bot_user_id):
+    if message.get('subtype') not in STORED_SUBTYPES or not message.get('text'):
+        return False
+    # the bot never sees its own messages
+    if message.get('user') == bot_user_id:
+        return False
+    # questions for the bot and follow-ups in its threads are answered, not stored
+    if f"<@{bot_user_id}>" in message['text'] or message.get('parent_user_id') == bot_user_id:
+        return False
+    return True
+
+
+# where we got to in each channel, saved as JSON after every page
+# with fresh=True, where earlier runs got to is ignored (and overwritten as we go)
+class Checkpoint:
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self.state = {}
+        if os.path.exists(path) and not fresh:
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def get(self, channel_id):
+        return self.state.get(channel_id, {"cursor": None, "done": False, "messages": 0})
+
+    def save(self, channel_id, cursor, done, messages):
+        self.state[channel_id] = {"cursor": cursor, "done": done, "messages": messages}
+        # write to a temporary file and rename it, so a crash never leaves half a checkpoint
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class Backfill:
+    def __init__(self, client, vector_store, embed_model, users, bot_user_id, checkpoint,
+                 batch_size=256, concurrency=4, page_size=200, team_id=None, keyword_index=None,
+                 window_size=1, window_overlap=0, window_gap=900):
+        self.client = client
+        self.vector_store = vector_store
+        # the bot's keyword index, which stored messages are added to as well
+        self.keyword_index = keyword_index
+        self.embed_model = embed_model
+        if self.embed_model.embed_batch_size < batch_size:
+            self.embed_model.embed_batch_size = batch_size
+        self.users = users
+        self.bot_user_id = bot_user_id
+        # history doesn't always say which workspace a message is from
+        self.team_id = team_id
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.page_size = page_size
+        # how to group messages into windows; see ConversationWindows
+        self.window_size = window_size
+        self.window_overlap = window_overlap
+        self.window_gap = window_gap
+        # fetching threads is most of the Slack calls, so we fetch a few at a time
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        self.stored = 0
+        self.vectors = 0
+        self.started = None
+
+    def run(self, channel_ids):
+        self.started = time.monotonic()
+        for channel_id in channel_ids:
+            self.backfill_channel(channel_id)
+        elapsed = time.monotonic() - self.started
+        print(f"Backfilled {self.stored} messages as {self.vectors} vectors in {elapsed:.1f}s ({self.rate():.1f} messages/s)")
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.stored / elapsed if elapsed > 0 else 0.0
+
+    def backfill_channel(self, channel_id):
+        state = self.checkpoint.get(channel_id)
+        if state["done"]:
+            print(f"{channel_id}: already backfilled ({state['messages']} messages), skipping")
+            return
+        cursor = state["cursor"]
+        count = state["messages"]
+        # the oldest channel window of the page before, which the newest of this page links to
+        # (only within a run: a resumed backfill doesn't link back across where it stopped)
+        newer = None
+        while True:
+            page = self.client.conversations_history(channel=channel_id, cursor=cursor, limit=self.page_size)
+            messages = list(page['messages'])
+            threads = [m['ts'] for m in messages if m.get('reply_count')]
+            for replies in self.pool.map(lambda ts: self.fetch_replies(channel_id, ts), threads):
+                messages.extend(replies)
+            messages = [dict(m, channel=channel_id, team=m.get('team') or self.team_id) for m in messages]
+            messages = [m for m in messages if should_store(m, self.bot_user_id)]
+            nodes, oldest, newest = self.windows_for(messages)
+            self.vectors += len(nodes)
+            if newer is not None and newest is not None:
+                # a window's text doesn't change when it gains a link, so storing it again is cheap
+                newest.relationships[NodeRelationship.NEXT] = RelatedNodeInfo(node_id=newer.node_id)
+                newer.relationships[NodeRelationship.PREVIOUS] = RelatedNodeInfo(node_id=newest.node_id)
+                nodes.append(newer)
+            newer = oldest or newer
+            self.store(nodes)
+            count += len(messages)
+            self.stored += len(messages)
+            cursor = page.get('response_metadata', {}).get('next_cursor') or None
+            # only move the checkpoint once the page is safely stored
+            self.checkpoint.save(channel_id, cursor, cursor is None, count)
+            print(f"{channel_id}: {count} messages stored ({self.rate():.1f} messages/s)")
+            if cursor is None:
+                return
+
+    # the nodes to store for a page of messages, and the page's oldest and newest channel windows
+    # history comes newest first, and windows have to be built oldest first, so every page gets
+    # windows of its own; backfill_channel links them to the pages either side. Threads are
+    # fetched whole, so they're never split between pages
+    def windows_for(self, messages):
+        windows = ConversationWindows(size=self.window_size, overlap=self.window_overlap,
+                                      max_gap_seconds=self.window_gap, max_conversations=len(messages) + 1)
+        nodes, channel_windows = {}, []
+        for message in sorted(messages, key=lambda m: float(m['ts'])):
+            # messages from bots and integrations have no user, just the name they posted as
+            for node in windows.add(message, self.users.author(message)[0]):
+                nodes[node.node_id] = node
+            if conversation_for(message)[1] is None:
+                channel_windows.append(node.node_id)
+        if not channel_windows:
+            return list(nodes.values()), None, None
+        return list(nodes.values()), nodes[channel_windows[0]], nodes[channel_windows[-1]]
+
+    # the replies in a thread, not including the parent message
+    def fetch_replies(self, channel_id, thread_ts):
+        replies = []
+        cursor = None
+        while True:
+            page = self.client.conversations_replies(channel=channel_id, ts=thread_ts, cursor=cursor, limit=self.page_size)
+            replies.extend(m for m in page['messages'] if m['ts'] != thread_ts)
+            cursor = page.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return replies
+
+    # embed nodes batch_size at a time and upsert each batch in one write
+    def store(self, nodes):
+        for start in range(0, len(nodes), self.batch_size):
+            batch = nodes[start:start + self.batch_size]
+            embeddings = self.embed_model.get_text_embedding_batch(
+                [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+            )
+            for node, embedding in zip(batch, embeddings):
+                node.embedding = embedding
+            self.vector_store.add(batch)
+            if self.keyword_index is not None:
+                self.keyword_index.add(batch)
+
+    # delete messages stored before we kept the channel, once every channel is stored again
+    # they had random ids, so the new copies didn't replace them, and they'd show up
+    # twice in searches. Only this workspace's, or ones that don't say
+    def forget_legacy(self):
+        client, collection = self.vector_store.client, self.vector_store.collection_name
+        must = [models.IsEmptyCondition(is_empty=models.PayloadField(key="channel_id"))]
+        if self.team_id is not None:
+            must.append(models.Filter(should=[
+                models.FieldCondition(key="team_id", match=models.MatchValue(value=self.team_id)),
+                models.IsEmptyCondition(is_empty=models.PayloadField(key="team_id")),
+            ]))
+        legacy = models.Filter(must=must)
+        ids, offset = [], None
+        while True:
+            points, offset = client.scroll(collection, scroll_filter=legacy, limit=1000, offset=offset,
+                                           with_payload=False, with_vectors=False)
+            ids.extend(point.id for point in points)
+            if offset is None:
+                break
+        for start in range(0, len(ids), self.batch_size):
+            batch = ids[start:start + self.batch_size]
+            client.delete(collection, points_selector=models.PointIdsList(points=batch))
+            if self.keyword_index is not None:
+                self.keyword_index.delete([str(point_id) for point_id in batch])
+        print(f"Deleted {len(ids)} messages stored before we kept their channel")
+        return len(ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channel", action="append", default=[], help="channel name, can be repeated")
+    parser.add_argument("--all-channels", action="store_true")
+    parser.add_argument("--checkpoint", help="defaults to backfill_checkpoint.json, or a temporary file with --fake")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--qdrant-path", help="the embedded store to use in place of QDRANT_PATH; ignored with QDRANT_URL")
+    parser.add_argument("--slack-url", default=os.environ.get("SLACK_API_URL"), help="base URL of the Slack Web API")
+    parser.add_argument("--window-size", type=int, default=int(os.environ.get("INGEST_WINDOW_SIZE", 1)),
+                        help="messages per conversation window, like the bot's INGEST_WINDOW_SIZE")
+    parser.add_argument("--window-overlap", type=int, default=os.environ.get("INGEST_WINDOW_OVERLAP"))
+    parser.add_argument("--window-gap", type=float, default=float(os.environ.get("INGEST_WINDOW_GAP", 900)))
+    parser.add_argument("--reindex", action="store_true", help="ignore the checkpoint and store every message again")
+    parser.add_argument("--fake", action="store_true", help="run offline against fake_slack.py and fake models")
+    args = parser.parse_args()
+
+    if args.fake:
+        from fake_slack import FakeSlack, synthetic_workspace
+        from fakes import FakeEmbedding, FakeLLM
+        fake_slack = FakeSlack(synthetic_workspace(channels=3, messages_per_channel=1000)).start()
+        # the fake isn't rate limited, so don't pace as if it were Slack
+        client = PacedWebClient(token="xoxb-fake", base_url=fake_slack.base_url, limit_scale=1000)
+        service_context = ServiceContext.from_defaults(llm=FakeLLM(), embed_model=FakeEmbedding())
+        vector_size = service_context.embed_model.dim
+        qdrant = LockedClient(qdrant_client.QdrantClient(":memory:"))
+        keyword_index = KeywordIndex(":memory:")
+        if not args.channel:
+            args.all_channels = True
+        # the fake index is in memory, so a saved checkpoint from an earlier run would be wrong
+        args.checkpoint = args.checkpoint or os.path.join(tempfile.mkdtemp(), "backfill_checkpoint.json")
+    else:
+        client = PacedWebClient(token=os.environ.get("SLACK_BOT_TOKEN"), base_url=args.slack_url or PacedWebClient.BASE_URL)
+        # history we've stored before is already in the embedding cache
+        service_context = cached_service_context()
+        vector_size = int(os.environ.get("EMBEDDING_DIM", 1536))
+        # the same Qdrant the bot uses: the server at QDRANT_URL, or the embedded store
+        qdrant = make_client(args.qdrant_path)
+        # the same KEYWORD_INDEX_DB as the bot, or None if that's turned off
+        keyword_index = keyword_index_from_env()
+    args.checkpoint = args.checkpoint or "backfill_checkpoint.json"
+
+    ensure_collection(qdrant, "slack_messages", vector_size)
+    vector_store = QdrantVectorStore(client=qdrant, collection_name="slack_messages")
+    users = UserDirectory(client)
+    users.warm()
+    auth = client.auth_test()
+    backfill = Backfill(
+        client,
+        vector_store,
+        service_context.embed_model,
+        users,
+        auth["user_id"],
+        Checkpoint(args.checkpoint, fresh=args.reindex),
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        page_size=args.page_size,
+        team_id=auth["team_id"],
+        keyword_index=keyword_index,
+        window_size=args.window_size,
+        window_overlap=min(2, args.window_size - 1) if args.window_overlap is None else int(args.window_overlap),
+        window_gap=args.window_gap,
+    )
+    backfill.run(find_channels(client, args.channel, args.all_channels))
+    if args.reindex:
+        if args.all_channels:
+            backfill.forget_legacy()
+        else:
+            # the old copies could be from a channel we haven't stored again yet
+            print("Kept the messages stored before we kept their channel; --reindex --all-channels deletes them")
+    embeddings = embedding_cache_stats(service_context)
+    if embeddings:
+        print(f"Embedding cache saved {embeddings['calls_saved']} of {embeddings['lookups']} embeddings")
@@ -0,0 +1,87 @@
+# benchmark: search latency with and without channel scoping, as the collection grows
+# the messages are spread over --channels channels, a few of them busy and most
+# of them quiet (like a real workspace), and each query searches:
+#   all: every channel, the way the bot used to
+#   channel: just the channel it was asked in, with a filter on channel_id
+#   allowed: that channel and --allowed others
+# The filters are the ones SlackRetriever builds for a ScopedQuery. With a Qdrant
+# server, the payload index on channel_id lets a filtered search look only at that
+# channel's messages, so it stays fast however big everything else gets:
+#
+#   docker run -p 6333:6333 qdrant/qdrant
+#   python bench_channel_filter.py --url http://localhost:6333 --sizes 10000,100000,1000000 --channels 5000
+#
+# Without --url it runs on the embedded store, which has no payload indexes and
+# checks the filter against every point, so expect scoped searches to be no faster there
+import argparse, time
+import numpy as np
+import qdrant_client
+from qdrant_client.http import models
+
+from storage import ensure_collection
+from retrieval import ScopedQuery, SlackRetriever
+
+
+def load(client, name, size, dim, channels, rng):
+    client.delete_collection(name)
+    ensure_collection(client, name, dim)
+    # a few busy channels and a long tail of quiet ones
+    weights = 1 / np.arange(1, channels + 1)
+    channel_of = rng.choice(channels, size=size, p=weights / weights.sum())
+    for start in range(0, size, 1000):
+        vectors = rng.normal(size=(min(1000, size - start), dim)).astype(np.float32)
+        client.upsert(name, points=models.Batch(
+            ids=list(range(start, start + len(vectors))),
+            vectors=vectors.tolist(),
+            payloads=[{"channel_id": f"C{channel_of[start + i]:06d}", "team_id": "T0BENCH", "when_ts": float(start + i)}
+                      for i in range(len(vectors))],
+        ))
+    return channel_of
+
+
+def timed_searches(client, name, retriever, queries, scopes, top_k):
+    timings = []
+    for vector, scope in zip(queries, scopes):
+        query_filter = retriever._query_filter(scope, time.time())
+        started = time.perf_counter()
+        client.search(name, query_vector=vector.tolist(), query_filter=query_filter, limit=top_k)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2], timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="a Qdrant server; the embedded store is used without one")
+    parser.add_argument("--sizes", default="10000,50000", help="collection sizes to try, comma separated")
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--allowed", type=int, default=10, help="extra channels in the allowed scope")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=40)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    client = qdrant_client.QdrantClient(url=args.url, timeout=300) if args.url else qdrant_client.QdrantClient(":memory:")
+    name = "bench_channel_filter"
+    retriever = SlackRetriever(client, name, embed_model=None)
+    print(f"{args.channels} channels, {args.queries} queries, top {args.top_k}, "
+          f"{'Qdrant at ' + args.url if args.url else 'embedded Qdrant'}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        channel_of = load(client, name, size, args.dim, args.channels, rng)
+        queries = rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+        # questions come from channels in proportion to how busy they are
+        asked_in = [f"C{channel:06d}" for channel in rng.choice(channel_of, size=args.queries)]
+        everything = [ScopedQuery("", team_id="T0BENCH") for _ in asked_in]
+        own = [ScopedQuery("", channel_ids=[channel]) for channel in asked_in]
+        allowed = [ScopedQuery("", channel_ids=[channel] + [f"C{c:06d}" for c in rng.choice(args.channels, size=args.allowed)])
+                   for channel in asked_in]
+        if args.url:
+            # let the server finish indexing before we time anything
+            while client.get_collection(name).status != models.CollectionStatus.GREEN:
+                time.sleep(1)
+        timed_searches(client, name, retriever, queries[:5], own[:5], args.top_k)
+        for scope_name, scopes in (("all", everything), ("channel", own), ("allowed", allowed)):
+            p50, p99 = timed_searches(client, name, retriever, queries, scopes, args.top_k)
+            print(f"{size:>9} messages   {scope_name:<8} p50 {p50 * 1000:8.2f} ms   p99 {p99 * 1000:8.2f} ms")
+    client.delete_collection(name)
@@ -0,0 +1,172 @@
+# benchmark: how many questions at once the Flask bot and the asyncio bot can answer
+# both bots run for real, against fake_slack instead of Slack, with fake models
+# instead of OpenAI. First each bot is sent --seed messages from the channel's
+# history and stores them, so there's something to search (with nothing stored,
+# llama_index answers "Empty Response" without asking the LLM at all). Then we fire
+# a burst of signed @-mention events at it and time how long it takes for every
+# answer to be posted back to the fake Slack, checking the LLM was asked once per question.
+# The fake LLM waits --llm-latency seconds per answer, like a slow API call would
+#
+#   pip install aiohttp httpx
+#   python bench_concurrency.py --questions 64 --llm-latency 1.0
+import argparse, asyncio, importlib.util, os, sys, tempfile, threading, time
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-not-a-real-key")
+
+import httpx
+from llama_index import ServiceContext, set_global_service_context
+
+from fake_slack import FakeSlack, synthetic_workspace, message_event, signed_request
+from fakes import FakeEmbedding, FakeLLM
+
+SIGNING_SECRET = "benchmark-signing-secret"
+QUESTIONS = ["when is the launch?", "who is fixing the outage?", "what did we decide about the budget?",
+             "is the demo on friday?", "which database are we migrating to?"]
+
+
+# load one of the bot scripts as a module, with its own Qdrant store
+def load_bot(path, name, fake, questions):
+    os.environ.update({
+        "SLACK_BOT_TOKEN": "xoxb-fake",
+        "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+        "SLACK_API_URL": fake.base_url,
+        # the fake isn't rate limited, so the bots shouldn't pace themselves as if it were Slack
+        "SLACK_RATE_LIMIT_SCALE": "1000",
+        # ask the fake who the bot is every time, rather than saving it next to the real one
+        "BOOTSTRAP_CACHE": "",
+        "EMBEDDING_DIM": "256",
+        "QDRANT_PATH": tempfile.mkdtemp(prefix=f"{name}-qdrant-"),
+        # room for the whole burst, so we measure throughput rather than busy replies
+        "ANSWER_QUEUE_SIZE": str(questions),
+        # the questions repeat, and every one of them should reach the LLM
+        "ANSWER_CACHE_MB": "0",
+        # nothing left behind on disk, and nothing shared between the two bots
+        "KEYWORD_INDEX_DB": "",
+        "EMBEDDING_CACHE_DB": "",
+    })
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# the channel's history as new messages, oldest first
+def seed_messages(fake, count):
+    channel = fake.workspace["channels"][0]["id"]
+    history = list(reversed(fake.workspace["history"][channel]))[:count]
+    now = time.time() - len(history)
+    events = [message_event(channel, message.get("text") or "", user=message.get("user"), ts=f"{now + i:.6f}")
+              for i, message in enumerate(history)]
+    return [signed_request(event, SIGNING_SECRET) for event in events]
+
+
+def burst(fake, questions, bot_user_id):
+    channel = fake.workspace["channels"][0]["id"]
+    now = time.time()
+    events = []
+    for i in range(questions):
+        ts = f"{now + i / 1000:.6f}"
+        events.append(message_event(channel, QUESTIONS[i % len(QUESTIONS)], user=f"U{i % 20:05d}", ts=ts, mention=bot_user_id))
+    return [signed_request(event, SIGNING_SECRET) for event in events]
+
+
+# wait until `expected` more messages have been posted, and return when each one arrived
+def collect_posts(fake, expected):
+    arrived = []
+    done = threading.Event()
+
+    def on_post(channel, message):
+        arrived.append(time.perf_counter())
+        if len(arrived) >= expected:
+            done.set()
+
+    fake.on_post.append(on_post)
+    return arrived, done
+
+
+def run_flask(bot, requests):
+    def send(body, headers):
+        with bot.flask_app.test_client() as client:
+            response = client.post("/", data=body, headers=headers)
+            assert response.status_code == 200, response.status_code
+
+    threads = [threading.Thread(target=send, args=request) for request in requests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+async def run_async(bot, requests):
+    transport = httpx.ASGITransport(app=bot.asgi_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client:
+        responses = await asyncio.gather(*(client.post("/", content=body, headers=headers) for body, headers in requests))
+    for response in responses:
+        assert response.status_code == 200, response.status_code
+
+
+def measure(name, fake, bot, questions, seed, timeout, send, llm):
+    # store the seed messages first, so the questions have something to find
+    seeded = bot.ingest_buffer.stats()["nodes"]
+    messages = seed_messages(fake, seed)
+    send(bot, messages)
+    deadline = time.monotonic() + timeout
+    while bot.ingest_buffer.stats()["nodes"] < seeded + len(messages) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    calls = llm.calls
+    requests = burst(fake, questions, fake.workspace["bot_user_id"])
+    arrived, done = collect_posts(fake, questions)
+    started = time.perf_counter()
+    send(bot, requests)
+    finished = done.wait(timeout)
+    fake.on_post.clear()
+    latencies = sorted(t - started for t in arrived)
+    dropped = bot.dispatcher.stats()["dropped"]
+    if not latencies:
+        print(f"{name:<8} no answers within {timeout:.0f}s")
+        return
+    wall = latencies[-1]
+    print(f"{name:<8} {len(latencies)}/{questions} answered{'' if finished else ' (timed out)'} in {wall:6.2f} s   "
+          f"{len(latencies) / wall:7.2f} answers/s   "
+          f"p50 {latencies[len(latencies) // 2]:6.2f} s   "
+          f"p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]:6.2f} s   "
+          f"busy replies {dropped}")
+    # if the LLM wasn't asked, the answers didn't wait for it and the timings mean nothing
+    assert llm.calls - calls == questions, f"{name}: the LLM was called {llm.calls - calls} times for {questions} questions"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", type=int, default=64)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=50, help="messages to store before the questions")
+    parser.add_argument("--slack-latency", type=float, default=0.02, help="seconds the fake Slack takes per API call")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    # every ServiceContext.from_defaults() in the bots picks these up
+    llm = FakeLLM(latency=args.llm_latency)
+    set_global_service_context(ServiceContext.from_defaults(llm=llm, embed_model=FakeEmbedding()))
+
+    with FakeSlack(synthetic_workspace(channels=1, messages_per_channel=50), latency=args.slack_latency) as fake:
+        print(f"{args.questions} questions at once, LLM latency {args.llm_latency:.2f} s, Slack latency {args.slack_latency * 1000:.0f} ms")
+        flask_bot = load_bot("8_rest_of_the_owl.py", "owl_flask", fake, args.questions)
+        measure("flask", fake, flask_bot, args.questions, args.seed, args.timeout, run_flask, llm)
+        async_bot = load_bot("8_rest_of_the_owl_async.py", "owl_async", fake, args.questions)
+
+        # measure() blocks while it waits for answers, so it runs on a thread and
+        # hands the burst to the event loop, which keeps answering in the meantime
+        async def main():
+            await async_bot.startup()
+            await asyncio.to_thread(
+                measure, "asyncio", fake, async_bot, args.questions, args.seed, args.timeout,
+                lambda bot, requests: asyncio.run_coroutine_threadsafe(run_async(bot, requests), loop).result(), llm
+            )
+            # answers still have a little to do after they're posted; let them finish before the loop goes away
+            await asyncio.gather(*async_bot.dispatcher.tasks)
+            if async_bot.app.client.session is not None:
+                await async_bot.app.client.session.close()
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(main())
@@ -0,0 +1,104 @@
+# benchmark: vector-only retrieval against vector + keyword (hybrid) retrieval
+# the synthetic channel talks about lots of tickets, hosts, people and functions.
+# Each question names one of them ("any news on JIRA-1234?"), and the message that
+# answers it mentions that id but is otherwise worded differently, while plenty of
+# other messages are worded just like the question but are about some other id.
+# That's where embeddings struggle: the id is one token among many, so the
+# look-alikes win. We report how often the answer is in the top k, and how long
+# a retrieval takes
+# runs offline against an in-memory Qdrant with the fake embedding model
+#
+#   python bench_hybrid.py --questions 100 --messages 5000
+import argparse, random, statistics, time
+import qdrant_client
+from llama_index.schema import MetadataMode
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+
+from fakes import FakeEmbedding
+from keyword_index import KeywordIndex
+from storage import ensure_collection
+from retrieval import SlackRetriever
+from slack_nodes import message_to_node
+
+PEOPLE = ["logan", "laurie", "jerry", "simon", "ravi"]
+# how each kind of id is written, how people ask about it, and how the answer is worded
+KINDS = [
+    (lambda n: f"JIRA-{n}", "any news on the status of {} is it still blocked", "{} got merged this morning, closing it out"),
+    (lambda n: f"db-{n}.prod.internal", "who owns {} and is it still blocked", "{} belongs to the storage team now"),
+    (lambda n: f"@user_{n}", "has anyone heard from {} about the status", "{} is out until next week, ping their lead"),
+    (lambda n: f"parse_ts_{n}()", "why does {} keep failing, is it still blocked", "{} chokes on timezones, fix is in review"),
+]
+FILLER = ("ok sounds good thanks let me check later today after lunch we should probably "
+          "look at that again tomorrow maybe").split()
+
+
+def build_channel(questions, messages, start):
+    texts, probes = [], []
+    ids = random.sample(range(1000, 10000), questions + messages)
+    for q in range(questions):
+        make_id, question, answer = random.choice(KINDS)
+        target = make_id(ids[q])
+        texts.append(answer.format(target))
+        probes.append((question.format(target), target))
+    for i in range(messages):
+        make_id, question, _ = random.choice(KINDS)
+        if random.random() < 0.5:
+            # looks just like a question, about some other id
+            texts.append(question.format(make_id(ids[questions + i])))
+        else:
+            texts.append(" ".join(random.sample(FILLER, 8)))
+    random.shuffle(texts)
+    nodes = [
+        message_to_node({"channel": "C1", "ts": f"{start + i * 30:.6f}", "text": text}, random.choice(PEOPLE))
+        for i, text in enumerate(texts)
+    ]
+    return nodes, probes
+
+
+def run(retriever, probes, top_k):
+    found, timings = 0, []
+    for question, target in probes:
+        started = time.perf_counter()
+        results = retriever.retrieve(question)
+        timings.append(time.perf_counter() - started)
+        found += any(target in result.node.get_content() for result in results[:top_k])
+    timings.sort()
+    return found / len(probes), timings[len(timings) // 2], timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--keyword-top-k", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(0)
+    embed_model = FakeEmbedding()
+    client = qdrant_client.QdrantClient(":memory:")
+    nodes, probes = build_channel(args.questions, args.messages, 1_700_000_000)
+    embeddings = embed_model.get_text_embedding_batch([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+    ensure_collection(client, "bench_hybrid", embed_model.dim)
+    QdrantVectorStore(client=client, collection_name="bench_hybrid").add(nodes)
+
+    keyword_index = KeywordIndex()
+    started = time.perf_counter()
+    for i in range(0, len(nodes), 32):
+        # in batches, like IngestBuffer hands them to its listeners
+        keyword_index.add(nodes[i:i + 32])
+    print(f"{len(nodes)} messages, {args.questions} questions, top {args.top_k}; "
+          f"keyword index built in {time.perf_counter() - started:.2f}s")
+
+    setups = [
+        ("vector only", None),
+        ("hybrid (RRF)", keyword_index),
+    ]
+    for name, index in setups:
+        retriever = SlackRetriever(client, "bench_hybrid", embed_model, similarity_top_k=args.top_k,
+                                   keyword_index=index, keyword_top_k=args.keyword_top_k)
+        # the results come back newest first, so recall is over the whole top k
+        recall, p50, p99 = run(retriever, probes, args.top_k)
+        print(f"{name:<16} answer found {recall:6.1%}   p50 {p50 * 1000:7.2f} ms   p99 {p99 * 1000:7.2f} ms")
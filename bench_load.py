@@ -0,0 +1,195 @@
+# benchmark: replay a stream of Slack events at the Flask bot and see how it keeps up
+# the bot runs for real, against fake_slack instead of Slack and with fake models
+# instead of OpenAI, so no tokens are needed. The events are the channel history
+# of a synthetic workspace (or one saved with fake_slack.record_workspace), oldest
+# first, with an @-mention question every --question-every messages. Each event is
+# signed and posted to the bot's Flask route by --senders threads at --rate events
+# a second (0 sends them as fast as the bot acks them). We report:
+#   events/s: how fast the bot acked events
+#   ack latency: how long Slack would wait for each ack (it gives up after 3 s)
+#   answer latency: from sending a question to its answer being posted
+#   ingestion lag: from sending a message to it being stored and searchable
+# If any question fails or isn't answered, we print the first error and exit with status 1
+#
+#   python bench_load.py --events 2000 --senders 8 --llm-latency 0.5
+import argparse, importlib.util, os, random, sys, tempfile, threading, time, traceback
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-not-a-real-key")
+
+from llama_index import ServiceContext, set_global_service_context
+
+from fake_slack import FakeSlack, WORDS, synthetic_workspace, message_event, signed_request
+from fakes import FakeEmbedding, FakeLLM
+from slack_nodes import node_id_for
+
+SIGNING_SECRET = "benchmark-signing-secret"
+
+
+def load_bot(fake, workdir, questions, slack_rate_scale):
+    os.environ.update({
+        "SLACK_BOT_TOKEN": "xoxb-fake",
+        "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+        "SLACK_API_URL": fake.base_url,
+        "SLACK_RATE_LIMIT_SCALE": str(slack_rate_scale),
+        # ask the fake who the bot is every time, rather than saving it next to the real one
+        "BOOTSTRAP_CACHE": "",
+        "EMBEDDING_DIM": "256",
+        "QDRANT_PATH": os.path.join(workdir, "qdrant"),
+        "EMBEDDING_CACHE_DB": os.path.join(workdir, "embedding_cache.db"),
+        "KEYWORD_INDEX_DB": os.path.join(workdir, "keyword_index.db"),
+        "ANSWER_QUEUE_SIZE": str(max(16, questions)),
+        "EVENT_LOG_SAMPLE": "0",
+    })
+    spec = importlib.util.spec_from_file_location("owl_flask", "8_rest_of_the_owl.py")
+    bot = importlib.util.module_from_spec(spec)
+    sys.modules["owl_flask"] = bot
+    spec.loader.exec_module(bot)
+    return bot
+
+
+# (kind, event) pairs: the channel's history as new messages, with questions mixed in
+def event_stream(fake, events, question_every, rng):
+    channel = fake.workspace["channels"][0]["id"]
+    history = list(reversed(fake.workspace["history"][channel]))
+    start = time.time()
+    stream = []
+    for i in range(events):
+        # fresh timestamps, so every message is new to the bot
+        ts = f"{start + i / 1000:.6f}"
+        if question_every and i % question_every == question_every - 1:
+            question = " ".join(rng.choices(WORDS, k=6)) + "?"
+            stream.append(("question", message_event(channel, question, ts=ts, mention=fake.workspace["bot_user_id"])))
+        else:
+            message = history[i % len(history)]
+            stream.append(("message", message_event(channel, message.get("text") or "", user=message.get("user"), ts=ts)))
+    return stream
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+def summary(name, seconds):
+    return f"{name:<16} p50 {percentile(seconds, 0.5) * 1000:9.1f} ms   p99 {percentile(seconds, 0.99) * 1000:9.1f} ms   ({len(seconds)})"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--question-every", type=int, default=20, help="one in this many events is a question")
+    parser.add_argument("--senders", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0, help="events a second across all senders, 0 for as fast as possible")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--slack-latency", type=float, default=0.02, help="seconds the fake Slack takes per API call")
+    parser.add_argument("--slack-rate-scale", type=float, default=1000,
+                        help="how many times Slack's rate limits the bot paces itself to; 1 to pace as it would against Slack")
+    parser.add_argument("--workspace", help="a JSON file saved by fake_slack.record_workspace")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    # every ServiceContext.from_defaults() in the bot picks these up
+    set_global_service_context(ServiceContext.from_defaults(llm=FakeLLM(latency=args.llm_latency), embed_model=FakeEmbedding()))
+    if args.workspace:
+        fake = FakeSlack.from_file(args.workspace, latency=args.slack_latency)
+    else:
+        fake = FakeSlack(synthetic_workspace(channels=1, messages_per_channel=500), latency=args.slack_latency)
+
+    with fake, tempfile.TemporaryDirectory(prefix="bench-load-") as workdir:
+        stream = event_stream(fake, args.events, args.question_every, rng)
+        questions = sum(kind == "question" for kind, _ in stream)
+        bot = load_bot(fake, workdir, questions, args.slack_rate_scale)
+
+        lock = threading.Lock()
+        # ts of each event -> when we sent it, and when its answer was posted or it was stored
+        sent, answered, stored = {}, {}, {}
+        acks = []
+        # the traceback of each question that failed
+        errors = []
+
+        # the bot looks these up by name for each question, so wrapping them here times every answer
+        def timed(answer):
+            def run(query, message):
+                try:
+                    answer(query, message)
+                except Exception:
+                    with lock:
+                        errors.append(traceback.format_exc())
+                    raise
+                with lock:
+                    answered[message["ts"]] = time.perf_counter()
+            return run
+        bot.answer_in_channel = timed(bot.answer_in_channel)
+        bot.answer_in_thread = timed(bot.answer_in_thread)
+
+        node_ts = {node_id_for(event["event"]["channel"], event["event"]["ts"]): event["event"]["ts"] for _, event in stream}
+
+        def on_stored(batch):
+            now = time.perf_counter()
+            with lock:
+                for node in batch:
+                    if node.node_id in node_ts:
+                        stored[node_ts[node.node_id]] = now
+        bot.ingest_buffer.listeners.append(on_stored)
+
+        requests = [(event["event"]["ts"], signed_request(event, SIGNING_SECRET)) for _, event in stream]
+        next_request = iter(requests)
+        started = time.perf_counter()
+
+        def send():
+            with bot.flask_app.test_client() as client:
+                while True:
+                    with lock:
+                        item = next(next_request, None)
+                        index = len(sent)
+                    if item is None:
+                        return
+                    ts, (body, headers) = item
+                    if args.rate:
+                        # hold each event until it's due, so the rate is the same however many senders there are
+                        delay = started + index / args.rate - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    before = time.perf_counter()
+                    with lock:
+                        sent[ts] = before
+                    response = client.post("/", data=body, headers=headers)
+                    assert response.status_code == 200, response.status_code
+                    with lock:
+                        acks.append(time.perf_counter() - before)
+
+        senders = [threading.Thread(target=send) for _ in range(args.senders)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        send_seconds = time.perf_counter() - started
+
+        # wait for the answers and the last batch of messages
+        messages = len(stream) - questions
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            with lock:
+                finished = len(answered) + bot.dispatcher.stats()["dropped"] + len(errors)
+                if finished >= questions and len(stored) >= messages:
+                    break
+            time.sleep(0.05)
+
+        kinds = {event["event"]["ts"]: kind for kind, event in stream}
+        answer_latency = [answered[ts] - sent[ts] for ts in answered]
+        ingest_lag = [stored[ts] - sent[ts] for ts in stored if kinds[ts] == "message"]
+        print(f"{len(stream)} events ({questions} questions) from {args.senders} senders, "
+              f"LLM latency {args.llm_latency:.2f} s, Slack latency {args.slack_latency * 1000:.0f} ms")
+        dispatch = bot.dispatcher.stats()
+        print(f"{len(acks) / send_seconds:.1f} events/s acked   "
+              f"{len(answered)}/{questions} answered   failed {dispatch['failed']}   busy replies {dispatch['dropped']}   "
+              f"{len(ingest_lag)}/{messages} messages stored")
+        print(summary("ack latency", acks))
+        print(summary("answer latency", answer_latency))
+        print(summary("ingestion lag", ingest_lag))
+        bot.ingest_buffer.close()
+        if errors:
+            print(f"First of {len(errors)} failed questions:\n{errors[0]}")
+        if len(answered) < questions:
+            sys.exit(f"{questions - len(answered)} of {questions} questions weren't answered")
@@ -0,0 +1,119 @@
+# benchmark: memory, recall@20 and search latency for different ways of storing vectors
+# quantization and on-disk vectors only exist in the Qdrant server (the embedded
+# store always searches every vector exactly), so this needs one running:
+#
+#   docker run -p 6333:6333 qdrant/qdrant
+#   python bench_quantization.py --url http://localhost:6333 --messages 100000
+#
+# The corpus is synthetic: message embeddings are clustered by topic, like real
+# ones, and the queries are drawn from the same topics. Recall@20 compares each
+# setting's top 20 against an exact search. Memory is an estimate of what each
+# setting keeps in RAM (full vectors, quantized vectors and the HNSW graph), since
+# Qdrant doesn't report memory per collection
+import argparse, statistics, time
+import numpy as np
+import qdrant_client
+from qdrant_client.http import models
+
+from storage import CollectionConfig, ensure_collection
+
+SETTINGS = [
+    CollectionConfig(),
+    CollectionConfig(quantization="scalar"),
+    CollectionConfig(quantization="scalar", on_disk=True),
+    CollectionConfig(quantization="product", product_compression="x16", on_disk=True),
+    CollectionConfig(quantization="binary", on_disk=True, oversampling=4.0),
+    CollectionConfig(quantization="scalar", on_disk=True, hnsw_m=32, hnsw_ef_construct=200, hnsw_ef=128),
+]
+
+
+def corpus(messages, dim, topics, rng):
+    centers = rng.normal(size=(topics, dim))
+    labels = rng.integers(topics, size=messages)
+    vectors = centers[labels] + rng.normal(scale=1.5, size=(messages, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32), centers
+
+
+def queries(centers, count, rng):
+    picked = centers[rng.integers(len(centers), size=count)]
+    vectors = picked + rng.normal(scale=1.5, size=picked.shape)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+# bytes each setting keeps in RAM, roughly
+def estimated_ram(config, messages, dim):
+    full = 0 if config.on_disk else messages * dim * 4
+    if config.quantization == "scalar":
+        quantized = messages * dim
+    elif config.quantization == "product":
+        quantized = messages * dim * 4 // int(config.product_compression[1:])
+    elif config.quantization == "binary":
+        quantized = messages * dim // 8
+    else:
+        quantized = 0
+    # each point links to about 2m others on the bottom layer of the graph
+    graph = messages * (config.hnsw_m or 16) * 2 * 4
+    return full + quantized + graph
+
+
+def load(client, name, vectors, config):
+    # left over from a run that was interrupted
+    client.delete_collection(name)
+    ensure_collection(client, name, vectors.shape[1], config)
+    for start in range(0, len(vectors), 1000):
+        batch = vectors[start:start + 1000]
+        client.upsert(name, points=models.Batch(
+            ids=list(range(start, start + len(batch))),
+            vectors=batch.tolist(),
+            payloads=[{"when_ts": float(start + i)} for i in range(len(batch))],
+        ))
+    # wait for Qdrant to finish building the index (and quantizing) before we time anything
+    while True:
+        info = client.get_collection(name)
+        if info.status == models.CollectionStatus.GREEN and (info.indexed_vectors_count or 0) >= len(vectors) * 0.99:
+            return
+        time.sleep(1)
+
+
+def search(client, name, query, limit, params):
+    return [point.id for point in client.search(name, query_vector=query.tolist(), limit=limit, search_params=params)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:6333")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    client = qdrant_client.QdrantClient(url=args.url, timeout=300)
+    vectors, centers = corpus(args.messages, args.dim, args.topics, rng)
+    probes = queries(centers, args.queries, rng)
+
+    print(f"{args.messages} vectors of {args.dim} dimensions, {args.queries} queries, recall@{args.top_k}")
+    truth = None
+    for i, config in enumerate(SETTINGS):
+        name = f"bench_quantization_{i}"
+        load(client, name, vectors, config)
+        if truth is None:
+            exact = models.SearchParams(exact=True)
+            truth = [set(search(client, name, query, args.top_k, exact)) for query in probes]
+        params = config.search_params()
+        search(client, name, probes[0], args.top_k, params)
+        timings, recalls = [], []
+        for query, expected in zip(probes, truth):
+            started = time.perf_counter()
+            found = search(client, name, query, args.top_k, params)
+            timings.append(time.perf_counter() - started)
+            recalls.append(len(expected & set(found)) / args.top_k)
+        timings.sort()
+        print(f"{config.describe():<40} RAM ~{estimated_ram(config, args.messages, args.dim) / 2 ** 20:8.1f} MiB   "
+              f"recall {statistics.mean(recalls):6.1%}   "
+              f"p50 {timings[len(timings) // 2] * 1000:7.2f} ms   "
+              f"p99 {timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000:7.2f} ms")
+        client.delete_collection(name)
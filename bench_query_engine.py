@@ -0,0 +1,106 @@
+# benchmark: per-question overhead of building a query engine every time (the old
+# answer_question) versus borrowing one from a QueryEnginePool built at startup
+# runs offline: the index and the engines use fake models, but the old code path
+# still builds its own default ServiceContext per question, just like the bot did,
+# so that setup cost is part of what we measure
+#
+#   python bench_query_engine.py --queries 50 --messages 500
+import argparse, datetime, os, random, statistics, time
+
+# the default ServiceContext wants a key to build its OpenAI clients; nothing is sent
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-not-a-real-key")
+
+from llama_index import VectorStoreIndex, ServiceContext
+from llama_index.schema import TextNode
+from llama_index.prompts import PromptTemplate
+from llama_index.postprocessor import FixedRecencyPostprocessor
+
+from fakes import FakeEmbedding, FakeLLM
+from query_engines import QueryEnginePool
+
+TEMPLATE = (
+    "---------------------\n"
+    "{context_str}"
+    "\n---------------------\n"
+    "The person who is asking the question is called '{who_is_asking}'.\n"
+    "{replies_stanza}\n"
+    "Given the most relevant chat messages above, please answer this question: {query_str}\n"
+)
+
+WORDS = "launch deploy release review staging prod bug fix meeting friday monday dog cat owl rollout plan budget".split()
+PEOPLE = ["logan", "laurie", "jerry", "simon", "ravi"]
+
+
+def build_index(messages, service_context):
+    now = time.time()
+    nodes = []
+    for i in range(messages):
+        nodes.append(TextNode(
+            text=" ".join(random.choices(WORDS, k=12)),
+            metadata={
+                "who": random.choice(PEOPLE),
+                "when": datetime.datetime.fromtimestamp(now - i * 60).strftime('%Y-%m-%d %H:%M:%S')
+            }
+        ))
+    return VectorStoreIndex(nodes, service_context=service_context)
+
+
+# what answer_question used to do for every question
+def old_way(index, query, who_is_asking):
+    template = TEMPLATE.replace("{who_is_asking}", who_is_asking).replace("{replies_stanza}", "")
+    qa_template = PromptTemplate(template)
+    postprocessor = FixedRecencyPostprocessor(
+        top_k=20,
+        date_key="when",
+        service_context=ServiceContext.from_defaults()
+    )
+    query_engine = index.as_query_engine(similarity_top_k=20, node_postprocessors=[postprocessor])
+    query_engine.update_prompts(
+        {"response_synthesizer:text_qa_template": qa_template}
+    )
+    return query_engine.query(query)
+
+
+def timed(fn, queries):
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        fn(query)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    print(f"{name:<28} mean {statistics.mean(timings) * 1000:8.2f} ms   "
+          f"p50 {timings[len(timings) // 2] * 1000:8.2f} ms   "
+          f"p99 {timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=500)
+    args = parser.parse_args()
+
+    random.seed(0)
+    service_context = ServiceContext.from_defaults(llm=FakeLLM(), embed_model=FakeEmbedding())
+    index = build_index(args.messages, service_context)
+    queries = [" ".join(random.choices(WORDS, k=5)) + "?" for _ in range(args.queries)]
+
+    started = time.perf_counter()
+    pool = QueryEnginePool(index, TEMPLATE, size=4)
+    pool_setup = time.perf_counter() - started
+
+    # warm up both paths once so lazy imports don't count against either
+    old_way(index, queries[0], "logan")
+    pool.query(queries[0], who_is_asking="logan", replies_stanza="")
+
+    before = timed(lambda q: old_way(index, q, "logan"), queries)
+    after = timed(lambda q: pool.query(q, who_is_asking="logan", replies_stanza=""), queries)
+
+    print(f"{args.queries} queries over {args.messages} messages, fake LLM and embeddings")
+    print(f"one-off pool setup: {pool_setup * 1000:.2f} ms for 4 engines")
+    report("before (engine per query)", before)
+    report("after (pooled engines)", after)
+    print(f"per-query overhead saved: {(statistics.mean(before) - statistics.mean(after)) * 1000:.2f} ms")
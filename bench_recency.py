@@ -0,0 +1,99 @@
+# benchmark: ranking quality and latency of the old recency handling (top 20 by
+# similarity, then FixedRecencyPostprocessor) against SlackRetriever's modes
+# the synthetic corpus has, for each topic, lots of old messages that match the
+# question closely and one recent message (the current truth) that matches it
+# less well. "recall" is how often that recent message makes it into the context
+# runs offline against an in-memory Qdrant with the fake embedding model
+#
+#   python bench_recency.py --topics 20 --noise 2000
+import argparse, random, statistics, time
+import qdrant_client
+from llama_index import VectorStoreIndex, ServiceContext
+from llama_index.schema import QueryBundle, MetadataMode
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from llama_index.postprocessor import FixedRecencyPostprocessor
+
+from fakes import FakeEmbedding, FakeLLM
+from slack_nodes import message_to_node
+from storage import ensure_collection
+from retrieval import SlackRetriever
+
+DAY = 86400
+FILLER = ("ok so anyway i think we should probably look at that later today maybe "
+          "after lunch sounds good thanks let me check and get back to you").split()
+
+
+def build_corpus(topics, old_per_topic, noise, now):
+    messages = []
+    probes = []
+    for t in range(topics):
+        words = [f"topic{t}word{i}" for i in range(6)]
+        for _ in range(old_per_topic):
+            text = " ".join(words[:4] + random.sample(FILLER, 2))
+            messages.append((text, now - random.uniform(15, 90) * DAY))
+        fresh = " ".join(words[:2] + ["update"] + random.sample(FILLER, 6))
+        fresh_ts = now - random.uniform(0, 2) * DAY
+        messages.append((fresh, fresh_ts))
+        probes.append((" ".join(words[:4]) + "?", f"{fresh_ts:.6f}"))
+    for _ in range(noise):
+        messages.append((" ".join(random.sample(FILLER, 8)), now - random.uniform(0, 90) * DAY))
+    return messages, probes
+
+
+def load(client, collection_name, embed_model, messages):
+    ensure_collection(client, collection_name, embed_model.dim)
+    vector_store = QdrantVectorStore(client=client, collection_name=collection_name)
+    nodes = [message_to_node({"channel": "C1", "ts": f"{ts:.6f}", "text": text}, "someone") for text, ts in messages]
+    embeddings = embed_model.get_text_embedding_batch([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+    vector_store.add(nodes)
+    return vector_store
+
+
+def run(name, retrieve, probes):
+    timings = []
+    hits = 0
+    for query, fresh_ts in probes:
+        started = time.perf_counter()
+        results = retrieve(query)
+        timings.append(time.perf_counter() - started)
+        if any(f"{result.node.metadata['when_ts']:.6f}" == fresh_ts for result in results):
+            hits += 1
+    timings.sort()
+    print(f"{name:<34} recall {hits / len(probes):6.1%}   "
+          f"mean {statistics.mean(timings) * 1000:7.2f} ms   "
+          f"p99 {timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000:7.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--topics", type=int, default=20)
+    parser.add_argument("--old-per-topic", type=int, default=60)
+    parser.add_argument("--noise", type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    now = time.time()
+    embed_model = FakeEmbedding()
+    service_context = ServiceContext.from_defaults(llm=FakeLLM(), embed_model=embed_model)
+    client = qdrant_client.QdrantClient(":memory:")
+    messages, probes = build_corpus(args.topics, args.old_per_topic, args.noise, now)
+    vector_store = load(client, "bench", embed_model, messages)
+    index = VectorStoreIndex.from_vector_store(vector_store, service_context=service_context)
+    print(f"{len(messages)} messages, {len(probes)} questions, in-memory Qdrant, fake embeddings")
+
+    old_retriever = index.as_retriever(similarity_top_k=20)
+    postprocessor = FixedRecencyPostprocessor(top_k=20, date_key="when", service_context=service_context)
+    def old_way(query):
+        query_bundle = QueryBundle(query)
+        return postprocessor.postprocess_nodes(old_retriever.retrieve(query_bundle), query_bundle)
+    run("before: top 20 + recency sort", old_way, probes)
+
+    for mode, kwargs in [
+        ("similarity", {}),
+        ("window", {"window_seconds": 14 * DAY}),
+        ("decay", {"half_life_seconds": 7 * DAY, "recency_weight": 0.3}),
+    ]:
+        retriever = SlackRetriever(client, "bench", embed_model, similarity_top_k=20, mode=mode, **kwargs)
+        run(f"after: SlackRetriever {mode}", retriever.retrieve, probes)
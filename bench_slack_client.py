@@ -0,0 +1,90 @@
+# benchmark: a plain WebClient against slack_client.PacedWebClient, on a rate limited fake Slack
+# fake_slack.py answers 429 when a method goes over its tier's limit, like Slack
+# does. Each of --questions questions, --workers at a time, does what the bot does
+# to answer one: looks up the asker (a handful of people ask most questions),
+# fetches a thread, posts a placeholder and streams the answer into it with
+# chat_update. The plain client does what backfill.py used to, sleeping for
+# Retry-After and trying again; the paced client waits its turn instead, shares
+# lookups, and defers the partial answers. A minute is --speedup times shorter
+# than usual, for the fake and for the paced client alike, so a run takes seconds.
+# We report how long questions took, how many calls reached Slack, how many of
+# them were rate limited, and how many connections were opened
+#
+#   python bench_slack_client.py --questions 200 --workers 16
+import argparse, random, time
+from concurrent.futures import ThreadPoolExecutor
+from slack_sdk import WebClient
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+
+from fake_slack import FakeSlack, WORDS, synthetic_workspace
+from slack_client import METHOD_TIERS, PER_CHANNEL_LIMITS, TIER_LIMITS, PacedWebClient
+from streaming import StreamingMessage
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(name, make_client, args):
+    workspace = synthetic_workspace(channels=args.channels, messages_per_channel=200)
+    limits = dict({method: TIER_LIMITS[tier] for method, tier in METHOD_TIERS.items()}, **PER_CHANNEL_LIMITS)
+    # the fake limits chat.postMessage per method rather than per channel, so allow it for every channel
+    limits["chat.postMessage"] *= args.channels
+    with FakeSlack(workspace, latency=args.slack_latency, rate_limits=limits, rate_window=60 / args.speedup) as fake:
+        client = make_client(fake)
+        askers = [user["id"] for user in workspace["users"][1:6]]
+        threads = [(channel, ts) for channel, replies in workspace["replies"].items() for ts in replies]
+
+        def answer(seed):
+            rng = random.Random(seed)
+            started = time.perf_counter()
+            client.users_info(user=rng.choice(askers))
+            channel, thread_ts = rng.choice(threads)
+            client.conversations_replies(channel=channel, ts=thread_ts)
+            streamed = StreamingMessage(client, channel, thread_ts=thread_ts, interval=args.interval).start()
+
+            def tokens():
+                for word in rng.choices(WORDS, k=args.answer_words):
+                    time.sleep(args.token_delay)
+                    yield word + " "
+            streamed.finish(streamed.consume(tokens()))
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.workers) as pool:
+            latencies = list(pool.map(answer, range(args.questions)))
+        elapsed = time.perf_counter() - started
+        print(f"{name:<6} {elapsed:6.1f} s   question p50 {percentile(latencies, 0.5):6.2f} s   "
+              f"p99 {percentile(latencies, 0.99):6.2f} s   {sum(fake.calls.values())} calls   "
+              f"{sum(fake.rate_limited.values())} rate limited   {fake.connections} connections")
+        if isinstance(client, PacedWebClient):
+            stats = client.stats()
+            print(f"       {stats['coalesced']} lookups shared   {stats['waits']} waits ({stats['waited_seconds']:.1f} s)   "
+                  f"{stats['deferred'] + stats['deferred_replaced']} partial answers deferred, "
+                  f"{stats['deferred_replaced'] + stats['deferred_superseded']} of them replaced before they were sent")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--speedup", type=float, default=20, help="how many times shorter a minute is")
+    parser.add_argument("--slack-latency", type=float, default=0.02, help="seconds the fake Slack takes per API call")
+    parser.add_argument("--answer-words", type=int, default=60)
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between streamed words")
+    parser.add_argument("--interval", type=float, default=0.25, help="seconds between updates to a streamed answer")
+    args = parser.parse_args()
+
+    def plain(fake):
+        client = WebClient(token="xoxb-fake", base_url=fake.base_url)
+        client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=5))
+        return client
+
+    def paced(fake):
+        return PacedWebClient(token="xoxb-fake", base_url=fake.base_url, limit_scale=args.speedup, max_retries=5)
+
+    print(f"{args.questions} questions, {args.workers} at a time, minutes {args.speedup:g} times shorter")
+    run("plain", plain, args)
+    run("paced", paced, args)
@@ -0,0 +1,128 @@
+# benchmark: how long the Flask bot takes to start, and where the time goes
+# each measurement is a fresh Python process, like a new gunicorn worker, talking
+# to fake_slack.py (which takes --slack-latency seconds per call, so you can see
+# what a slow Slack does to starting up) instead of Slack:
+#   imports: importing each of lazy_app.HEAVY_MODULES, in order, so each one's
+#       time is what it adds to the ones before it
+#   boot: importing 8_rest_of_the_owl.py, first with no bootstrap cache, then with
+#       the one the first boot saved, then with the heavy modules already imported
+#       the way a worker forked from gunicorn's master has them (see gunicorn.conf.py)
+#   lazy_app: how long until lazy_app can answer, and until the bot behind it is loaded
+# Each line is the median of --runs processes. "process" is the whole process
+# including starting Python; "bot" is just importing the bot script. Once the
+# bootstrap cache is saved, starting shouldn't ask Slack anything: we check that
+# no boot after the first calls auth.test
+#
+#   python bench_startup.py --slack-latency 0.5
+import argparse, json, os, statistics, subprocess, sys, tempfile, time
+
+BOT = "8_rest_of_the_owl.py"
+
+
+# runs in the child process: measure one thing, print it as JSON and leave without cleaning up
+def child(mode):
+    import importlib.util
+    result = {}
+    if mode == "imports":
+        import importlib
+        from lazy_app import HEAVY_MODULES
+        for name in HEAVY_MODULES:
+            started = time.perf_counter()
+            importlib.import_module(name)
+            result[name] = time.perf_counter() - started
+    elif mode == "lazy":
+        started = time.perf_counter()
+        import lazy_app
+        result["ready"] = time.perf_counter() - started
+        lazy_app.app.start()
+        while lazy_app.app.app is None and lazy_app.app.error is None:
+            time.sleep(0.005)
+        result["loaded"] = time.perf_counter() - started
+    else:
+        if mode == "preloaded":
+            from lazy_app import preload_imports
+            result["preload"] = preload_imports()
+        started = time.perf_counter()
+        spec = importlib.util.spec_from_file_location("owl_flask", BOT)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["owl_flask"] = module
+        spec.loader.exec_module(module)
+        result["bot"] = time.perf_counter() - started
+    print(json.dumps(result), flush=True)
+    # the bot's background threads would keep going; we've got what we came for
+    os._exit(0)
+
+
+def run(mode, env, workdir, fake):
+    env = dict(env, QDRANT_PATH=tempfile.mkdtemp(dir=workdir))
+    auth_calls = fake.calls["auth.test"]
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, __file__, "--child", mode], env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if output.returncode != 0:
+        sys.exit(f"{mode} failed:\n{output.stderr}")
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    result["process"] = elapsed
+    result["auth.test calls"] = fake.calls["auth.test"] - auth_calls
+    return result
+
+
+def median(results):
+    return {key: statistics.median(result[key] for result in results) for key in results[0]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--slack-latency", type=float, default=0.2, help="seconds the fake Slack takes per API call")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+
+    from fake_slack import FakeSlack, synthetic_workspace
+
+    with FakeSlack(synthetic_workspace(channels=3, messages_per_channel=10), latency=args.slack_latency) as fake, \
+            tempfile.TemporaryDirectory(prefix="bench-startup-") as workdir:
+        bootstrap_cache = os.path.join(workdir, "bootstrap.json")
+        env = dict(
+            os.environ,
+            OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "sk-benchmark-not-a-real-key"),
+            SLACK_BOT_TOKEN="xoxb-fake",
+            SLACK_SIGNING_SECRET="benchmark-signing-secret",
+            SLACK_API_URL=fake.base_url,
+            BOT_APP=BOT,
+            BOOTSTRAP_CACHE=bootstrap_cache,
+            EMBEDDING_CACHE_DB=os.path.join(workdir, "embedding_cache.db"),
+            KEYWORD_INDEX_DB=os.path.join(workdir, "keyword_index.db"),
+            EVENT_LOG_SAMPLE="0",
+        )
+        env.pop("QDRANT_URL", None)
+        env.pop("INDEXER_SOCKET", None)
+        print(f"Slack latency {args.slack_latency * 1000:.0f} ms, median of {args.runs} runs")
+
+        imports = median([run("imports", env, workdir, fake) for _ in range(args.runs)])
+        for name, seconds in imports.items():
+            if name not in ("process", "auth.test calls"):
+                print(f"import {name:<34} {seconds:6.2f} s")
+
+        def boot(label, mode, cold):
+            results = []
+            for _ in range(args.runs):
+                if cold and os.path.exists(bootstrap_cache):
+                    os.remove(bootstrap_cache)
+                results.append(run(mode, env, workdir, fake))
+            result = median(results)
+            print(f"{label:<41} process {result['process']:6.2f} s   bot {result['bot']:6.2f} s   "
+                  f"auth.test calls {result['auth.test calls']:g}")
+            if not cold:
+                assert max(r["auth.test calls"] for r in results) == 0, f"{label}: called auth.test with the bootstrap cache saved"
+
+        boot("boot, no bootstrap cache", "boot", cold=True)
+        boot("boot, bootstrap cache", "boot", cold=False)
+        boot("boot, heavy modules already imported", "preloaded", cold=False)
+        lazy_results = [run("lazy", env, workdir, fake) for _ in range(args.runs)]
+        lazy = median(lazy_results)
+        print(f"{'lazy_app':<41} process {lazy['process']:6.2f} s   ready {lazy['ready']:6.2f} s   loaded {lazy['loaded']:6.2f} s   "
+              f"auth.test calls {lazy['auth.test calls']:g}")
+        assert max(r["auth.test calls"] for r in lazy_results) == 0, "lazy_app: called auth.test with the bootstrap cache saved"
@@ -0,0 +1,107 @@
+# benchmark: how long someone waits before they see anything, with and without
+# streaming answers. Answers go to fake_slack, and the fake LLM takes --llm-latency
+# seconds to write each one, a word at a time. We time when the first message
+# appears, when the first words of the answer appear, and when the answer is done
+#
+#   python bench_streaming.py --questions 10 --llm-latency 5
+import argparse, datetime, os, random, statistics, time
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-not-a-real-key")
+
+from slack_sdk import WebClient
+from llama_index import VectorStoreIndex, ServiceContext
+from llama_index.schema import TextNode
+
+from fake_slack import FakeSlack, synthetic_workspace
+from fakes import FakeEmbedding, FakeLLM
+from query_engines import QueryEnginePool
+from streaming import StreamingMessage, PLACEHOLDER
+
+TEMPLATE = (
+    "---------------------\n"
+    "{context_str}"
+    "\n---------------------\n"
+    "Given the most relevant chat messages above, please answer this question: {query_str}\n"
+)
+WORDS = "launch deploy release review staging prod bug fix meeting friday monday dog cat owl".split()
+ANSWER = ("From what I've heard in this channel, the launch moved to friday because staging "
+          "was broken on monday, and Laurie is doing the deploy once the fix has been reviewed.")
+
+
+def build_index(messages, service_context):
+    now = time.time()
+    nodes = [TextNode(
+        text=" ".join(random.choices(WORDS, k=12)),
+        metadata={"who": "logan", "when": datetime.datetime.fromtimestamp(now - i * 60).strftime('%Y-%m-%d %H:%M:%S')}
+    ) for i in range(messages)]
+    return VectorStoreIndex(nodes, service_context=service_context)
+
+
+# watch the fake Slack for the first message, the first one with part of the answer in it, and the whole answer
+class Watcher:
+    def __init__(self, fake):
+        self.started = None
+        self.first_message = None
+        self.first_words = None
+        self.done = None
+        fake.on_post.append(self.seen)
+        fake.on_update.append(self.seen)
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.first_message = self.first_words = self.done = None
+
+    def seen(self, channel, message):
+        now = time.perf_counter() - self.started
+        if self.first_message is None:
+            self.first_message = now
+        if self.first_words is None and message["text"] != PLACEHOLDER:
+            self.first_words = now
+        if message["text"] == ANSWER:
+            self.done = now
+
+
+def report(name, timings):
+    print(f"{name:<20}" + "   ".join(
+        f"{label} {statistics.median(values):6.2f} s" for label, values in timings.items()
+    ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", type=int, default=10)
+    parser.add_argument("--llm-latency", type=float, default=5.0)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between chat_update calls")
+    args = parser.parse_args()
+
+    random.seed(0)
+    llm = FakeLLM(latency=args.llm_latency, answer=ANSWER)
+    service_context = ServiceContext.from_defaults(llm=llm, embed_model=FakeEmbedding())
+    index = build_index(200, service_context)
+    blocking = QueryEnginePool(index, TEMPLATE, size=1)
+    streaming = QueryEnginePool(index, TEMPLATE, size=1, streaming=True)
+
+    with FakeSlack(synthetic_workspace(channels=1, messages_per_channel=10), latency=0.02) as fake:
+        client = WebClient(token="xoxb-fake", base_url=fake.base_url)
+        channel = fake.workspace["channels"][0]["id"]
+        watcher = Watcher(fake)
+        results = {}
+        for name in ("blocking", "streaming"):
+            timings = {"first message": [], "first words": [], "whole answer": []}
+            for _ in range(args.questions):
+                query = " ".join(random.choices(WORDS, k=5)) + "?"
+                watcher.reset()
+                if name == "blocking":
+                    client.chat_postMessage(channel=channel, text=str(blocking.query(query)))
+                else:
+                    streamed = StreamingMessage(client, channel, interval=args.interval).start()
+                    response = streaming.stream(query)
+                    streamed.finish(streamed.consume(response.response_gen))
+                timings["first message"].append(watcher.first_message)
+                timings["first words"].append(watcher.first_words)
+                timings["whole answer"].append(watcher.done)
+            results[name] = timings
+
+    print(f"{args.questions} questions, LLM takes {args.llm_latency:.1f} s per answer, medians:")
+    for name, timings in results.items():
+        report(name, timings)
@@ -0,0 +1,84 @@
+# benchmark: what the write-ahead log (wal.py) costs the handlers, and how fast it catches up
+#   append: --threads handlers each logging messages at once, for a few fsync
+#       intervals; every append waits for the fsync that covers it, so this is
+#       the time a handler spends before Slack gets its ack
+#   catch up: --backlog messages already in the log (say, logged while the
+#       embedding API was down), drained by a consumer whose store takes
+#       --store-latency seconds per batch, like one embedding call and one upsert
+#
+#   python bench_wal.py --threads 16 --backlog 20000
+import argparse, tempfile, threading, time
+
+from wal import WriteAheadLog, LogConsumer
+
+
+def message(i):
+    return {"kind": "message", "message": {"channel": "C00000001", "user": f"U{i % 20:05d}", "ts": f"{1700000000 + i}.000100",
+                                           "text": f"message {i} about the launch, the outage and the budget"}}
+
+
+def bench_append(threads, per_thread, fsync_interval):
+    with tempfile.TemporaryDirectory(prefix="bench-wal-") as directory:
+        log = WriteAheadLog(directory, fsync_interval=fsync_interval)
+        latencies = []
+        lock = threading.Lock()
+
+        def handler(n):
+            mine = []
+            for i in range(per_thread):
+                started = time.perf_counter()
+                log.append(message(n * per_thread + i))
+                mine.append(time.perf_counter() - started)
+            with lock:
+                latencies.extend(mine)
+
+        workers = [threading.Thread(target=handler, args=(n,)) for n in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        stats = log.stats()
+        log.close()
+    latencies.sort()
+    print(f"append, fsync every {fsync_interval * 1000:4.0f} ms   {len(latencies) / elapsed:8.0f} messages/s   "
+          f"p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms   p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.2f} ms   "
+          f"{stats['appended'] / stats['fsyncs']:6.1f} messages per fsync")
+
+
+def bench_catch_up(backlog, batch_size, store_latency):
+    with tempfile.TemporaryDirectory(prefix="bench-wal-") as directory:
+        log = WriteAheadLog(directory)
+        for i in range(backlog):
+            log.append(message(i), wait=False)
+        log.wait_for(backlog)
+        done = threading.Event()
+
+        def store(records):
+            time.sleep(store_latency)
+            if records[-1][0] >= backlog:
+                done.set()
+
+        started = time.perf_counter()
+        consumer = LogConsumer(log, store, batch_size=batch_size, max_delay=0).start()
+        done.wait()
+        elapsed = time.perf_counter() - started
+        consumer.close()
+    print(f"catch up, batches of {batch_size:4}   {backlog / elapsed:8.0f} messages/s   {elapsed:6.2f} s for {backlog}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=200, help="messages each thread logs")
+    parser.add_argument("--backlog", type=int, default=20000)
+    parser.add_argument("--store-latency", type=float, default=0.2, help="seconds to embed and store one batch")
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads logging {args.messages} messages each")
+    for fsync_interval in (0.0, 0.002, 0.01):
+        bench_append(args.threads, args.messages, fsync_interval)
+    print(f"{args.backlog} messages behind, {args.store_latency * 1000:.0f} ms to store a batch")
+    for batch_size in (32, 256):
+        bench_catch_up(args.backlog, batch_size, args.store_latency)
@@ -0,0 +1,104 @@
+# benchmark: storing each message on its own against storing conversation windows
+# the synthetic channel is mostly chatter, plus questions that someone answers
+# right away or up to --max-gap messages later. The answers don't share any words with the questions, so
+# searching for a question only finds its answer if the answer is stored with it
+# (a window) or pulled in next to it (NeighborExpander). We report how many
+# vectors each way stores, how often the answer makes it into the context, and
+# how many tokens of context that took
+# runs offline against an in-memory Qdrant with the fake embedding model
+#
+#   python bench_windows.py --questions 50 --chatter 2000
+import argparse, random, statistics
+import qdrant_client
+from llama_index.schema import MetadataMode, QueryBundle
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+
+from fakes import FakeEmbedding
+from storage import ensure_collection
+from retrieval import SlackRetriever
+from windows import ConversationWindows, NeighborExpander
+
+FILLER = ("ok so anyway i think we should probably look at that later today maybe "
+          "after lunch sounds good thanks let me check and get back to you").split()
+PEOPLE = ["logan", "laurie", "jerry", "simon", "ravi"]
+
+
+def build_channel(questions, chatter, start, max_gap):
+    lines = [("chatter", " ".join(random.sample(FILLER, 6))) for _ in range(chatter)]
+    probes = []
+    for q in range(questions):
+        position = random.randrange(len(lines))
+        question = f"does anyone know where topic{q}alpha topic{q}beta topic{q}gamma lives"
+        answer = f"answer{q} " + " ".join(random.sample(FILLER, 4))
+        between = [("chatter", random.choice(FILLER)) for _ in range(random.randint(0, max_gap))]
+        lines[position:position] = [("question", question)] + between + [("answer", answer)]
+        probes.append((question, f"answer{q} "))
+    messages = [
+        {"channel": "C1", "ts": f"{start + i * 30:.6f}", "user": random.choice(PEOPLE), "text": text}
+        for i, (_, text) in enumerate(lines)
+    ]
+    return messages, probes
+
+
+def load(client, collection_name, embed_model, messages, size, overlap):
+    windows = ConversationWindows(size=size, overlap=overlap)
+    nodes = {}
+    for message in messages:
+        for node in windows.add(message, message["user"]):
+            nodes[node.node_id] = node
+    nodes = list(nodes.values())
+    embeddings = embed_model.get_text_embedding_batch([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+    ensure_collection(client, collection_name, embed_model.dim)
+    QdrantVectorStore(client=client, collection_name=collection_name).add(nodes)
+    return len(nodes)
+
+
+def run(retrieve, probes):
+    found, tokens = 0, []
+    for question, answer in probes:
+        results = retrieve(question)
+        context = "\n\n".join(result.node.get_content(metadata_mode=MetadataMode.LLM) for result in results)
+        tokens.append(len(context) // 4 + 1)
+        found += answer in context
+    return found / len(probes), statistics.mean(tokens)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--chatter", type=int, default=2000)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--window-size", type=int, default=6)
+    parser.add_argument("--overlap", type=int, default=2)
+    parser.add_argument("--max-gap", type=int, default=3, help="most messages between a question and its answer")
+    args = parser.parse_args()
+
+    random.seed(0)
+    embed_model = FakeEmbedding()
+    client = qdrant_client.QdrantClient(":memory:")
+    messages, probes = build_channel(args.questions, args.chatter, 1_700_000_000, args.max_gap)
+
+    setups = [
+        ("messages", "per_message", 1, 0, 0),
+        ("messages + neighbors", "per_message", 1, 0, 1),
+        ("messages + 2 neighbors", "per_message", 1, 0, 2),
+        (f"windows of {args.window_size}", "windows", args.window_size, args.overlap, 0),
+        (f"windows of {args.window_size} + neighbors", "windows", args.window_size, args.overlap, 1),
+    ]
+    vectors = {}
+    print(f"{len(messages)} messages, {args.questions} questions, top {args.top_k}")
+    for name, collection_name, size, overlap, hops in setups:
+        if collection_name not in vectors:
+            vectors[collection_name] = load(client, collection_name, embed_model, messages, size, overlap)
+        retriever = SlackRetriever(client, collection_name, embed_model, similarity_top_k=args.top_k)
+        expander = NeighborExpander(client, collection_name, hops=hops)
+
+        def retrieve(question):
+            results = retriever.retrieve(question)
+            return expander.postprocess_nodes(results, QueryBundle(question)) if hops else results
+
+        recall, tokens = run(retrieve, probes)
+        print(f"{name:<28} {vectors[collection_name]:6d} vectors   answer found {recall:6.1%}   "
+              f"context {tokens:7.1f} tokens   found per 1k tokens {recall * 1000 / tokens:6.3f}")
@@ -0,0 +1,105 @@
+# what the bot needs to know about itself before it can start, saved on disk
+# every worker used to call auth_test (and page through conversations_list to join
+# its channels) as it started, so starting took as long as Slack did, and failed
+# when Slack was down. The answers hardly ever change, so they're saved in
+# BOOTSTRAP_CACHE (default ./bootstrap.json, "" to turn it off) and reused for
+# BOOTSTRAP_TTL seconds (default a day) by every worker and every restart. They're
+# saved for one bot token and Slack API at a time, so changing either asks Slack again.
+# With BOT_CHANNELS=*, channels created since the list was saved are joined when it expires
+import hashlib, json, os, threading, time
+
+
+class BootstrapCache:
+    def __init__(self, path="./bootstrap.json", ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # which bot, without keeping its token on disk
+    def _key(self, client):
+        return hashlib.sha256(f"{client.base_url} {client.token}".encode()).hexdigest()[:16]
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, client, name):
+        if not self.path:
+            return None
+        with self.lock:
+            data = self._load()
+            entry = data.get("values", {}).get(name) if data.get("key") == self._key(client) else None
+            if entry is not None and entry["saved_at"] + self.ttl > time.time():
+                self.hits += 1
+                return entry["value"]
+            self.misses += 1
+            return None
+
+    def put(self, client, name, value):
+        if not self.path:
+            return
+        with self.lock:
+            data = self._load()
+            if data.get("key") != self._key(client):
+                data = {"key": self._key(client), "values": {}}
+            data["values"][name] = {"saved_at": time.time(), "value": value}
+            # other workers may be reading it, so they get the old file or the new one, never half of one
+            temp = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp, "w") as f:
+                json.dump(data, f)
+            os.replace(temp, self.path)
+
+    # who the bot is: auth_test's user_id, team_id and so on
+    def auth(self, client):
+        auth = self.get(client, "auth")
+        if auth is None:
+            auth = _auth_fields(client.auth_test())
+            self.put(client, "auth", auth)
+        return auth
+
+    # the ids of the channels in BOT_CHANNELS, joining them with find_channels if we haven't lately
+    def channels(self, client, names, all_channels, find_channels):
+        name = _channels_name(names, all_channels)
+        channel_ids = self.get(client, name)
+        if channel_ids is None:
+            channel_ids = find_channels(client, names, all_channels)
+            self.put(client, name, channel_ids)
+        return channel_ids
+
+    # the same with an AsyncWebClient
+    async def aauth(self, client):
+        auth = self.get(client, "auth")
+        if auth is None:
+            auth = _auth_fields(await client.auth_test())
+            self.put(client, "auth", auth)
+        return auth
+
+    async def achannels(self, client, names, all_channels, afind_channels):
+        name = _channels_name(names, all_channels)
+        channel_ids = self.get(client, name)
+        if channel_ids is None:
+            channel_ids = await afind_channels(client, names, all_channels)
+            self.put(client, name, channel_ids)
+        return channel_ids
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ.get("BOOTSTRAP_CACHE", "./bootstrap.json"), ttl=int(os.environ.get("BOOTSTRAP_TTL", 86400)))
+
+
+def _auth_fields(response):
+    return {name: response.get(name) for name in ("user_id", "team_id", "bot_id", "user", "url")}
+
+
+# a different BOT_CHANNELS is a different list
+def _channels_name(names, all_channels):
+    return "channels:" + ("*" if all_channels else ",".join(sorted(names)))
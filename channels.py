@@ -0,0 +1,74 @@
+# which channels the bot listens in, and which of them a question searches
+# the bot used to join #bot-testing and nothing else. Now it joins the channels
+# in BOT_CHANNELS (names, comma separated, or * for every public channel) and
+# stores messages from all of them, each tagged with its channel and team id.
+# Those are indexed payload fields, so a question can search just some channels
+# with a filter, and Qdrant only looks at their messages instead of everything:
+#   channel: only the channel the question was asked in (the default)
+#   allowed: that channel plus the ones in SEARCH_CHANNELS (channel ids)
+#   all: every channel, like before
+import os
+
+SCOPES = ("channel", "allowed", "all")
+
+
+# ids of the channels we want, joining the ones we're not in yet
+# with thousands of channels this is a lot of Slack calls, so the bot runs it in the background
+def find_channels(client, names, all_channels):
+    channel_ids = []
+    cursor = None
+    while True:
+        page = client.conversations_list(cursor=cursor, limit=200, exclude_archived=True)
+        for channel in page['channels']:
+            if all_channels or channel['name'] in names:
+                if not channel.get('is_member'):
+                    client.conversations_join(channel=channel['id'])
+                channel_ids.append(channel['id'])
+        cursor = page.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return channel_ids
+
+
+# the same with an AsyncWebClient
+async def afind_channels(client, names, all_channels):
+    channel_ids = []
+    cursor = None
+    while True:
+        page = await client.conversations_list(cursor=cursor, limit=200, exclude_archived=True)
+        for channel in page['channels']:
+            if all_channels or channel['name'] in names:
+                if not channel.get('is_member'):
+                    await client.conversations_join(channel=channel['id'])
+                channel_ids.append(channel['id'])
+        cursor = page.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return channel_ids
+
+
+# BOT_CHANNELS as (names, all_channels)
+def bot_channels_from_env():
+    value = os.environ.get("BOT_CHANNELS", "bot-testing").strip()
+    if value == "*":
+        return [], True
+    return [name.strip().lstrip("#") for name in value.split(",") if name.strip()], False
+
+
+class ChannelScope:
+    def __init__(self, mode="channel", allowed=()):
+        if mode not in SCOPES:
+            raise ValueError(f"Unknown search scope {mode!r}, expected one of {SCOPES}")
+        self.mode = mode
+        self.allowed = set(allowed)
+
+    # the channel ids a question asked in channel_id may search, or None for all of them
+    def channels_for(self, channel_id):
+        if self.mode == "all":
+            return None
+        if self.mode == "channel":
+            return [channel_id]
+        return sorted(self.allowed | {channel_id})
+
+    @classmethod
+    def from_env(cls):
+        allowed = [channel.strip() for channel in os.environ.get("SEARCH_CHANNELS", "").split(",") if channel.strip()]
+        return cls(os.environ.get("SEARCH_SCOPE", "channel"), allowed)
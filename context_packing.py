@@ -0,0 +1,141 @@
+# picks which chat messages go into the prompt, within a token budget
+# handing the LLM a fixed top 20 wastes tokens when a handful of short messages
+# would do, and a few long ones can blow past the context window. Instead we
+# fetch more candidates than we need and then:
+#   1. drop near-duplicates ("+1", the same link pasted twice), keeping the best scoring copy
+#   2. take the best scoring messages that fit in the budget
+#   3. merge messages someone sent one after another into a single message, so
+#      the who:/when: header is only paid for once, and use what that frees up
+#      to fit in more messages
+# The messages that make it are sorted most recent first, like before
+import re, threading
+from typing import Any, Callable, List, Optional
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import MetadataMode, NodeWithScore, QueryBundle, TextNode
+
+from retrieval import keep_similarity, message_time
+
+WORD = re.compile(r"\w+")
+# what the prompt puts between messages
+SEPARATOR_TOKENS = 2
+
+
+def _words(text):
+    return set(WORD.findall((text or "").lower()))
+
+
+class ContextPacker(BaseNodePostprocessor):
+    token_budget: int = Field(default=3000, description="Most tokens of chat messages to put in the prompt.")
+    duplicate_threshold: float = Field(default=0.9, description="Word overlap above which two messages count as the same.")
+    merge_gap_seconds: float = Field(default=300, description="Merge messages from one person sent this close together.")
+    _count_tokens: Callable[[str], int] = PrivateAttr()
+    _lock: Any = PrivateAttr()
+    _totals: dict = PrivateAttr()
+    _last: Optional[dict] = PrivateAttr()
+
+    def __init__(self, count_tokens: Optional[Callable[[str], int]] = None, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        # a rough count is fine if we aren't given a real tokenizer
+        self._count_tokens = count_tokens or (lambda text: len(text) // 4 + 1)
+        self._lock = threading.Lock()
+        self._totals = {"queries": 0, "candidates": 0, "sent": 0, "duplicates": 0, "merged": 0,
+                        "tokens_sent": 0, "tokens_saved": 0}
+        self._last = None
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextPacker"
+
+    def _tokens(self, node):
+        return self._count_tokens(node.node.get_content(metadata_mode=MetadataMode.LLM)) + SEPARATOR_TOKENS
+
+    def _is_duplicate(self, words, kept_words):
+        for other in kept_words:
+            if words == other:
+                return True
+            union = len(words | other)
+            if union and len(words & other) / union >= self.duplicate_threshold:
+                return True
+        return False
+
+    # best first, skipping anything too like a message we've already kept
+    def _dedupe(self, nodes):
+        kept, kept_words = [], []
+        for node in sorted(nodes, key=lambda n: n.score or 0.0, reverse=True):
+            words = _words(node.node.get_content())
+            if self._is_duplicate(words, kept_words):
+                continue
+            kept.append(node)
+            kept_words.append(words)
+        return kept
+
+    # oldest first, with runs of messages from the same person joined together
+    def _merge(self, nodes):
+        merged = []
+        for node in sorted(nodes, key=lambda n: message_time(n.node)):
+            previous = merged[-1] if merged else None
+            if (previous is not None
+                    and previous.node.metadata.get("who") == node.node.metadata.get("who")
+                    and message_time(node.node) - message_time(previous.node) <= self.merge_gap_seconds):
+                # keep the first message's "when" for the LLM, and the last one's when_ts for sorting
+                metadata = dict(previous.node.metadata, when_ts=node.node.metadata.get("when_ts", message_time(node.node)))
+                merged[-1] = NodeWithScore(
+                    node=TextNode(
+                        id_=previous.node.node_id,
+                        text=previous.node.get_content() + "\n" + node.node.get_content(),
+                        metadata=metadata,
+                        excluded_embed_metadata_keys=list(previous.node.excluded_embed_metadata_keys),
+                        excluded_llm_metadata_keys=list(previous.node.excluded_llm_metadata_keys),
+                    ),
+                    score=max(previous.score or 0.0, node.score or 0.0),
+                )
+                # as similar to the question as the closer of the two
+                similarities = [n.node.metadata["similarity"] for n in (previous, node) if "similarity" in n.node.metadata]
+                if similarities:
+                    keep_similarity(merged[-1].node, max(similarities))
+            else:
+                merged.append(node)
+        return merged
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        candidate_tokens = sum(self._tokens(node) for node in nodes)
+        remaining = self._dedupe(nodes)
+        duplicates = len(nodes) - len(remaining)
+        chosen = []
+        # merging frees up tokens, so keep going until nothing else fits
+        while True:
+            used = sum(self._tokens(node) for node in chosen)
+            added = False
+            for node in list(remaining):
+                tokens = self._tokens(node)
+                if used + tokens <= self.token_budget:
+                    chosen.append(node)
+                    remaining.remove(node)
+                    used += tokens
+                    added = True
+            if not added:
+                break
+            chosen = self._merge(chosen)
+        chosen.sort(key=lambda node: message_time(node.node), reverse=True)
+        tokens_sent = sum(self._tokens(node) for node in chosen)
+        stats = {
+            "candidates": len(nodes),
+            "sent": len(chosen),
+            "duplicates": duplicates,
+            "merged": len(nodes) - duplicates - len(remaining) - len(chosen),
+            "tokens_sent": tokens_sent,
+            "tokens_saved": candidate_tokens - tokens_sent,
+        }
+        with self._lock:
+            self._last = stats
+            self._totals["queries"] += 1
+            for key, value in stats.items():
+                self._totals[key] += value
+        print(f"Packed {stats['sent']} messages from {stats['candidates']} into {tokens_sent} tokens "
+              f"({stats['duplicates']} duplicates, {stats['merged']} merged, {stats['tokens_saved']} tokens saved)")
+        return chosen
+
+    def stats(self):
+        with self._lock:
+            return dict(self._totals, last=self._last)
@@ -0,0 +1,73 @@
+# remembers which Slack events and messages we've already handled
+# Slack redelivers events it thinks we missed (with an X-Slack-Retry-Num header),
+# and the same message can arrive more than once, so we keep a bounded,
+# expiring set of keys we've seen. It lives in memory, and can optionally be
+# backed by a SQLite file so it survives restarts and is shared between workers
+import collections, sqlite3, threading, time
+
+
+class SeenStore:
+    def __init__(self, max_size=10000, ttl=3600, sqlite_path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> expiry time, oldest first
+        self.seen = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        self.writes = 0
+        if sqlite_path:
+            self.db = sqlite3.connect(sqlite_path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires REAL NOT NULL)")
+
+    # returns True if we've seen this key before, otherwise remembers it and returns False
+    def check_and_add(self, key):
+        now = time.time()
+        with self.lock:
+            expires = self.seen.get(key)
+            if expires is not None and expires > now:
+                self.seen.move_to_end(key)
+                self.hits += 1
+                return True
+            if self.db is not None and self._seen_in_db(key, now):
+                self._remember(key, now)
+                self.hits += 1
+                return True
+            self._remember(key, now)
+            if self.db is not None:
+                self._write_to_db(key, now)
+            self.misses += 1
+            return False
+
+    def _remember(self, key, now):
+        self.seen[key] = now + self.ttl
+        self.seen.move_to_end(key)
+        while len(self.seen) > self.max_size:
+            self.seen.popitem(last=False)
+        # drop expired keys from the old end while we're here
+        while self.seen:
+            oldest_key, oldest_expiry = next(iter(self.seen.items()))
+            if oldest_expiry > now:
+                break
+            del self.seen[oldest_key]
+
+    def _seen_in_db(self, key, now):
+        row = self.db.execute("SELECT expires FROM seen WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] > now
+
+    def _write_to_db(self, key, now):
+        # INSERT OR IGNORE would keep an expired row, so replace it instead
+        self.db.execute("INSERT OR REPLACE INTO seen (key, expires) VALUES (?, ?)", (key, now + self.ttl))
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            self.db.execute("DELETE FROM seen WHERE expires <= ?", (now,))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.seen),
+                "duplicates": self.hits,
+                "new": self.misses,
+            }
@@ -0,0 +1,169 @@
+# a small dispatch layer so the Slack handler never waits on the LLM
+# jobs go onto a bounded queue and are served by a pool of worker threads;
+# when the queue is full we drop the job and tell the user we're busy instead
+# of letting everyone's answers get slower and slower
+#
+# answering a question waits on the LLM and Qdrant, not the CPU, so threads are
+# all we need. A process pool forked from the bot would copy its caches and
+# Qdrant client as they were at the fork, send nothing back, and could inherit
+# a lock some other thread was holding
+import asyncio, atexit, collections, queue, threading, time
+
+
+class Dispatcher:
+    def __init__(self, workers=4, max_queue=16):
+        self.mode = "thread"
+        self.workers = workers
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits = collections.deque(maxlen=1000)
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name=f"dispatch-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        atexit.register(self.shutdown)
+
+    # queue a job; if there's no room, call on_busy (if given) and return False
+    def submit(self, fn, *args, on_busy=None, **kwargs):
+        try:
+            self.jobs.put_nowait((time.monotonic(), fn, args, kwargs))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            if on_busy is not None:
+                try:
+                    on_busy()
+                except Exception as e:
+                    print("Could not send busy reply:", e)
+            return False
+        with self.lock:
+            self.submitted += 1
+        return True
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            enqueued_at, fn, args, kwargs = job
+            waited = time.monotonic() - enqueued_at
+            with self.lock:
+                self.in_flight += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                self.recent_waits.append(waited)
+            try:
+                fn(*args, **kwargs)
+                with self.lock:
+                    self.completed += 1
+            except Exception as e:
+                print("Dispatched job failed:", repr(e))
+                with self.lock:
+                    self.failed += 1
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+                self.jobs.task_done()
+
+    # queue depth, throughput counters and how long jobs sat in the queue
+    def stats(self):
+        with self.lock:
+            return summarize(self, self.jobs.qsize(), self.jobs.maxsize)
+
+    # let queued jobs finish, then stop the workers
+    def shutdown(self, wait=True):
+        if not self.threads:
+            return
+        for _ in self.threads:
+            self.jobs.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        self.threads = []
+
+
+# the same idea for asyncio: jobs are coroutine functions, at most `concurrency` of
+# them run at once and up to max_queue more can wait their turn
+class AsyncDispatcher:
+    def __init__(self, concurrency=32, max_queue=64):
+        self.mode = "asyncio"
+        self.workers = concurrency
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+        self.waiting = 0
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits = collections.deque(maxlen=1000)
+
+    # start a job; if too many are already waiting, await on_busy (if given) and return False
+    async def submit(self, fn, *args, on_busy=None, **kwargs):
+        if self.waiting + self.in_flight >= self.workers + self.max_queue:
+            self.dropped += 1
+            if on_busy is not None:
+                try:
+                    await on_busy()
+                except Exception as e:
+                    print("Could not send busy reply:", e)
+            return False
+        self.submitted += 1
+        self.waiting += 1
+        task = asyncio.create_task(self._run(time.monotonic(), fn, args, kwargs))
+        # keep a reference, or the task can be garbage collected before it finishes
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def _run(self, enqueued_at, fn, args, kwargs):
+        async with self.semaphore:
+            waited = time.monotonic() - enqueued_at
+            self.waiting -= 1
+            self.in_flight += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.recent_waits.append(waited)
+            try:
+                await fn(*args, **kwargs)
+                self.completed += 1
+            except Exception as e:
+                print("Dispatched job failed:", repr(e))
+                self.failed += 1
+            finally:
+                self.in_flight -= 1
+
+    def stats(self):
+        return summarize(self, self.waiting, self.max_queue)
+
+
+def summarize(dispatcher, queue_depth, queue_capacity):
+    waits = sorted(dispatcher.recent_waits)
+    started = dispatcher.completed + dispatcher.failed + dispatcher.in_flight
+    return {
+        "mode": dispatcher.mode,
+        "workers": dispatcher.workers,
+        "queue_depth": queue_depth,
+        "queue_capacity": queue_capacity,
+        "in_flight": dispatcher.in_flight,
+        "submitted": dispatcher.submitted,
+        "completed": dispatcher.completed,
+        "failed": dispatcher.failed,
+        "dropped": dispatcher.dropped,
+        "wait_seconds_avg": dispatcher.wait_total / started if started else 0.0,
+        "wait_seconds_p50": waits[len(waits) // 2] if waits else 0.0,
+        "wait_seconds_p99": waits[min(len(waits) - 1, int(len(waits) * 0.99))] if waits else 0.0,
+        "wait_seconds_max": dispatcher.wait_max,
+    }
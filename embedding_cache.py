@@ -0,0 +1,175 @@
+# remembers embeddings so the same text is never embedded twice
+# Slack is full of repeats: "+1", "thanks!", the same link pasted in three
+# channels, and a backfill going over history we've already stored. Embeddings
+# are looked up by a hash of the model name and the text (with whitespace
+# tidied up) in a SQLite file, so they survive restarts and are shared by every
+# process that points at the same file. When there are more than max_entries,
+# the ones that haven't been used for longest are deleted.
+#
+# CachedEmbedding wraps any embedding model; put it in the ServiceContext and
+# both storing messages and answering questions go through it
+import array, hashlib, os, re, sqlite3, threading, time
+from typing import Any, List
+from llama_index import ServiceContext
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class EmbeddingStore:
+    def __init__(self, path, max_entries=50000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self.count = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.lookups = 0
+        self.hits = 0
+        self.embedded = 0
+        self.evicted = 0
+
+    @staticmethod
+    def key(model_name, kind, text):
+        text = WHITESPACE.sub(" ", text).strip()
+        return hashlib.sha256(f"{model_name}\0{kind}\0{text}".encode()).hexdigest()
+
+    # key -> embedding for the keys we have
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            # SQLite allows a limited number of parameters per statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk)
+                for key, vector in rows:
+                    found[key] = array.array("f", vector).tolist()
+            if found:
+                self.db.executemany("UPDATE embeddings SET used = ? WHERE key = ?", [(time.time(), key) for key in found])
+            self.lookups += len(keys)
+            self.hits += sum(1 for key in keys if key in found)
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        rows = [(key, array.array("f", embedding).tobytes(), now) for key, embedding in items]
+        with self.lock:
+            self.embedded += len(rows)
+            before = self.db.total_changes
+            self.db.executemany("INSERT OR IGNORE INTO embeddings (key, vector, used) VALUES (?, ?, ?)", rows)
+            self.count += self.db.total_changes - before
+            if self.count > self.max_entries:
+                self._evict()
+
+    # delete the least recently used tenth, so we don't do this on every write
+    def _evict(self):
+        target = int(self.max_entries * 0.9)
+        excess = self.count - target
+        self.db.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)", (excess,)
+        )
+        self.count = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.evicted += excess
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.count,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "embedded": self.embedded,
+                # hits, plus repeats within a batch that we only embedded once
+                "calls_saved": self.lookups - self.embedded,
+                "evicted": self.evicted,
+            }
+
+
+class CachedEmbedding(BaseEmbedding):
+    _model: BaseEmbedding = PrivateAttr()
+    _store: EmbeddingStore = PrivateAttr()
+
+    def __init__(self, model: BaseEmbedding, store: EmbeddingStore, **kwargs: Any) -> None:
+        super().__init__(
+            model_name=model.model_name,
+            embed_batch_size=model.embed_batch_size,
+            callback_manager=model.callback_manager,
+            **kwargs,
+        )
+        self._model = model
+        self._store = store
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def store(self) -> EmbeddingStore:
+        return self._store
+
+    # the keys for these texts, the embeddings we already have, and the texts we still need
+    # (each only once, since a batch often has the same "+1" in it several times)
+    def _lookup(self, kind, texts):
+        keys = [EmbeddingStore.key(self.model_name, kind, text) for text in texts]
+        found = self._store.get_many(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        return keys, found, missing
+
+    def _remember(self, keys, found, missing, embeddings):
+        self._store.put_many(list(zip(missing, embeddings)))
+        found.update(zip(missing, embeddings))
+        return [found[key] for key in keys]
+
+    def _cached(self, kind, texts, embed):
+        keys, found, missing = self._lookup(kind, texts)
+        embeddings = embed(list(missing.values())) if missing else []
+        return self._remember(keys, found, missing, embeddings)
+
+    async def _acached(self, kind, texts, aembed):
+        keys, found, missing = self._lookup(kind, texts)
+        embeddings = await aembed(list(missing.values())) if missing else []
+        return self._remember(keys, found, missing, embeddings)
+
+    # some models embed questions differently from documents, so they're cached separately
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._cached("query", [query], lambda texts: [self._model._get_query_embedding(texts[0])])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        async def aembed(texts):
+            return [await self._model._aget_query_embedding(texts[0])]
+        return (await self._acached("query", [query], aembed))[0]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._cached("text", [text], self._model._get_text_embeddings)[0]
+
+    # one request to the model per batch, for just the texts we haven't seen
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._cached("text", texts, self._model._get_text_embeddings)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await self._acached("text", texts, self._model._aget_text_embeddings)
+
+
+# a copy of service_context (or the default one) whose embedding model is cached
+# in EMBEDDING_CACHE_DB, unless EMBEDDING_CACHE_DB is set to an empty string
+def cached_service_context(service_context=None):
+    service_context = service_context or ServiceContext.from_defaults()
+    path = os.environ.get("EMBEDDING_CACHE_DB", "./embedding_cache.db")
+    if not path:
+        return service_context
+    store = EmbeddingStore(path, max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", 50000)))
+    return ServiceContext.from_service_context(
+        service_context, embed_model=CachedEmbedding(service_context.embed_model, store)
+    )
+
+
+# the cache's stats for /stats, or None if the embedding model isn't cached
+def embedding_cache_stats(service_context):
+    embed_model = service_context.embed_model
+    return embed_model.store.stats() if isinstance(embed_model, CachedEmbedding) else None
@@ -0,0 +1,349 @@
+# a fake Slack Web API, so we can run the bot and its tools without a workspace
+# it serves the handful of methods we use over HTTP on localhost, from either a
+# synthetic workspace or one recorded from a real workspace with record_workspace.
+# Point a WebClient at it with WebClient(token="xoxb-fake", base_url=fake.base_url)
+#
+#   python fake_slack.py --port 3001 --channels 3 --messages 500
+import argparse, collections, hashlib, hmac, itertools, json, random, threading, time, urllib.parse, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("launch deploy release review staging prod bug fix meeting friday monday "
+         "roadmap budget hiring design api docs customer demo latency outage "
+         "database migration postgres redis cache owl dog cat lunch offsite").split()
+
+
+# a workspace with some users and channels full of random chatter, some of it threaded
+# every bot_every-th message is from an integration: a bot_message with no user
+def synthetic_workspace(channels=3, messages_per_channel=500, users=20, thread_every=10,
+                        replies_per_thread=5, bot_every=25, seed=0, now=None):
+    rng = random.Random(seed)
+    now = now or time.time()
+    workspace = {
+        "team_id": "T0FAKE",
+        "bot_user_id": "U0BOT",
+        "users": [{"id": "U0BOT", "name": "owlbot", "is_bot": True, "profile": {"display_name": "Owl"}}],
+        "channels": [],
+        "history": {},
+        "replies": {},
+    }
+    for u in range(users):
+        workspace["users"].append({"id": f"U{u:05d}", "name": f"user{u}", "profile": {"display_name": f"User {u}"}})
+    for c in range(channels):
+        channel_id = f"C{c:05d}"
+        workspace["channels"].append({"id": channel_id, "name": "bot-testing" if c == 0 else f"channel-{c}"})
+        history = []
+        replies = {}
+        for m in range(messages_per_channel):
+            ts = f"{now - (messages_per_channel - m) * 60:.6f}"
+            message = {
+                "type": "message",
+                "ts": ts,
+                "user": rng.choice(workspace["users"][1:])["id"],
+                "text": " ".join(rng.choices(WORDS, k=rng.randint(3, 15))),
+            }
+            if bot_every and m % bot_every == bot_every - 1:
+                del message["user"]
+                message.update(bot_message_fields("deploybot"))
+            elif thread_every and m % thread_every == 0:
+                thread = []
+                for r in range(replies_per_thread):
+                    thread.append({
+                        "type": "message",
+                        "ts": f"{float(ts) + r + 1:.6f}",
+                        "thread_ts": ts,
+                        "parent_user_id": message["user"],
+                        "user": rng.choice(workspace["users"][1:])["id"],
+                        "text": " ".join(rng.choices(WORDS, k=rng.randint(3, 15))),
+                    })
+                message["thread_ts"] = ts
+                message["reply_count"] = len(thread)
+                replies[ts] = thread
+            history.append(message)
+        # Slack returns history newest first
+        workspace["history"][channel_id] = list(reversed(history))
+        workspace["replies"][channel_id] = replies
+    return workspace
+
+
+# save part of a real workspace in the format FakeSlack loads
+def record_workspace(client, path, channel_ids, limit=1000):
+    workspace = {
+        "team_id": client.auth_test()["team_id"],
+        "bot_user_id": client.auth_test()["user_id"],
+        "users": client.users_list(limit=200)["members"],
+        "channels": [],
+        "history": {},
+        "replies": {},
+    }
+    for channel_id in channel_ids:
+        workspace["channels"].append(client.conversations_info(channel=channel_id)["channel"])
+        history = client.conversations_history(channel=channel_id, limit=min(limit, 1000))["messages"]
+        workspace["history"][channel_id] = history
+        workspace["replies"][channel_id] = {}
+        for message in history:
+            if message.get("reply_count"):
+                thread = client.conversations_replies(channel=channel_id, ts=message["ts"])["messages"]
+                workspace["replies"][channel_id][message["ts"]] = [m for m in thread if m["ts"] != message["ts"]]
+    with open(path, "w") as f:
+        json.dump(workspace, f)
+
+
+# the body of an Events API callback for a message, as Slack would send it
+# mention puts an @-mention of that user id in front of the text, the way the
+# bot's mention detection expects it; a message with user=None is from an integration
+def message_event(channel, text, user="U00001", ts=None, thread_ts=None, parent_user_id=None,
+                  mention=None, team_id="T0FAKE"):
+    ts = ts or f"{time.time():.6f}"
+    event = {"type": "message", "channel": channel, "user": user, "text": text, "ts": ts, "event_ts": ts}
+    if user is None:
+        del event["user"]
+        event.update(bot_message_fields("deploybot"))
+    if mention:
+        event["text"] = f"<@{mention}> {text}"
+        event["blocks"] = [{"type": "rich_text", "elements": [{"type": "rich_text_section", "elements": [
+            {"type": "user", "user_id": mention},
+            {"type": "text", "text": " " + text},
+        ]}]}]
+    if thread_ts:
+        event["thread_ts"] = thread_ts
+        event["parent_user_id"] = parent_user_id
+    return {
+        "type": "event_callback",
+        "team_id": team_id,
+        "api_app_id": "A0FAKE",
+        "event_id": "Ev" + uuid.uuid4().hex[:12].upper(),
+        "event_time": int(float(ts)),
+        "event": event,
+    }
+
+
+# what an integration's message has in place of a user
+def bot_message_fields(name):
+    return {"subtype": "bot_message", "username": name, "bot_id": "B0" + name.upper()[:8],
+            "bot_profile": {"name": name}}
+
+
+# the raw body and headers of a request signed the way Slack signs them
+def signed_request(payload, signing_secret):
+    body = json.dumps(payload)
+    timestamp = str(int(time.time()))
+    signature = hmac.new(signing_secret.encode(), f"v0:{timestamp}:{body}".encode(), hashlib.sha256).hexdigest()
+    headers = {
+        "Content-Type": "application/json",
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": "v0=" + signature,
+    }
+    return body, headers
+
+
+class FakeSlack:
+    def __init__(self, workspace, port=0, latency=0.0, rate_limits=None, rate_window=60):
+        self.workspace = workspace
+        self.latency = latency
+        # method name -> calls allowed per rate_window seconds before we answer 429
+        self.rate_limits = rate_limits or {}
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.calls = collections.Counter()
+        self.rate_limited = collections.Counter()
+        self.recent = collections.defaultdict(collections.deque)
+        self.posted = []
+        # called with each message the bot posts, e.g. to measure answer latency
+        self.on_post = []
+        # and with each edit to one of them
+        self.on_update = []
+        self.ts_counter = itertools.count()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with fake.lock:
+                    fake.connections += 1
+
+            def do_GET(self):
+                self._handle(b"")
+
+            def do_POST(self):
+                self._handle(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+
+            def _handle(self, body):
+                url = urllib.parse.urlparse(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                args = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+                if body:
+                    if self.headers.get("Content-Type", "").startswith("application/json"):
+                        args.update(json.loads(body))
+                    else:
+                        args.update({k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()})
+                status, headers, payload = fake.call(method, args)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path) as f:
+            return cls(json.load(f), **kwargs)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/api/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-slack", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # answer one API call: returns (HTTP status, extra headers, JSON payload)
+    def call(self, method, args):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[method] += 1
+            limit = self.rate_limits.get(method)
+            if limit:
+                now = time.monotonic()
+                recent = self.recent[method]
+                while recent and recent[0] < now - self.rate_window:
+                    recent.popleft()
+                if len(recent) >= limit:
+                    self.rate_limited[method] += 1
+                    retry_after = max(1, int(recent[0] + self.rate_window - now) + 1)
+                    return 429, {"Retry-After": str(retry_after)}, {"ok": False, "error": "ratelimited"}
+                recent.append(now)
+        handler = getattr(self, "api_" + method.replace(".", "_"), None)
+        if handler is None:
+            return 200, {}, {"ok": False, "error": "unknown_method"}
+        try:
+            return 200, {}, dict({"ok": True}, **handler(args))
+        except KeyError as e:
+            return 200, {}, {"ok": False, "error": f"not_found: {e}"}
+
+    # a cursor is just the offset of the next page
+    def _page(self, items, args, key, default_limit=100):
+        offset = int(args.get("cursor") or 0)
+        limit = int(args.get("limit") or default_limit)
+        page = items[offset:offset + limit]
+        next_offset = offset + limit
+        has_more = next_offset < len(items)
+        return {
+            key: page,
+            "has_more": has_more,
+            "response_metadata": {"next_cursor": str(next_offset) if has_more else ""},
+        }
+
+    def _channel(self, channel_id):
+        for channel in self.workspace["channels"]:
+            if channel["id"] == channel_id:
+                return channel
+        raise KeyError(channel_id)
+
+    def api_auth_test(self, args):
+        return {
+            "user_id": self.workspace["bot_user_id"],
+            "team_id": self.workspace["team_id"],
+            "user": "owlbot",
+            "bot_id": "B0BOT",
+            "url": "https://fake.slack.com/",
+        }
+
+    def api_conversations_list(self, args):
+        return self._page(self.workspace["channels"], args, "channels")
+
+    def api_conversations_info(self, args):
+        return {"channel": self._channel(args["channel"])}
+
+    def api_conversations_join(self, args):
+        return {"channel": self._channel(args["channel"])}
+
+    def api_conversations_history(self, args):
+        return self._page(self.workspace["history"][args["channel"]], args, "messages")
+
+    def api_conversations_replies(self, args):
+        channel_id = args["channel"]
+        thread_ts = args["ts"]
+        parent = next((m for m in self.workspace["history"][channel_id] if m["ts"] == thread_ts), None)
+        thread = self.workspace["replies"][channel_id].get(thread_ts, [])
+        return self._page(([parent] if parent else []) + thread, args, "messages")
+
+    def api_users_list(self, args):
+        return self._page(self.workspace["users"], args, "members")
+
+    def api_users_info(self, args):
+        for user in self.workspace["users"]:
+            if user["id"] == args["user"]:
+                return {"user": user}
+        raise KeyError(args["user"])
+
+    def _next_ts(self):
+        return f"{time.time():.0f}.{next(self.ts_counter):06d}"
+
+    def api_chat_postMessage(self, args):
+        channel_id = args["channel"]
+        self._channel(channel_id)
+        message = {"type": "message", "ts": self._next_ts(), "user": self.workspace["bot_user_id"], "text": args.get("text", "")}
+        if args.get("thread_ts"):
+            message["thread_ts"] = args["thread_ts"]
+        with self.lock:
+            self.posted.append(dict(message, channel=channel_id, posted_at=time.time()))
+            if message.get("thread_ts"):
+                self.workspace["replies"][channel_id].setdefault(message["thread_ts"], []).append(message)
+            else:
+                self.workspace["history"][channel_id].insert(0, message)
+        for callback in self.on_post:
+            callback(channel_id, message)
+        return {"channel": channel_id, "ts": message["ts"], "message": message}
+
+    def api_chat_update(self, args):
+        with self.lock:
+            for message in self.posted:
+                if message["channel"] == args["channel"] and message["ts"] == args["ts"]:
+                    message["text"] = args.get("text", "")
+                    message["updated_at"] = time.time()
+                    break
+            else:
+                raise KeyError(args["ts"])
+        for callback in self.on_update:
+            callback(args["channel"], message)
+        return {"channel": args["channel"], "ts": args["ts"], "text": message["text"]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=3001)
+    parser.add_argument("--workspace", help="a JSON file saved by record_workspace")
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=500)
+    args = parser.parse_args()
+    if args.workspace:
+        fake = FakeSlack.from_file(args.workspace, port=args.port)
+    else:
+        fake = FakeSlack(synthetic_workspace(args.channels, args.messages), port=args.port)
+    print(f"Fake Slack API listening at {fake.base_url}")
+    fake.server.serve_forever()
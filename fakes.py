@@ -0,0 +1,91 @@
+# stand-ins for the OpenAI models so the benchmarks can run offline
+# the embedding is a deterministic hashed bag of words, so texts that share
+# words are similar to each other; the LLM waits a fixed time and then returns
+# a canned answer
+import asyncio, hashlib, math, re, threading, time
+from typing import Any, List
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.llms import CustomLLM, CompletionResponse, CompletionResponseGen, LLMMetadata
+from llama_index.llms.base import llm_completion_callback
+
+WORD = re.compile(r"\w+")
+
+
+class FakeEmbedding(BaseEmbedding):
+    dim: int = 256
+
+    def __init__(self, dim: int = 256, **kwargs: Any) -> None:
+        super().__init__(dim=dim, model_name="fake-embedding", **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeEmbedding"
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for word in WORD.findall(text.lower()):
+            digest = hashlib.md5(word.encode()).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] % 2 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class FakeLLM(CustomLLM):
+    latency: float = 0.0
+    answer: str = "From what I've heard in this channel, the answer is 42."
+    # how many times we've been asked, so a benchmark can check every question got here
+    calls: int = 0
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def _count(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=16384, num_output=256, model_name="fake-llm")
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        self._count()
+        time.sleep(self.latency)
+        return CompletionResponse(text=self.answer)
+
+    # waits without blocking the event loop, like a real async API call
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        self._count()
+        await asyncio.sleep(self.latency)
+        return CompletionResponse(text=self.answer)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, **kwargs: Any) -> CompletionResponseGen:
+        self._count()
+        words = self.answer.split(" ")
+        # spread the latency over the answer so streaming looks like streaming
+        delay = self.latency / len(words)
+
+        def gen() -> CompletionResponseGen:
+            text = ""
+            for i, word in enumerate(words):
+                time.sleep(delay)
+                delta = word if i == 0 else " " + word
+                text += delta
+                yield CompletionResponse(text=text, delta=delta)
+
+        return gen()
@@ -0,0 +1,46 @@
+# gunicorn settings for the Flask bot, so starting workers is quick
+#
+#   gunicorn -c gunicorn.conf.py
+#
+# Before it forks any workers, gunicorn's master process does the slow parts once:
+# it imports llama_index and friends (the workers inherit them, already imported),
+# and asks Slack who the bot is and joins its channels, saving the answers in the
+# bootstrap cache (see bootstrap.py) for the workers to read. Each worker then
+# serves lazy_app.app, which is up straight away and loads the bot in the background.
+# Nothing that opens a connection, a file or a thread is left open in the master,
+# since they don't survive a fork
+import os
+
+wsgi_app = "lazy_app:app"
+bind = f"0.0.0.0:{os.environ.get('PORT', 3000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+# loading the bot happens after a worker has booted, so this only has to cover answering
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+
+
+def on_starting(server):
+    from lazy_app import preload_imports
+    server.log.info(f"Preloaded libraries in {preload_imports():.2f}s")
+    try:
+        warm_bootstrap()
+    except Exception as e:
+        # the workers will ask Slack themselves
+        server.log.warning(f"Could not fetch bootstrap data from Slack: {e!r}")
+
+
+def warm_bootstrap():
+    import dotenv
+    dotenv.load_dotenv()
+    from slack_sdk import WebClient
+    from bootstrap import BootstrapCache
+    from channels import bot_channels_from_env, find_channels
+    # a plain client, which doesn't keep connections open to hand down to the workers
+    client = WebClient(token=os.environ.get("SLACK_BOT_TOKEN"), base_url=os.environ.get("SLACK_API_URL", WebClient.BASE_URL))
+    bootstrap = BootstrapCache.from_env()
+    bootstrap.auth(client)
+    names, all_channels = bot_channels_from_env()
+    bootstrap.channels(client, names, all_channels, find_channels)
+
+
+def post_worker_init(worker):
+    worker.wsgi.start()
@@ -0,0 +1,229 @@
+# the indexer: one process that does all the writing to the index
+# when several web workers share a Qdrant server, each of them can search it
+# directly, but it's better if writes go through one place: every worker's
+# messages end up in the same batches, and only one process pays for embedding.
+# Workers send their nodes here over a Unix socket with RemoteIngest, which
+# works just like IngestBuffer. Each line is a node as JSON, or {"delete": [ids]}
+#
+# New, edited and deleted messages are sent as they came from Slack, as
+# {"message": message, "user_name": name}, {"edited": message} or {"deleted": message},
+# and put into conversation windows here: a channel's messages reach whichever
+# worker Slack happens to send them to, so only the indexer sees all of them, and
+# only it can build the windows and link them up in order (see windows.py)
+#
+#   QDRANT_URL=http://localhost:6333 python indexer.py
+import dotenv
+dotenv.load_dotenv()
+
+import json, os, socket, socketserver, threading
+from llama_index import VectorStoreIndex, StorageContext
+from llama_index.schema import TextNode
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+
+from ingest import IngestBuffer
+from message_sync import MessageSync
+from windows import ConversationWindows
+from storage import ensure_collection, make_client
+from embedding_cache import cached_service_context
+from retention import retention_from_env
+from keyword_index import keyword_index_from_env
+
+SOCKET_PATH = os.environ.get("INDEXER_SOCKET", "/tmp/owl-indexer.sock")
+
+
+# the web worker's end: sends each node as a line of JSON
+class RemoteIngest:
+    def __init__(self, path=SOCKET_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sock = None
+        self.sent = 0
+        self.failed = 0
+        # called with each node we send; the indexer stores it a moment later
+        self.listeners = []
+        # and with the ids of nodes we ask it to delete
+        self.delete_listeners = []
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    # if the indexer falls behind, the socket fills up and this blocks, which is the backpressure we want
+    def add(self, node):
+        if not self._send(node.to_json().encode() + b"\n"):
+            return False
+        for listener in self.listeners:
+            try:
+                listener([node])
+            except Exception as e:
+                print("Ingest listener failed:", repr(e))
+        return True
+
+    def delete(self, node_ids):
+        if not self._send(json.dumps({"delete": list(node_ids)}).encode() + b"\n"):
+            return False
+        for listener in self.delete_listeners:
+            try:
+                listener(node_ids)
+            except Exception as e:
+                print("Ingest listener failed:", repr(e))
+        return True
+
+    def _send(self, line):
+        with self.lock:
+            # try twice, in case the indexer was restarted since we connected
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.sock = self._connect()
+                    self.sock.sendall(line)
+                    self.sent += 1
+                    break
+                except OSError as e:
+                    if self.sock is not None:
+                        self.sock.close()
+                    self.sock = None
+                    if attempt == 1:
+                        print("Could not send message to the indexer:", e)
+            else:
+                self.failed += 1
+                return False
+        return True
+
+    # a new message, to be put into its window by the indexer
+    def add_message(self, message, user_name):
+        return self._send(json.dumps({"message": message, "user_name": user_name}).encode() + b"\n")
+
+    # an edited message, its new version with its channel
+    def edit_message(self, message):
+        return self._send(json.dumps({"edited": message}).encode() + b"\n")
+
+    # a deleted message, its last version with its channel
+    def delete_message(self, message):
+        return self._send(json.dumps({"deleted": message}).encode() + b"\n")
+
+    def stats(self):
+        with self.lock:
+            return {"indexer": self.path, "sent": self.sent, "failed": self.failed}
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+
+# stands in for ConversationWindows in a web worker: the indexer builds the windows,
+# so there are no nodes for the worker to store itself
+class RemoteWindows:
+    def __init__(self, remote):
+        self.remote = remote
+
+    def add(self, message, user_name):
+        self.remote.add_message(message, user_name)
+        return []
+
+    def stats(self):
+        return {"built_by": "indexer"}
+
+
+# and for MessageSync; which nodes an edit or delete changes is only known to the indexer
+class RemoteSync:
+    def __init__(self, remote):
+        self.remote = remote
+
+    def edit(self, message):
+        self.remote.edit_message(message)
+        return []
+
+    def delete(self, message):
+        self.remote.delete_message(message)
+        return []
+
+    def stats(self):
+        return {"applied_by": "indexer"}
+
+
+# the indexer's end: reads nodes and messages from any number of workers into one IngestBuffer
+class IndexerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, ingest_buffer, windows, message_sync):
+        self.ingest_buffer = ingest_buffer
+        self.windows = windows
+        self.message_sync = message_sync
+        # a socket left behind by an indexer that didn't shut down cleanly
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, IndexerHandler)
+
+
+class IndexerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                data = json.loads(line)
+                node = None if data.keys() & {"message", "edited", "deleted", "delete"} else TextNode.from_dict(data)
+            except Exception as e:
+                print("Indexer got a message it couldn't read:", e)
+                continue
+            try:
+                self.apply(data, node)
+            except Exception as e:
+                print("Indexer couldn't store a message:", repr(e))
+
+    def apply(self, data, node):
+        server = self.server
+        if node is not None:
+            server.ingest_buffer.add(node)
+        elif "message" in data:
+            for node in server.windows.add(data["message"], data["user_name"]):
+                server.ingest_buffer.add(node)
+        elif "edited" in data:
+            server.message_sync.edit(data["edited"])
+        elif "deleted" in data:
+            server.message_sync.delete(data["deleted"])
+        else:
+            server.ingest_buffer.delete(data["delete"])
+
+
+if __name__ == "__main__":
+    client = make_client()
+    ensure_collection(client, "slack_messages", int(os.environ.get("EMBEDDING_DIM", 1536)))
+    vector_store = QdrantVectorStore(client=client, collection_name="slack_messages")
+    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    index = VectorStoreIndex([], storage_context=storage_context, service_context=cached_service_context())
+    ingest_buffer = IngestBuffer(
+        index,
+        max_batch=int(os.environ.get("INGEST_BATCH_SIZE", 32)),
+        max_delay=float(os.environ.get("INGEST_MAX_DELAY", 2.0)),
+        max_pending=int(os.environ.get("INGEST_MAX_PENDING", 1000))
+    )
+    # the bots search the keyword index, but only we add to it
+    keyword_index = keyword_index_from_env()
+    if keyword_index is not None:
+        ingest_buffer.listeners.append(keyword_index.add)
+        ingest_buffer.delete_listeners.append(keyword_index.delete)
+    # the indexer is the only process that writes, so it's also the one that forgets old messages
+    retention = retention_from_env(client, "slack_messages", index.service_context, vector_store)
+    if retention is not None:
+        retention.start()
+    # the same INGEST_WINDOW_* settings the bots use when they store messages themselves
+    window_size = int(os.environ.get("INGEST_WINDOW_SIZE", 1))
+    windows = ConversationWindows(
+        size=window_size,
+        overlap=int(os.environ.get("INGEST_WINDOW_OVERLAP", min(2, window_size - 1))),
+        max_gap_seconds=float(os.environ.get("INGEST_WINDOW_GAP", 900))
+    )
+    message_sync = MessageSync(client, "slack_messages", windows, ingest_buffer)
+    server = IndexerServer(SOCKET_PATH, ingest_buffer, windows, message_sync)
+    print(f"Indexer listening on {SOCKET_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(SOCKET_PATH)
+        ingest_buffer.close()
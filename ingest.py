@@ -0,0 +1,172 @@
+# batches up messages on their way into the index
+# embedding and writing one message at a time costs an embedding API round trip
+# and a Qdrant write per message; instead we collect nodes and flush them when
+# we have enough of them or they've waited long enough, embedding each batch in
+# one call and writing it to Qdrant in one upsert
+# Deletes go through the same queue, so an edit and a delete of the same message
+# are applied in the order they happened: in each batch, the last thing queued
+# for a node id wins
+import atexit, queue, threading, time
+from qdrant_client.http import models
+from llama_index.schema import MetadataMode
+
+
+# queued in place of a node to delete it instead
+class Deletion:
+    def __init__(self, node_id):
+        self.node_id = node_id
+
+
+class IngestBuffer:
+    def __init__(self, index, max_batch=32, max_delay=2.0, max_pending=1000, put_timeout=5.0):
+        self.index = index
+        self.embed_model = index.service_context.embed_model
+        # the embedding model splits batches into embed_batch_size chunks, one request each
+        if self.embed_model.embed_batch_size < max_batch:
+            self.embed_model.embed_batch_size = max_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.put_timeout = put_timeout
+        # bounded, so a slow embedding API pushes back on the handlers instead of eating memory
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.nodes = 0
+        self.deleted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.last_batch_size = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+        self.closed = False
+        # called with each batch once it's stored, e.g. to drop cached answers it makes stale
+        self.listeners = []
+        # called with the ids of each batch of deleted nodes
+        self.delete_listeners = []
+        self.thread = threading.Thread(target=self._run, name="ingest-flusher", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # queue a node to be stored; blocks for up to put_timeout if we're backed up
+    def add(self, node):
+        if self.closed:
+            raise RuntimeError("IngestBuffer is closed")
+        try:
+            self.pending.put(node, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            print("Ingest buffer is full, dropping message", node.node_id)
+            return False
+
+    # queue nodes to be deleted; deleting one that isn't there is a no-op
+    def delete(self, node_ids):
+        return all([self.add(Deletion(node_id)) for node_id in node_ids])
+
+    def _run(self):
+        while True:
+            node = self.pending.get()
+            if node is None:
+                return
+            batch = [node]
+            deadline = time.monotonic() + self.max_delay
+            stopping = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    node = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if node is None:
+                    stopping = True
+                    break
+                batch.append(node)
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch):
+        try:
+            self.store(batch)
+        except Exception as e:
+            print(f"Failed to store a batch of {len(batch)} messages:", repr(e))
+
+    # store a batch of nodes and deletions now, on this thread; raises if it couldn't
+    # the write-ahead log (see wal.py) stores what it logged this way, so it can try again
+    def store(self, batch):
+        started = time.monotonic()
+        # a conversation window that grew while it waited only needs storing once, as it is now
+        latest = list({node.node_id: node for node in batch}.values())
+        deletes = [item.node_id for item in latest if isinstance(item, Deletion)]
+        batch = [item for item in latest if not isinstance(item, Deletion)]
+        if deletes:
+            self._delete(deletes)
+        if not batch:
+            return
+        try:
+            texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+            embeddings = self.embed_model.get_text_embedding_batch(texts)
+            for node, embedding in zip(batch, embeddings):
+                node.embedding = embedding
+            # nodes that already have embeddings go straight to the vector store
+            self.index.insert_nodes(batch)
+        except Exception:
+            with self.lock:
+                self.failed += len(batch)
+            raise
+        elapsed = time.monotonic() - started
+        with self.lock:
+            self.batches += 1
+            self.nodes += len(batch)
+            self.last_batch_size = len(batch)
+            self.flush_seconds_total += elapsed
+            self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+        print(f"Stored {len(batch)} messages in {elapsed:.2f}s")
+        for listener in self.listeners:
+            try:
+                listener(batch)
+            except Exception as e:
+                print("Ingest listener failed:", repr(e))
+
+    def _delete(self, node_ids):
+        vector_store = self.index.vector_store
+        try:
+            vector_store.client.delete(vector_store.collection_name, points_selector=models.PointIdsList(points=node_ids))
+        except Exception:
+            with self.lock:
+                self.failed += len(node_ids)
+            raise
+        with self.lock:
+            self.deleted += len(node_ids)
+        print(f"Deleted {len(node_ids)} messages")
+        for listener in self.delete_listeners:
+            try:
+                listener(node_ids)
+            except Exception as e:
+                print("Ingest listener failed:", repr(e))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": self.pending.qsize(),
+                "batches": self.batches,
+                "nodes": self.nodes,
+                "deleted": self.deleted,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "batch_size_avg": self.nodes / self.batches if self.batches else 0.0,
+                "batch_size_last": self.last_batch_size,
+                "flush_seconds_avg": self.flush_seconds_total / self.batches if self.batches else 0.0,
+                "flush_seconds_max": self.flush_seconds_max,
+            }
+
+    # stop taking new nodes and flush everything that's waiting
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.thread.join()
@@ -0,0 +1,117 @@
+# a keyword index over stored messages, for the questions embeddings are bad at
+# "what's happening with JIRA-1234?" or "who owns db-7.prod.internal?" hinge on
+# one exact token, and a similarity search happily returns messages about some
+# other ticket. This is a BM25 index (SQLite's FTS5) of every message we store,
+# kept up to date as batches are stored; SlackRetriever fuses its results with
+# the vector search.
+#
+# Tokens like JIRA-1234, db-7.prod.internal, @logan or src/app.py are kept whole,
+# and their parts are indexed too, so "jira" still finds JIRA-1234
+import os, re, sqlite3, threading
+from llama_index.schema import MetadataMode
+
+# a run of word characters, joined by the punctuation that turns up inside ids,
+# hostnames, handles and paths, but not ending in it (so "deploy." is just "deploy")
+TOKEN = re.compile(r"[@#]?\w+(?:[-_.@/:#]\w+)*")
+PARTS = re.compile(r"\w+")
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN.findall((text or "").lower()):
+        tokens.append(token)
+        parts = PARTS.findall(token)
+        if len(parts) > 1 or parts[0] != token:
+            tokens.extend(parts)
+    return tokens
+
+
+class KeywordIndex:
+    def __init__(self, path=":memory:"):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(messages)")]
+        if columns and "channel_id" not in columns:
+            # made before we kept channels; nodes are indexed again as they're stored
+            print("Keyword index has no channels, starting it again")
+            self.db.execute("DROP TABLE messages")
+            self.db.execute("DROP TABLE IF EXISTS node_ids")
+        # we tokenize ourselves; FTS5 just has to leave our tokens alone
+        self.db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+            "node_id UNINDEXED, channel_id UNINDEXED, tokens, tokenize=\"unicode61 tokenchars '-_.@/:#'\")"
+        )
+        # FTS5 can't index node_id, so finding a node's row by it reads the whole table;
+        # this keeps each node's rowid in messages, so re-indexing and deleting find it directly
+        tables = {row[0] for row in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if "node_ids" not in tables:
+            self.db.execute("BEGIN")
+            self.db.execute("CREATE TABLE node_ids (node_id TEXT PRIMARY KEY, row INTEGER NOT NULL) WITHOUT ROWID")
+            self.db.execute("INSERT OR REPLACE INTO node_ids SELECT node_id, rowid FROM messages")
+            self.db.execute("COMMIT")
+        self.added = 0
+        self.deleted = 0
+        self.searches = 0
+
+    # index (or re-index) a batch of nodes; the signature fits IngestBuffer.listeners
+    def add(self, nodes):
+        # the last version of each node wins, if a batch has one more than once
+        rows = list({node.node_id: (node.node_id, node.metadata.get("channel_id"), " ".join(tokenize(node.get_content(metadata_mode=MetadataMode.EMBED))))
+                     for node in nodes}.values())
+        with self.lock:
+            self.db.execute("BEGIN")
+            self._delete([row[0] for row in rows])
+            for row in rows:
+                rowid = self.db.execute("INSERT INTO messages (node_id, channel_id, tokens) VALUES (?, ?, ?)", row).lastrowid
+                self.db.execute("INSERT INTO node_ids (node_id, row) VALUES (?, ?)", (row[0], rowid))
+            self.db.execute("COMMIT")
+            self.added += len(rows)
+
+    def delete(self, node_ids):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self._delete(node_ids)
+            self.db.execute("COMMIT")
+            self.deleted += len(node_ids)
+
+    # called with the lock held, inside a transaction
+    def _delete(self, node_ids):
+        for node_id in node_ids:
+            found = self.db.execute("SELECT row FROM node_ids WHERE node_id = ?", (node_id,)).fetchone()
+            if found is not None:
+                self.db.execute("DELETE FROM messages WHERE rowid = ?", found)
+                self.db.execute("DELETE FROM node_ids WHERE node_id = ?", (node_id,))
+
+    # the best matching node ids, best first, only from channel_ids if that's given
+    # (and from no channel, for nodes stored before we kept channels, as in SlackRetriever)
+    def search(self, query, limit=20, channel_ids=None):
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens or channel_ids == []:
+            return []
+        match = " OR ".join('"' + token + '"' for token in tokens)
+        sql, params = "SELECT node_id FROM messages WHERE messages MATCH ?", [match]
+        if channel_ids is not None:
+            sql += f" AND (channel_id IN ({', '.join('?' * len(channel_ids))}) OR channel_id IS NULL)"
+            params.extend(channel_ids)
+        with self.lock:
+            self.searches += 1
+            rows = self.db.execute(sql + " ORDER BY bm25(messages) LIMIT ?", params + [limit]).fetchall()
+        return [node_id for node_id, in rows]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+                "added": self.added,
+                "deleted": self.deleted,
+                "searches": self.searches,
+            }
+
+
+# the index in KEYWORD_INDEX_DB (./keyword_index.db by default), or None if that's set to ""
+# the bot and indexer.py can share the file; whichever one stores messages keeps it up to date
+def keyword_index_from_env():
+    path = os.environ.get("KEYWORD_INDEX_DB", "./keyword_index.db")
+    return KeywordIndex(path) if path else None
@@ -0,0 +1,94 @@
+# a WSGI app that starts straight away and loads the bot behind it in the background
+# importing 8_rest_of_the_owl.py takes seconds: llama_index is big, and the bot opens
+# Qdrant and builds its query engines before it can serve anything. Run under gunicorn,
+# every worker paid that before it answered a request, and a worker that took too long
+# to boot was killed and started again. This app is ready as soon as it's imported:
+#   GET /healthz answers right away, "ok" once the bot is loaded and "loading" until then
+#   everything else waits for the bot to finish loading, then goes to its Flask app
+# start() begins loading without waiting for a request; gunicorn.conf.py calls it in
+# every worker, after doing the slow imports once in gunicorn's master process.
+# BOT_APP is the file to load (default 8_rest_of_the_owl.py, or app.py when deployed)
+#
+#   gunicorn -c gunicorn.conf.py
+import importlib, importlib.util, os, sys, threading, time
+
+# imported once before gunicorn forks its workers, which then already have them
+HEAVY_MODULES = (
+    "llama_index",
+    "llama_index.vector_stores.qdrant",
+    "qdrant_client",
+    "openai",
+    "tiktoken",
+    "slack_bolt",
+    "slack_bolt.adapter.flask",
+    "slack_sdk",
+    "flask",
+)
+
+
+def preload_imports(modules=HEAVY_MODULES):
+    started = time.perf_counter()
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f"Could not preload {name}:", e)
+    return time.perf_counter() - started
+
+
+class LazyApp:
+    def __init__(self, path, attribute="flask_app", module_name="owl_app"):
+        self.path = path
+        self.attribute = attribute
+        self.module_name = module_name
+        self.lock = threading.Lock()
+        self.app = None
+        self.error = None
+        self.load_seconds = None
+
+    # the bot's Flask app, loading it if nobody has yet
+    # if loading failed (say Slack was down), the next request tries again
+    def load(self):
+        with self.lock:
+            if self.app is None:
+                started = time.perf_counter()
+                try:
+                    spec = importlib.util.spec_from_file_location(self.module_name, self.path)
+                    module = importlib.util.module_from_spec(spec)
+                    sys.modules[self.module_name] = module
+                    spec.loader.exec_module(module)
+                    self.app = getattr(module, self.attribute)
+                    self.error = None
+                except Exception as e:
+                    sys.modules.pop(self.module_name, None)
+                    self.error = e
+                    raise
+                self.load_seconds = time.perf_counter() - started
+                print(f"Loaded {self.path} in {self.load_seconds:.2f}s")
+            return self.app
+
+    # load in the background, so the first request doesn't have to
+    def start(self):
+        def load():
+            try:
+                self.load()
+            except Exception as e:
+                print(f"Could not load {self.path}, will try again on the next request:", repr(e))
+        threading.Thread(target=load, name="load-bot", daemon=True).start()
+        return self
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") == "/healthz":
+            body = b"ok" if self.app is not None else b"loading"
+            start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+            return [body]
+        try:
+            app = self.load()
+        except Exception:
+            body = b"still starting up"
+            start_response("503 Service Unavailable", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+            return [body]
+        return app(environ, start_response)
+
+
+app = LazyApp(os.environ.get("BOT_APP", "8_rest_of_the_owl.py"))
@@ -0,0 +1,117 @@
+# keeps what we've stored in step with messages being edited and deleted in Slack
+# reply() only ever sees new messages, so an edit left the old text searchable
+# and a deleted message stayed in the index forever. Messages are found by
+# (channel, ts): a single message by its id, conversation windows by the
+# message_ts they keep. For an edit, only the nodes with that message in them are
+# changed and re-stored (re-embedded, in place); for a delete, the message is cut
+# out of its windows, nodes left empty are deleted, and their neighbors are
+# relinked past them. Everything goes through the ingest buffer, so it's stored
+# in batches and in order with new messages.
+#
+# Applying the same edit or delete twice changes nothing, so Slack redelivering
+# an event is harmless. The write-ahead log (see wal.py) passes a sink, to collect
+# the changes and store them itself, in place of the ingest buffer
+import threading
+from qdrant_client.http import models
+from llama_index.vector_stores.utils import metadata_dict_to_node
+
+from slack_nodes import node_id_for
+from windows import edit_node, remove_from_node, unlink
+
+
+class MessageSync:
+    def __init__(self, client, collection_name, windows, ingest_buffer):
+        self.client = client
+        self.collection_name = collection_name
+        # the windows still being filled, which aren't stored as they are yet
+        self.windows = windows
+        self.ingest_buffer = ingest_buffer
+        self.lock = threading.Lock()
+        self.edits = 0
+        self.deletes = 0
+        self.nodes_updated = 0
+        self.nodes_deleted = 0
+
+    # the stored nodes that have the message sent at ts in them
+    def _stored(self, channel, ts):
+        windows, _ = self.client.scroll(
+            self.collection_name,
+            scroll_filter=models.Filter(must=[
+                models.FieldCondition(key="channel_id", match=models.MatchValue(value=channel)),
+                models.FieldCondition(key="message_ts", match=models.MatchValue(value=ts)),
+            ]),
+            limit=16,
+            with_payload=True,
+        )
+        single = self.client.retrieve(self.collection_name, ids=[node_id_for(channel, ts)], with_payload=True)
+        return [metadata_dict_to_node(point.payload) for point in windows + single]
+
+    # a message was edited; message is the new version, with its channel
+    # returns the ids of the nodes that changed
+    def edit(self, message, sink=None):
+        sink = sink or self.ingest_buffer
+        ts, text = message.get('ts'), message.get('text')
+        changed = {}
+        for node in self._stored(message.get('channel'), ts):
+            edited = edit_node(node, ts, text)
+            if edited.text != node.text:
+                changed[edited.node_id] = edited
+        # windows we're still filling are newer than what's stored
+        for node in self.windows.edit(message):
+            changed[node.node_id] = node
+        for node in changed.values():
+            sink.add(node)
+        with self.lock:
+            self.edits += 1
+            self.nodes_updated += len(changed)
+        return list(changed)
+
+    # a message was deleted; message is the last version of it, with its channel
+    # returns the ids of the nodes that changed or were deleted
+    def delete(self, message, sink=None):
+        sink = sink or self.ingest_buffer
+        ts = message.get('ts')
+        changed, removed = {}, {}
+        for node in self._stored(message.get('channel'), ts):
+            remaining = remove_from_node(node, ts)
+            if remaining is None:
+                removed[node.node_id] = node
+            else:
+                changed[remaining.node_id] = remaining
+        # whatever linked to a deleted node now links past it
+        def relink(node):
+            for gone in removed.values():
+                node = unlink(node, gone) or node
+            return node
+        changed = {node_id: relink(node) for node_id, node in changed.items()}
+        neighbor_ids = {related.node_id for node in removed.values() for related in (node.prev_node, node.next_node)
+                        if related is not None and related.node_id not in removed and related.node_id not in changed}
+        if neighbor_ids:
+            for point in self.client.retrieve(self.collection_name, ids=list(neighbor_ids), with_payload=True):
+                neighbor = metadata_dict_to_node(point.payload)
+                relinked = relink(neighbor)
+                if relinked is not neighbor:
+                    changed[relinked.node_id] = relinked
+        in_memory, emptied = self.windows.remove(message)
+        for node in in_memory:
+            changed[node.node_id] = node
+        deleted = set(removed) | set(emptied)
+        changed = {node_id: node for node_id, node in changed.items() if node_id not in deleted}
+        for node in changed.values():
+            sink.add(node)
+        if deleted:
+            sink.delete(list(deleted))
+        with self.lock:
+            self.deletes += 1
+            self.nodes_updated += len(changed)
+            self.nodes_deleted += len(deleted)
+        return list(changed) + list(deleted)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "edits": self.edits,
+                "deletes": self.deletes,
+                "nodes_updated": self.nodes_updated,
+                "nodes_deleted": self.nodes_deleted,
+            }
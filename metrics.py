@@ -0,0 +1,177 @@
+# how long each stage of handling a message takes, in a form Prometheus can scrape
+# printing every event told us nothing about where the time goes (and printing a
+# big payload costs time itself). Instead, each stage is timed into a histogram:
+#   mention_detection, user_lookup, thread_fetch, slack_post: timed by the bot itself
+#   embedding, vector_search, llm, synthesize: timed from llama_index's callback
+#       events by MetricsHandler
+#   postprocessing: NeighborExpander, ContextPacker and friends, timed by TimedPostprocessor
+# render() writes them out in Prometheus' text format, along with any numbers
+# from /stats as gauges. PayloadLog prints a sample of incoming events, cut short,
+# for when you do need to see one
+import bisect, contextlib, json, random, threading, time
+from typing import Any, Dict, List, Optional
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import NodeWithScore, QueryBundle
+
+# seconds; from a cache hit to a slow LLM call
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# llama_index events we time, and the stage each one counts as
+EVENT_STAGES = {
+    CBEventType.EMBEDDING: "embedding",
+    CBEventType.RETRIEVE: "vector_search",
+    CBEventType.LLM: "llm",
+    CBEventType.SYNTHESIZE: "synthesize",
+}
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, prefix="slack_bot", buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # stage -> Histogram, in the order stages were first seen
+        self.stages = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    # with metrics.span("user_lookup"): ...
+    @contextlib.contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    # the histograms, and the numbers in gauges (like the /stats dict), as Prometheus text
+    def render(self, gauges=None):
+        name = f"{self.prefix}_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each stage of handling a message.",
+            f"# TYPE {name} histogram",
+        ]
+        with self.lock:
+            for stage, histogram in self.stages.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        if gauges:
+            name = f"{self.prefix}_stat"
+            lines.append(f"# HELP {name} Numbers from /stats.")
+            lines.append(f"# TYPE {name} gauge")
+            for path, value in _numbers(gauges):
+                lines.append(f'{name}{{name="{path}"}} {float(value)}')
+        return "\n".join(lines) + "\n"
+
+
+# ("dispatch.queued", 3) for every number in a nested dict
+def _numbers(values, prefix=""):
+    for key, value in values.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _numbers(value, path + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path, value
+
+
+# times llama_index's events into Metrics; add it to the service context's callback manager
+class MetricsHandler(BaseCallbackHandler):
+    def __init__(self, metrics):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        # event id -> when it started
+        self.started = {}
+
+    def on_event_start(self, event_type, payload=None, event_id="", parent_id="", **kwargs):
+        if event_type in EVENT_STAGES:
+            with self.lock:
+                self.started[event_id] = time.perf_counter()
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        if event_type in EVENT_STAGES:
+            with self.lock:
+                started = self.started.pop(event_id, None)
+            if started is not None:
+                self.metrics.observe(EVENT_STAGES[event_type], time.perf_counter() - started)
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
+
+
+# runs some postprocessors in order, timing them all as one stage
+class TimedPostprocessor(BaseNodePostprocessor):
+    _postprocessors: List[BaseNodePostprocessor] = PrivateAttr()
+    _metrics: Any = PrivateAttr()
+    _stage: str = PrivateAttr()
+
+    def __init__(self, postprocessors, metrics, stage="postprocessing", **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._postprocessors = list(postprocessors)
+        self._metrics = metrics
+        self._stage = stage
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TimedPostprocessor"
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        with self._metrics.span(self._stage):
+            for postprocessor in self._postprocessors:
+                nodes = postprocessor.postprocess_nodes(nodes, query_bundle)
+        return nodes
+
+
+# prints about one in every 1/rate payloads, cut to max_chars
+class PayloadLog:
+    def __init__(self, rate=0.01, max_chars=2000):
+        self.rate = rate
+        self.max_chars = max_chars
+        self.lock = threading.Lock()
+        self.seen = 0
+        self.logged = 0
+
+    def log(self, label, payload: Dict[str, Any]):
+        with self.lock:
+            self.seen += 1
+            if self.rate <= 0 or random.random() >= self.rate:
+                return
+            self.logged += 1
+        # only a sampled payload pays for being serialized
+        text = json.dumps(payload, default=str)
+        if len(text) > self.max_chars:
+            text = text[:self.max_chars] + f"... ({len(text)} chars)"
+        print(label, text)
+
+    def stats(self):
+        with self.lock:
+            return {"seen": self.seen, "logged": self.logged, "rate": self.rate}
@@ -0,0 +1,100 @@
+# a small pool of long-lived query engines
+# building a query engine (and the postprocessor and service context that go with
+# it) for every question is wasted work, so we build a few at startup and lend
+# them out. The parts of the prompt that change per question, like who is asking,
+# are template variables filled in for each query
+import asyncio, queue
+from llama_index.prompts import PromptTemplate
+from llama_index.postprocessor import FixedRecencyPostprocessor
+from llama_index.query_engine import RetrieverQueryEngine
+
+
+# RetrieverQueryEngine runs the node postprocessors right on the event loop in aquery,
+# and ours block: NeighborExpander reads Qdrant (waiting on the lock around the
+# embedded store) and ContextPacker counts tokens. So they run on a thread instead
+class ThreadedPostprocessingEngine(RetrieverQueryEngine):
+    async def aretrieve(self, query_bundle):
+        nodes = await self._retriever.aretrieve(query_bundle)
+        return await asyncio.to_thread(self._apply_node_postprocessors, nodes, query_bundle=query_bundle)
+
+
+class QueryEnginePool:
+    # with no retriever, engines use the index's own similarity search and sort
+    # the results by date with FixedRecencyPostprocessor; a retriever that already
+    # handles recency (like SlackRetriever) is shared by all the engines instead
+    # with streaming=True, use stream() instead of query()
+    # node_postprocessors run after retrieval, like ContextPacker choosing what fits in the prompt
+    def __init__(self, index, template, size=4, similarity_top_k=20, retriever=None, streaming=False, node_postprocessors=None):
+        self.template = PromptTemplate(template)
+        self.engines = queue.Queue()
+        for _ in range(size):
+            if retriever is None:
+                postprocessor = FixedRecencyPostprocessor(
+                    top_k=similarity_top_k,
+                    date_key="when", # the key in the metadata to find the date
+                    service_context=index.service_context
+                )
+                engine = ThreadedPostprocessingEngine.from_args(
+                    index.as_retriever(similarity_top_k=similarity_top_k),
+                    service_context=index.service_context,
+                    node_postprocessors=[postprocessor] + list(node_postprocessors or []),
+                    streaming=streaming
+                )
+            else:
+                engine = ThreadedPostprocessingEngine.from_args(
+                    retriever,
+                    service_context=index.service_context,
+                    node_postprocessors=list(node_postprocessors or []),
+                    streaming=streaming
+                )
+            self.engines.put(engine)
+
+    # answer a query; template_vars fill in the per-question parts of the prompt
+    def query(self, query, **template_vars):
+        # only one question uses an engine at a time, since we swap its prompt
+        engine = self.engines.get()
+        try:
+            engine.update_prompts(
+                {"response_synthesizer:text_qa_template": self.template.partial_format(**template_vars)}
+            )
+            return engine.query(query)
+        finally:
+            self.engines.put(engine)
+
+    # the same for asyncio
+    async def aquery(self, query, **template_vars):
+        try:
+            engine = self.engines.get_nowait()
+        except queue.Empty:
+            # every engine is busy; wait for one without blocking the event loop
+            engine = await asyncio.to_thread(self.engines.get)
+        try:
+            engine.update_prompts(
+                {"response_synthesizer:text_qa_template": self.template.partial_format(**template_vars)}
+            )
+            return await engine.aquery(query)
+        finally:
+            self.engines.put(engine)
+
+    # start answering a query, and return a StreamingResponse whose response_gen
+    # yields the answer a piece at a time; the engine is ours until that's been read
+    def stream(self, query, **template_vars):
+        engine = self.engines.get()
+        try:
+            engine.update_prompts(
+                {"response_synthesizer:text_qa_template": self.template.partial_format(**template_vars)}
+            )
+            response = engine.query(query)
+        except Exception:
+            self.engines.put(engine)
+            raise
+        tokens = response.response_gen
+
+        def read():
+            try:
+                yield from tokens
+            finally:
+                self.engines.put(engine)
+
+        response.response_gen = read()
+        return response
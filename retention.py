@@ -0,0 +1,229 @@
+# forgets old messages, and optionally squashes them into summaries first
+# nothing ever left the index before, so it (and search time) only ever grew,
+# while the prompt tells the LLM to prefer recent messages anyway. Two jobs
+# run on a background thread every `interval` seconds, so reply() never waits:
+#   TTL: messages older than their channel's time to live are deleted. Every
+#        channel gets default_days unless channel_days says otherwise
+#   compaction: once messages are older than compact_after_days, each day of
+#        each channel is replaced by summaries of up to group_size messages,
+#        written by the LLM. Summaries are searched like any other message and
+#        are never summarized again
+# Each run compacts at most max_days_per_run channel-days, so a big backlog
+# is worked through a bit at a time
+import datetime, os, threading, time, uuid
+from qdrant_client.http import models
+from llama_index.schema import MetadataMode, TextNode
+from llama_index.vector_stores.utils import metadata_dict_to_node
+
+from retrieval import message_time
+from slack_nodes import HIDDEN_METADATA, SLACK_NAMESPACE, format_ts
+
+DAY = 86400
+SUMMARY_PROMPT = (
+    "Below are chat messages from one Slack channel, oldest first, each starting with who said it and when.\n"
+    "Write a short summary that someone could search later. Keep names, decisions, dates, numbers, links\n"
+    "and anything people agreed to do. Leave out small talk.\n"
+    "---------------------\n"
+    "{messages}\n"
+    "---------------------\n"
+    "Summary:"
+)
+
+
+# "C0123=30,C0456=none" -> {"C0123": 30.0, "C0456": None}; none keeps that channel forever
+def parse_channel_days(text):
+    channel_days = {}
+    for part in (text or "").split(","):
+        if "=" in part:
+            channel, days = part.split("=", 1)
+            channel_days[channel.strip()] = None if days.strip().lower() in ("none", "") else float(days)
+    return channel_days
+
+
+def channel_condition(channel_id):
+    # messages stored before we recorded the channel have no channel_id at all
+    if channel_id is None:
+        return models.IsEmptyCondition(is_empty=models.PayloadField(key="channel_id"))
+    return models.FieldCondition(key="channel_id", match=models.MatchValue(value=channel_id))
+
+
+class Retention:
+    def __init__(self, client, collection_name, default_days=None, channel_days=None,
+                 compact_after_days=None, service_context=None, vector_store=None,
+                 group_size=50, max_days_per_run=10, interval=3600):
+        if compact_after_days is not None and (service_context is None or vector_store is None):
+            raise ValueError("compaction needs a service_context and a vector_store")
+        self.client = client
+        self.collection_name = collection_name
+        self.default_days = default_days
+        self.channel_days = channel_days or {}
+        self.compact_after_days = compact_after_days
+        self.service_context = service_context
+        self.vector_store = vector_store
+        self.group_size = group_size
+        self.max_days_per_run = max_days_per_run
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.expired = 0
+        self.compacted_messages = 0
+        self.summaries = 0
+        self.failed_runs = 0
+        self.last_run_seconds = 0.0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+
+    def _loop(self):
+        while not self.stopping.wait(self.interval):
+            started = time.monotonic()
+            try:
+                self.run_once()
+            except Exception as e:
+                print("Retention run failed:", repr(e))
+                with self.lock:
+                    self.failed_runs += 1
+            with self.lock:
+                self.last_run_seconds = time.monotonic() - started
+
+    def run_once(self, now=None):
+        now = now or time.time()
+        if self.compact_after_days is not None:
+            self.compact(now)
+        self.expire(now)
+        with self.lock:
+            self.runs += 1
+
+    # delete everything past its channel's TTL
+    def expire(self, now):
+        deletes = []
+        for channel_id, days in self.channel_days.items():
+            if days is not None:
+                deletes.append(models.Filter(must=[
+                    channel_condition(channel_id),
+                    models.FieldCondition(key="when_ts", range=models.Range(lt=now - days * DAY)),
+                ]))
+        if self.default_days is not None:
+            deletes.append(models.Filter(
+                must=[models.FieldCondition(key="when_ts", range=models.Range(lt=now - self.default_days * DAY))],
+                # channels with their own TTL (or none at all) were handled above
+                must_not=[channel_condition(channel_id) for channel_id in self.channel_days],
+            ))
+        for delete in deletes:
+            count = self.client.count(self.collection_name, count_filter=delete, exact=True).count
+            if count:
+                self.client.delete(self.collection_name, points_selector=models.FilterSelector(filter=delete))
+                print(f"Deleted {count} expired messages")
+            with self.lock:
+                self.expired += count
+
+    # old messages that haven't been summarized yet
+    def _uncompacted(self, before, extra=()):
+        return models.Filter(
+            must=[models.FieldCondition(key="when_ts", range=models.Range(lt=before))] + list(extra),
+            must_not=[models.FieldCondition(key="summary", match=models.MatchValue(value=True))],
+        )
+
+    # summarize up to max_days_per_run channel-days of old messages
+    def compact(self, now):
+        cutoff = now - self.compact_after_days * DAY
+        for _ in range(self.max_days_per_run):
+            # any old message will do; we compact the whole day around it
+            points, _ = self.client.scroll(
+                self.collection_name, scroll_filter=self._uncompacted(cutoff), limit=1, with_payload=True
+            )
+            if not points:
+                return
+            channel_id = points[0].payload.get("channel_id")
+            day = datetime.datetime.fromtimestamp(message_time(metadata_dict_to_node(points[0].payload))).date()
+            day_start = datetime.datetime.combine(day, datetime.time()).timestamp()
+            self._compact_day(channel_id, day_start, min(day_start + DAY, cutoff))
+
+    def _compact_day(self, channel_id, start, end):
+        in_day = self._uncompacted(end, [
+            channel_condition(channel_id),
+            models.FieldCondition(key="when_ts", range=models.Range(gte=start)),
+        ])
+        points, offset = [], None
+        while True:
+            page, offset = self.client.scroll(
+                self.collection_name, scroll_filter=in_day, limit=256, offset=offset, with_payload=True
+            )
+            points.extend(page)
+            if offset is None:
+                break
+        nodes = sorted((metadata_dict_to_node(point.payload) for point in points), key=message_time)
+        summaries = [self._summarize(channel_id, nodes[i:i + self.group_size])
+                     for i in range(0, len(nodes), self.group_size)]
+        # store the summaries before deleting anything, so a crash can't lose messages
+        self.vector_store.add(summaries)
+        self.client.delete(self.collection_name, points_selector=models.PointIdsList(points=[point.id for point in points]))
+        with self.lock:
+            self.compacted_messages += len(points)
+            self.summaries += len(summaries)
+        print(f"Compacted {len(points)} messages from {channel_id} on {format_ts(start)[:10]} into {len(summaries)} summaries")
+
+    def _summarize(self, channel_id, nodes):
+        lines = "\n".join(f"{n.metadata.get('who')} ({n.metadata.get('when')}): {n.get_content()}" for n in nodes)
+        summary = self.service_context.llm.complete(SUMMARY_PROMPT.format(messages=lines)).text.strip()
+        first, last = message_time(nodes[0]), message_time(nodes[-1])
+        node = TextNode(
+            id_=str(uuid.uuid5(SLACK_NAMESPACE, f"summary:{channel_id}:{first}:{last}")),
+            text=summary,
+            metadata={
+                "who": f"summary of {len(nodes)} messages",
+                "when": format_ts(first),
+                "when_ts": last,
+                "channel_id": channel_id,
+                "team_id": nodes[0].metadata.get("team_id"),
+                "summary": True,
+            },
+            excluded_embed_metadata_keys=HIDDEN_METADATA + ["summary"],
+            excluded_llm_metadata_keys=HIDDEN_METADATA + ["summary"],
+        )
+        node.embedding = self.service_context.embed_model.get_text_embedding(node.get_content(metadata_mode=MetadataMode.EMBED))
+        return node
+
+    def stats(self):
+        with self.lock:
+            return {
+                "runs": self.runs,
+                "failed_runs": self.failed_runs,
+                "last_run_seconds": self.last_run_seconds,
+                "expired": self.expired,
+                "compacted_messages": self.compacted_messages,
+                "summaries": self.summaries,
+            }
+
+
+# a Retention set up from RETENTION_DAYS, RETENTION_CHANNEL_DAYS and COMPACT_AFTER_DAYS,
+# or None if none of them are set
+def retention_from_env(client, collection_name, service_context, vector_store):
+    environ = os.environ
+
+    def days(name):
+        return float(environ[name]) if environ.get(name) else None
+    default_days = days("RETENTION_DAYS")
+    channel_days = parse_channel_days(environ.get("RETENTION_CHANNEL_DAYS"))
+    compact_after_days = days("COMPACT_AFTER_DAYS")
+    if default_days is None and not channel_days and compact_after_days is None:
+        return None
+    return Retention(
+        client,
+        collection_name,
+        default_days=default_days,
+        channel_days=channel_days,
+        compact_after_days=compact_after_days,
+        service_context=service_context,
+        vector_store=vector_store,
+        group_size=int(environ.get("COMPACT_GROUP_SIZE", 50)),
+        max_days_per_run=int(environ.get("COMPACT_DAYS_PER_RUN", 10)),
+        interval=float(environ.get("RETENTION_INTERVAL", 3600)),
+    )
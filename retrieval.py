@@ -0,0 +1,228 @@
+# a retriever that searches Qdrant directly, with recency built into the search
+# FixedRecencyPostprocessor only sorts whatever the similarity search returned, so
+# a recent message that isn't quite in the top 20 most similar is never seen.
+# This retriever has three modes:
+#   similarity: the top matches, most recent first (what the bot always did)
+#   window: the same, but only searching messages from the last window_seconds,
+#           using a filter on the indexed when_ts payload field
+#   decay: fetch more candidates, then blend similarity with a score that halves
+#          every half_life_seconds, and keep the best
+# With a KeywordIndex it also does a keyword search and merges the two rankings
+# with reciprocal rank fusion (each result scores 1 / (rrf_k + rank) in each list
+# it's in), so a message that mentions the exact ticket id or hostname in the
+# question makes it in even when its embedding isn't close
+# In decay mode and with keyword search, a result's score isn't its similarity to
+# the question any more, so that's kept in the (hidden) "similarity" metadata for
+# the answer cache
+# A ScopedQuery searches only some channels (or one workspace), with a filter on
+# the indexed channel_id and team_id payload fields
+import asyncio, datetime, time
+import numpy as np
+from dataclasses import dataclass
+from typing import List, Optional
+from qdrant_client.http import models
+from llama_index.retrievers import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle
+from llama_index.vector_stores.utils import metadata_dict_to_node
+
+MODES = ("similarity", "window", "decay")
+
+
+# when a message was sent, in seconds since the epoch
+def message_time(node):
+    when_ts = node.metadata.get("when_ts")
+    if when_ts is not None:
+        return float(when_ts)
+    # messages stored before we kept a numeric timestamp only have the formatted one
+    when = node.metadata.get("when")
+    if when:
+        return datetime.datetime.strptime(when, '%Y-%m-%d %H:%M:%S').timestamp()
+    return 0.0
+
+
+# remember how similar a node is to the question, without showing it to the LLM or the embedding
+def keep_similarity(node, similarity):
+    node.metadata["similarity"] = similarity
+    for excluded in (node.excluded_embed_metadata_keys, node.excluded_llm_metadata_keys):
+        if "similarity" not in excluded:
+            excluded.append("similarity")
+
+
+# a question that should only search channel_ids (all of them if None) in team_id's workspace
+# query engines hand the bundle to the retriever as it is, so the scope comes along
+@dataclass
+class ScopedQuery(QueryBundle):
+    channel_ids: Optional[List[str]] = None
+    team_id: Optional[str] = None
+
+
+class SlackRetriever(BaseRetriever):
+    def __init__(
+        self,
+        client,
+        collection_name,
+        embed_model,
+        similarity_top_k=20,
+        mode="similarity",
+        window_seconds=None,
+        half_life_seconds=7 * 24 * 3600,
+        recency_weight=0.3,
+        candidates=100,
+        search_params=None,
+        keyword_index=None,
+        keyword_top_k=20,
+        rrf_k=60,
+        aclient=None,
+        callback_manager=None,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {MODES}")
+        if mode == "window" and window_seconds is None:
+            raise ValueError("window mode needs window_seconds")
+        self.client = client
+        # an AsyncQdrantClient for aretrieve; without one, async searches run on a thread
+        self.aclient = aclient
+        self.collection_name = collection_name
+        self.embed_model = embed_model
+        self.similarity_top_k = similarity_top_k
+        self.mode = mode
+        self.window_seconds = window_seconds
+        self.half_life_seconds = half_life_seconds
+        self.recency_weight = recency_weight
+        self.candidates = max(candidates, similarity_top_k)
+        # e.g. how to use quantized vectors; see CollectionConfig.search_params
+        self.search_params = search_params
+        self.keyword_index = keyword_index
+        self.keyword_top_k = keyword_top_k
+        self.rrf_k = rrf_k
+        super().__init__(callback_manager)
+
+    # the oldest message we can use, if we're only searching a window
+    def _cutoff(self, now):
+        if self.mode == "similarity" or self.window_seconds is None:
+            return None
+        return now - self.window_seconds
+
+    # only messages newer than the window, and from the channels the query is scoped to
+    def _query_filter(self, query_bundle, now):
+        must = []
+        if self._cutoff(now) is not None:
+            must.append(models.FieldCondition(key="when_ts", range=models.Range(gte=self._cutoff(now))))
+        channel_ids = getattr(query_bundle, "channel_ids", None)
+        team_id = getattr(query_bundle, "team_id", None)
+        team = None
+        if team_id is not None:
+            team = models.Filter(should=[
+                models.FieldCondition(key="team_id", match=models.MatchValue(value=team_id)),
+                # stored before we kept the team
+                models.IsEmptyCondition(is_empty=models.PayloadField(key="team_id")),
+            ])
+        if channel_ids is not None:
+            # channel ids are unique across workspaces, so they're scope enough
+            # messages stored before we kept the channel could be from any of them, so
+            # they're only held to the team, until backfill.py --all-channels --reindex replaces them
+            unknown_channel = [models.IsEmptyCondition(is_empty=models.PayloadField(key="channel_id"))]
+            if team is not None:
+                unknown_channel.append(team)
+            must.append(models.Filter(should=[
+                models.FieldCondition(key="channel_id", match=models.MatchAny(any=list(channel_ids))),
+                models.Filter(must=unknown_channel),
+            ]))
+        elif team is not None:
+            must.append(team)
+        return models.Filter(must=must) if must else None
+
+    def _search_args(self, query_bundle, embedding, now):
+        return dict(
+            collection_name=self.collection_name,
+            query_vector=embedding,
+            query_filter=self._query_filter(query_bundle, now),
+            limit=self.candidates if self.mode == "decay" else self.similarity_top_k,
+            with_payload=True,
+            search_params=self.search_params,
+        )
+
+    def _retrieve(self, query_bundle):
+        embedding = query_bundle.embedding or self.embed_model.get_query_embedding(query_bundle.query_str)
+        now = time.time()
+        results = self._score(self.client.search(**self._search_args(query_bundle, embedding, now)), now)
+        if self.keyword_index is not None:
+            keyword_ids = self._keyword_search(query_bundle)
+            missing = self._missing(results, keyword_ids)
+            points = self.client.retrieve(self.collection_name, ids=missing, with_payload=True, with_vectors=True) if missing else []
+            results = self._fuse(results, keyword_ids, points, query_bundle, embedding, now)
+        return self._by_time(results)
+
+    async def _aretrieve(self, query_bundle):
+        if self.aclient is None:
+            return await asyncio.to_thread(self._retrieve, query_bundle)
+        embedding = query_bundle.embedding or await self.embed_model.aget_query_embedding(query_bundle.query_str)
+        now = time.time()
+        results = self._score(await self.aclient.search(**self._search_args(query_bundle, embedding, now)), now)
+        if self.keyword_index is not None:
+            keyword_ids = await asyncio.to_thread(self._keyword_search, query_bundle)
+            missing = self._missing(results, keyword_ids)
+            points = await self.aclient.retrieve(self.collection_name, ids=missing, with_payload=True, with_vectors=True) if missing else []
+            results = self._fuse(results, keyword_ids, points, query_bundle, embedding, now)
+        return self._by_time(results)
+
+    def _score(self, points, now):
+        results = [NodeWithScore(node=metadata_dict_to_node(point.payload), score=point.score) for point in points]
+        for result in results:
+            keep_similarity(result.node, result.score)
+        if self.mode == "decay":
+            for result in results:
+                age = max(0.0, now - message_time(result.node))
+                recency = 0.5 ** (age / self.half_life_seconds)
+                result.score = (1 - self.recency_weight) * result.score + self.recency_weight * recency
+            results.sort(key=lambda result: result.score, reverse=True)
+            results = results[:self.similarity_top_k]
+        return results
+
+    def _keyword_search(self, query_bundle):
+        return self.keyword_index.search(
+            query_bundle.query_str, self.keyword_top_k, channel_ids=getattr(query_bundle, "channel_ids", None)
+        )
+
+    # keyword matches the vector search didn't return, whose payloads we still need
+    def _missing(self, results, keyword_ids):
+        found = {result.node.node_id for result in results}
+        return [node_id for node_id in keyword_ids if node_id not in found]
+
+    def _fuse(self, results, keyword_ids, points, query_bundle, embedding, now):
+        nodes = {result.node.node_id: result.node for result in results}
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        for point in points:
+            node = nodes[str(point.id)] = metadata_dict_to_node(point.payload)
+            # the collection uses cosine distance, so Qdrant keeps its vectors normalized
+            if point.vector is not None:
+                keep_similarity(node, float(np.dot(query, point.vector)))
+        # ids the keyword index has but Qdrant doesn't (expired or compacted away)
+        stale = [node_id for node_id in keyword_ids if node_id not in nodes]
+        if stale:
+            self.keyword_index.delete(stale)
+        cutoff = self._cutoff(now)
+        # the keyword index knows channels but not workspaces
+        team_id = getattr(query_bundle, "team_id", None)
+        if getattr(query_bundle, "channel_ids", None) is None and team_id is not None:
+            nodes = {node_id: node for node_id, node in nodes.items()
+                     if node.metadata.get("team_id") in (team_id, None)}
+        scores = {}
+        for ranking in ([result.node.node_id for result in results], keyword_ids):
+            rank = 0
+            for node_id in ranking:
+                # the vector search was already filtered; keyword matches have to be checked here
+                if node_id not in nodes or (cutoff is not None and message_time(nodes[node_id]) < cutoff):
+                    continue
+                rank += 1
+                scores[node_id] = scores.get(node_id, 0.0) + 1 / (self.rrf_k + rank)
+        # scaled so first in both lists scores 1
+        best = 2 / (self.rrf_k + 1)
+        fused = sorted(scores, key=scores.get, reverse=True)[:self.similarity_top_k]
+        return [NodeWithScore(node=nodes[node_id], score=scores[node_id] / best) for node_id in fused]
+
+    # the prompt tells the LLM the most recent message comes first
+    def _by_time(self, results):
+        results.sort(key=lambda result: message_time(result.node), reverse=True)
+        return results
@@ -0,0 +1,431 @@
+# a Slack Web API client that paces itself, so it isn't rate limited in the first place
+# the bot called users_info, conversations_replies, chat_postMessage and friends
+# whenever it liked, and under load Slack answered with 429s that stalled
+# whichever handler made the call. PacedWebClient is a WebClient that:
+#   paces each method with a token bucket sized to the method's rate limit tier
+#       (chat.postMessage is limited per channel instead), a little under the
+#       limit so a burst doesn't push a minute over it
+#   when Slack answers 429 anyway, holds every call to that method for as long as
+#       Retry-After asks, then tries again
+#   sends identical read calls made at the same time (ten questions from the same
+#       user, say) once, and gives them all the answer
+#   sends deferred calls (see defer) in the background, only when there's room to
+#       spare, and only the latest one for each message
+#   keeps its connections to Slack open and reuses them, instead of a new
+#       connection (and TLS handshake) for every call
+# PacedAsyncWebClient does the same for an AsyncWebClient
+import asyncio, collections, contextvars, http.client, json, threading, time, urllib.parse
+from concurrent.futures import Future, wait
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+
+# calls a minute Slack allows for each tier; see https://api.slack.com/docs/rate-limits
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_TIERS = {
+    "auth.test": 4,
+    "chat.update": 3,
+    "conversations.history": 3,
+    "conversations.info": 3,
+    "conversations.join": 3,
+    "conversations.list": 2,
+    "conversations.replies": 3,
+    "users.info": 4,
+    "users.list": 2,
+}
+DEFAULT_TIER = 3
+# these aren't tiered: Slack allows about a message a second in each channel
+PER_CHANNEL_LIMITS = {"chat.postMessage": 60}
+# calls that only read, so identical ones made at the same time can share an answer
+COALESCED = {"auth.test", "conversations.history", "conversations.info", "conversations.list",
+             "conversations.replies", "users.info", "users.list"}
+
+# set while the client is sending one of its own deferred calls
+_sending_deferred = contextvars.ContextVar("sending_deferred", default=False)
+
+
+class TokenBucket:
+    # limit calls every window seconds, up to burst of them at once
+    def __init__(self, limit, window=60.0, burst=1 / 12):
+        self.capacity = max(1, int(limit * burst))
+        # refill a little under the limit, so a full bucket spent at once still fits in the window
+        self.rate = max(limit - self.capacity, limit / 2) / window
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    # take a token; returns how long to wait before using it
+    # tokens can go negative, so callers queue up behind each other at the bucket's rate
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            return max(0.0, self.updated - now) + max(0.0, -self.tokens / self.rate)
+
+    # how long until a token could be taken with keep tokens still left over
+    def wait_time(self, keep=0):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return max(0.0, self.updated - now) + max(0.0, (1 + keep - self.tokens) / self.rate)
+
+    # Slack said to wait: nothing until seconds from now, and start again from empty
+    def pause(self, seconds):
+        with self.lock:
+            self.tokens = min(self.tokens, 0)
+            self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+# what both clients share: the buckets, the bookkeeping and the stats
+class Pacing:
+    def __init__(self, *args, limits=None, limit_scale=1.0, burst=1 / 12, max_retries=3, reserve=1, pool_size=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        # method -> calls a minute, for methods whose limit isn't what METHOD_TIERS says
+        self.limits = dict(limits or {})
+        # every limit times this; a fake Slack can take far more than the real one
+        self.limit_scale = limit_scale
+        # the share of a minute's calls that can go at once
+        self.burst = burst
+        self.max_retries = max_retries
+        # tokens deferred calls leave for everything else
+        self.reserve = reserve
+        self.pool_size = pool_size
+        self.pacing_lock = threading.Lock()
+        # method, or (method, channel) -> TokenBucket
+        self.buckets = {}
+        # coalesce key -> the future of the call being made for it
+        self.in_flight = {}
+        # defer key -> (method name, kwargs), oldest first
+        self.pending = collections.OrderedDict()
+        # (defer key, future) of the deferred call being sent
+        self.sending = None
+        self.calls = collections.Counter()
+        self.counts = collections.Counter()
+        self.waited = 0.0
+
+    def _bucket(self, api_method, args):
+        per_channel = PER_CHANNEL_LIMITS.get(api_method)
+        key = (api_method, args.get("channel")) if per_channel else api_method
+        with self.pacing_lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                limit = self.limits.get(api_method) or per_channel or TIER_LIMITS[METHOD_TIERS.get(api_method, DEFAULT_TIER)]
+                bucket = self.buckets[key] = TokenBucket(limit, 60 / self.limit_scale, self.burst)
+            return bucket
+
+    # seconds to wait before making this call
+    def _take(self, api_method, args):
+        delay = self._bucket(api_method, args).take()
+        with self.pacing_lock:
+            self.calls[api_method] += 1
+            if delay > 0:
+                self.counts["waits"] += 1
+                self.waited += delay
+        return delay
+
+    # after a failed call: whether it was a 429 worth trying again, pausing the method if so
+    def _rate_limited(self, api_method, args, error, attempt):
+        if error.response.status_code != 429 or attempt == self.max_retries:
+            return False
+        retry_after = float(error.response.headers.get("Retry-After", 1))
+        self._bucket(api_method, args).pause(retry_after)
+        with self.pacing_lock:
+            self.counts["rate_limited"] += 1
+        return True
+
+    def _coalesce_key(self, api_method, args):
+        if api_method not in COALESCED:
+            return None
+        return api_method, json.dumps(args, sort_keys=True, default=str)
+
+    # deferred calls to the same method for the same message (or channel) replace each other
+    def _defer_key(self, api_method, args):
+        return api_method, args.get("channel"), args.get("ts")
+
+    def _queue_deferred(self, method, kwargs):
+        key = self._defer_key(method.replace("_", "."), kwargs)
+        with self.pacing_lock:
+            self.counts["deferred_replaced" if key in self.pending else "deferred"] += 1
+            # a replaced call keeps its place in the queue
+            self.pending[key] = (method, kwargs)
+
+    # a call made directly drops the deferred calls it makes out of date
+    # returns the future of one already being sent, to wait for
+    def _supersede(self, api_method, args):
+        key = self._defer_key(api_method, args)
+        with self.pacing_lock:
+            if self.pending.pop(key, None) is not None:
+                self.counts["deferred_superseded"] += 1
+            if self.sending is not None and self.sending[0] == key:
+                return self.sending[1]
+        return None
+
+    # the oldest deferred call if it can go now, otherwise how long until it can (None if there's none)
+    def _next_deferred(self, future):
+        with self.pacing_lock:
+            if not self.pending:
+                return None, None
+            key, (method, kwargs) = next(iter(self.pending.items()))
+        delay = self._bucket(method.replace("_", "."), kwargs).wait_time(keep=self.reserve)
+        if delay > 0:
+            return None, delay
+        with self.pacing_lock:
+            if self.pending.get(key) != (method, kwargs):
+                # replaced or superseded while we looked
+                return None, 0
+            del self.pending[key]
+            self.sending = (key, future)
+        return (method, kwargs), None
+
+    def _deferred_done(self, error):
+        with self.pacing_lock:
+            self.sending = None
+            if error is not None:
+                self.counts["deferred_failed"] += 1
+        if error is not None:
+            print("Deferred Slack call failed:", repr(error))
+
+    def stats(self):
+        with self.pacing_lock:
+            return dict(
+                {name: self.counts[name] for name in ("waits", "rate_limited", "coalesced", "deferred",
+                                                      "deferred_replaced", "deferred_superseded",
+                                                      "deferred_failed", "connections")},
+                calls=dict(self.calls),
+                waited_seconds=round(self.waited, 3),
+                pending=len(self.pending),
+            )
+
+
+# the keyword arguments of an api_call, as one dict
+def _args(kwargs):
+    args = {}
+    for name in ("params", "data", "json"):
+        if isinstance(kwargs.get(name), dict):
+            args.update(kwargs[name])
+    return args
+
+
+class PacedWebClient(Pacing, WebClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (scheme, host) -> idle connections
+        self.idle = collections.defaultdict(list)
+        self.deferred_wakeup = threading.Event()
+        self.deferred_thread = None
+
+    def api_call(self, api_method, **kwargs):
+        args = _args(kwargs)
+        key = self._coalesce_key(api_method, args)
+        if key is None:
+            return self._paced_call(api_method, args, kwargs)
+        with self.pacing_lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+            else:
+                self.counts["coalesced"] += 1
+        if not leader:
+            return future.result()
+        try:
+            response = self._paced_call(api_method, args, kwargs)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.pacing_lock:
+                del self.in_flight[key]
+
+    def _paced_call(self, api_method, args, kwargs):
+        if not _sending_deferred.get():
+            superseded = self._supersede(api_method, args)
+            if superseded is not None:
+                wait([superseded])
+        for attempt in range(self.max_retries + 1):
+            delay = self._take(api_method, args)
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                return super().api_call(api_method, **kwargs)
+            except SlackApiError as e:
+                if not self._rate_limited(api_method, args, e, attempt):
+                    raise
+
+    # make a call some time soon, when the method has tokens to spare; returns straight away
+    # e.g. client.defer("chat_update", channel=channel, ts=ts, text=partial_answer)
+    def defer(self, method, **kwargs):
+        self._queue_deferred(method, kwargs)
+        with self.pacing_lock:
+            if self.deferred_thread is None:
+                self.deferred_thread = threading.Thread(target=self._send_deferred, name="slack-deferred", daemon=True)
+                self.deferred_thread.start()
+        self.deferred_wakeup.set()
+
+    def _send_deferred(self):
+        _sending_deferred.set(True)
+        while True:
+            future = Future()
+            call, delay = self._next_deferred(future)
+            if call is None:
+                if delay != 0:
+                    self.deferred_wakeup.wait(delay)
+                    self.deferred_wakeup.clear()
+                continue
+            method, kwargs = call
+            error = None
+            try:
+                getattr(self, method)(**kwargs)
+            except Exception as e:
+                error = e
+            finally:
+                self._deferred_done(error)
+                future.set_result(None)
+
+    # slack_sdk opens a new connection for every call; this keeps them open and reuses them
+    def _perform_urllib_http_request_internal(self, url, req):
+        parts = urllib.parse.urlsplit(req.full_url)
+        if self.proxy or parts.scheme not in ("http", "https"):
+            return super()._perform_urllib_http_request_internal(url, req)
+        target = parts.path + (f"?{parts.query}" if parts.query else "")
+        headers = dict(req.header_items())
+        if req.data and "content-type" not in {name.lower() for name in headers}:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in range(2):
+            connection, reused = self._connection(parts)
+            try:
+                connection.request(req.get_method(), target, body=req.data, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                # Slack closed a connection we kept open; try once more on a new one
+                if reused and attempt == 0:
+                    continue
+                raise
+            self._release(parts, connection, response)
+            charset = response.headers.get_content_charset() or "utf-8"
+            return {"status": response.status, "headers": response.headers, "body": body.decode(charset)}
+
+    # an idle connection to the host, or a new one; and whether it was reused
+    def _connection(self, parts):
+        with self.pacing_lock:
+            idle = self.idle[(parts.scheme, parts.netloc)]
+            if idle:
+                return idle.pop(), True
+            self.counts["connections"] += 1
+        if parts.scheme == "https":
+            return http.client.HTTPSConnection(parts.hostname, parts.port, timeout=self.timeout, context=self.ssl), False
+        return http.client.HTTPConnection(parts.hostname, parts.port, timeout=self.timeout), False
+
+    def _release(self, parts, connection, response):
+        with self.pacing_lock:
+            idle = self.idle[(parts.scheme, parts.netloc)]
+            if not response.will_close and len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+
+class PacedAsyncWebClient(Pacing, AsyncWebClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.deferred_wakeup = None
+        self.deferred_task = None
+
+    # an AsyncWebClient without a session opens (and closes) one for every call
+    # this one is made on the first call, since it has to be made on the event loop
+    def _open_session(self):
+        if self.session is not None:
+            return
+        import aiohttp
+        trace = aiohttp.TraceConfig()
+
+        async def opened(session, context, params):
+            with self.pacing_lock:
+                self.counts["connections"] += 1
+        trace.on_connection_create_end.append(opened)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size), trace_configs=[trace])
+
+    async def api_call(self, api_method, **kwargs):
+        self._open_session()
+        args = _args(kwargs)
+        key = self._coalesce_key(api_method, args)
+        if key is None:
+            return await self._paced_call(api_method, args, kwargs)
+        future = self.in_flight.get(key)
+        if future is not None:
+            with self.pacing_lock:
+                self.counts["coalesced"] += 1
+            # shielded, so one caller giving up doesn't cancel the call for the rest
+            return await asyncio.shield(future)
+        future = self.in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await self._paced_call(api_method, args, kwargs)
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the callers waiting on it get the error; don't warn that nobody did
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+
+    async def _paced_call(self, api_method, args, kwargs):
+        if not _sending_deferred.get():
+            superseded = self._supersede(api_method, args)
+            if superseded is not None:
+                await asyncio.wait([superseded])
+        for attempt in range(self.max_retries + 1):
+            delay = self._take(api_method, args)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await super().api_call(api_method, **kwargs)
+            except SlackApiError as e:
+                if not self._rate_limited(api_method, args, e, attempt):
+                    raise
+
+    # like PacedWebClient.defer; call it from the event loop, and don't await it
+    def defer(self, method, **kwargs):
+        self._queue_deferred(method, kwargs)
+        if self.deferred_wakeup is None:
+            self.deferred_wakeup = asyncio.Event()
+        if self.deferred_task is None or self.deferred_task.done():
+            self.deferred_task = asyncio.get_running_loop().create_task(self._send_deferred())
+        self.deferred_wakeup.set()
+
+    async def _send_deferred(self):
+        _sending_deferred.set(True)
+        while True:
+            future = asyncio.get_running_loop().create_future()
+            call, delay = self._next_deferred(future)
+            if call is None:
+                if delay != 0:
+                    try:
+                        await asyncio.wait_for(self.deferred_wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    self.deferred_wakeup.clear()
+                continue
+            method, kwargs = call
+            error = None
+            try:
+                await getattr(self, method)(**kwargs)
+            except Exception as e:
+                error = e
+            finally:
+                self._deferred_done(error)
+                future.set_result(None)
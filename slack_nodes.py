@@ -0,0 +1,43 @@
+# turns Slack messages into LlamaIndex nodes
+# node ids are derived from the channel and timestamp of the message, which
+# together identify a Slack message uniquely, so storing the same message twice
+# just overwrites the same point in Qdrant instead of creating a duplicate
+import datetime, uuid
+from llama_index.schema import TextNode
+
+# any fixed UUID works here, it just namespaces our uuid5 ids
+SLACK_NAMESPACE = uuid.UUID("6f1d4f3e-2b8a-5c4e-9a57-3f0e1d2c8b61")
+
+
+# Qdrant only accepts UUIDs or integers as point ids
+def node_id_for(channel, ts):
+    return str(uuid.uuid5(SLACK_NAMESPACE, f"{channel}:{ts}"))
+
+
+# format timestamp as YYYY-MM-DD HH:MM:SS
+def format_ts(ts):
+    dt_object = datetime.datetime.fromtimestamp(float(ts))
+    return dt_object.strftime('%Y-%m-%d %H:%M:%S')
+
+
+# metadata only Qdrant needs: kept out of the embedding and the prompt
+HIDDEN_METADATA = ["when_ts", "channel_id", "team_id", "message_ts"]
+
+
+# create a node for a message and apply metadata
+# "when" is for the LLM to read; "when_ts" is the same time as a number, for
+# Qdrant to filter and sort on, and "channel_id" and "team_id" say where it was said
+def message_to_node(message, user_name):
+    return TextNode(
+        text=message.get('text'),
+        id_=node_id_for(message.get('channel'), message.get('ts')),
+        metadata={
+            "who": user_name,
+            "when": format_ts(message.get('ts')),
+            "when_ts": float(message.get('ts')),
+            "channel_id": message.get('channel'),
+            "team_id": message.get('team')
+        },
+        excluded_embed_metadata_keys=HIDDEN_METADATA,
+        excluded_llm_metadata_keys=HIDDEN_METADATA
+    )
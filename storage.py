@@ -0,0 +1,165 @@
+# setting up Qdrant: which client we use, and the collection the bot stores messages in
+# QdrantVectorStore will create a bare collection the first time we insert into
+# it, but we want to choose how it's created and which payload fields get an
+# index, so we create it ourselves at startup
+import os, threading
+import qdrant_client
+from qdrant_client.http import models
+
+# payload fields we filter or sort on, and how Qdrant should index them
+PAYLOAD_INDEXES = {
+    "when_ts": models.PayloadSchemaType.FLOAT,
+    "channel_id": models.PayloadSchemaType.KEYWORD,
+    "team_id": models.PayloadSchemaType.KEYWORD,
+    # the timestamps of the messages in a conversation window, to find it when one is edited
+    "message_ts": models.PayloadSchemaType.KEYWORD,
+}
+
+QUANTIZATIONS = ("none", "scalar", "product", "binary")
+
+
+# how the collection stores its vectors, for when there are too many to keep in RAM
+#   quantization: keep a compressed copy of every vector for searching; scalar
+#     stores a byte per dimension (4x smaller), product 16x to 64x smaller
+#     (product_compression), binary a bit per dimension (32x smaller). Searches
+#     use the compressed copies, then re-score the best oversampling x limit
+#     candidates with the full vectors
+#   on_disk: keep the full vectors on disk instead of in RAM, which works well
+#     with quantization since only the re-scoring reads them
+#   hnsw_m, hnsw_ef_construct: how connected the search graph is; bigger is more
+#     accurate and uses more memory. hnsw_ef is how hard each search looks
+# Qdrant only uses these when it creates the collection, and only a Qdrant server
+# uses them at all: the embedded store always does an exact search
+class CollectionConfig:
+    def __init__(self, quantization="none", on_disk=False, always_ram=True, product_compression="x16",
+                 hnsw_m=None, hnsw_ef_construct=None, hnsw_ef=None, oversampling=2.0):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+        self.quantization = quantization
+        self.on_disk = on_disk
+        # keep the compressed vectors in RAM even when everything else is on disk
+        self.always_ram = always_ram
+        self.product_compression = product_compression
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construct = hnsw_ef_construct
+        self.hnsw_ef = hnsw_ef
+        self.oversampling = oversampling
+
+    # QDRANT_QUANTIZATION, QDRANT_ON_DISK and friends
+    @classmethod
+    def from_env(cls):
+        def number(name, kind):
+            return kind(os.environ[name]) if os.environ.get(name) else None
+        return cls(
+            quantization=os.environ.get("QDRANT_QUANTIZATION", "none"),
+            on_disk=os.environ.get("QDRANT_ON_DISK", "").lower() in ("1", "true", "yes"),
+            product_compression=os.environ.get("QDRANT_PQ_COMPRESSION", "x16"),
+            hnsw_m=number("QDRANT_HNSW_M", int),
+            hnsw_ef_construct=number("QDRANT_HNSW_EF_CONSTRUCT", int),
+            hnsw_ef=number("QDRANT_HNSW_EF", int),
+            oversampling=number("QDRANT_OVERSAMPLING", float) or 2.0,
+        )
+
+    def quantization_config(self):
+        if self.quantization == "scalar":
+            return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, quantile=0.99, always_ram=self.always_ram
+            ))
+        if self.quantization == "product":
+            return models.ProductQuantization(product=models.ProductQuantizationConfig(
+                compression=models.CompressionRatio(self.product_compression), always_ram=self.always_ram
+            ))
+        if self.quantization == "binary":
+            return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=self.always_ram))
+        return None
+
+    # the arguments to create_collection
+    def create_args(self, vector_size):
+        hnsw_config = None
+        if self.hnsw_m is not None or self.hnsw_ef_construct is not None:
+            hnsw_config = models.HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct)
+        return dict(
+            # the same distance QdrantVectorStore uses when it creates a collection
+            vectors_config=models.VectorParams(size=vector_size, distance=models.Distance.COSINE, on_disk=self.on_disk),
+            quantization_config=self.quantization_config(),
+            hnsw_config=hnsw_config,
+        )
+
+    # what to pass as search_params, or None for Qdrant's defaults
+    def search_params(self):
+        if self.quantization == "none" and self.hnsw_ef is None:
+            return None
+        quantization = None
+        if self.quantization != "none":
+            quantization = models.QuantizationSearchParams(rescore=True, oversampling=self.oversampling)
+        return models.SearchParams(hnsw_ef=self.hnsw_ef, quantization=quantization)
+
+    def describe(self):
+        parts = [self.quantization if self.quantization != "product" else f"product {self.product_compression}"]
+        if self.on_disk:
+            parts.append("on disk")
+        if self.hnsw_m is not None:
+            parts.append(f"m={self.hnsw_m}")
+        if self.hnsw_ef_construct is not None:
+            parts.append(f"ef_construct={self.hnsw_ef_construct}")
+        if self.hnsw_ef is not None:
+            parts.append(f"ef={self.hnsw_ef}")
+        return ", ".join(parts)
+
+
+def collection_exists(client, collection_name):
+    return any(c.name == collection_name for c in client.get_collections().collections)
+
+
+# create the collection if it isn't there yet, and make sure our payload indexes exist
+# vector_size has to match the embedding model (1536 for OpenAI's text-embedding-ada-002)
+# config defaults to CollectionConfig.from_env()
+def ensure_collection(client, collection_name, vector_size, config=None):
+    if not collection_exists(client, collection_name):
+        config = config or CollectionConfig.from_env()
+        client.create_collection(collection_name=collection_name, **config.create_args(vector_size))
+    # creating an index that already exists is a no-op
+    for field_name, field_schema in PAYLOAD_INDEXES.items():
+        client.create_payload_index(
+            collection_name=collection_name,
+            field_name=field_name,
+            field_schema=field_schema,
+        )
+
+
+# the embedded store isn't safe to use from more than one thread: a search while the
+# ingest flusher is upserting can see the collection half updated, and fails with
+# numpy errors like "operands could not be broadcast together". This hands out the
+# client's methods wrapped in one lock, so only one call runs at a time
+class LockedClient:
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+        return locked
+
+
+# the Qdrant client the bot and its tools use
+# with QDRANT_URL set we talk to a Qdrant server, which any number of processes can
+# share; otherwise we use the embedded store in QDRANT_PATH, which locks its files
+# so that only one process at a time can open it, and only one thread at a time can use
+# path, if it's given, is used in place of QDRANT_PATH
+def make_client(path=None):
+    if os.environ.get("QDRANT_URL"):
+        return qdrant_client.QdrantClient(url=os.environ["QDRANT_URL"], api_key=os.environ.get("QDRANT_API_KEY"))
+    return LockedClient(qdrant_client.QdrantClient(path=path or os.environ.get("QDRANT_PATH", "./qdrant_data")))
+
+
+# an async client for the same server, or None for the embedded store, which
+# can't be opened by a second client in the same process
+def make_async_client():
+    if os.environ.get("QDRANT_URL"):
+        return qdrant_client.AsyncQdrantClient(url=os.environ["QDRANT_URL"], api_key=os.environ.get("QDRANT_API_KEY"))
+    return None
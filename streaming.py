@@ -0,0 +1,141 @@
+# shows an answer in Slack while the LLM is still writing it
+# we post a placeholder straight away, then edit it with chat_update as the
+# answer streams in. The first words go up as soon as they arrive; after that
+# Slack only lets us update a message about once a second (chat.update is a
+# Tier 3 method), so we update at most every interval seconds, and always once
+# more at the end with the whole answer. With a client
+# that can defer calls (slack_client.PacedWebClient), partial answers are handed
+# to it instead, so waiting on chat.update never holds up the answer
+import asyncio, time
+from slack_sdk.errors import SlackApiError
+
+PLACEHOLDER = "Thinking..."
+# shown at the end of an answer that's still being written
+CURSOR = " ▍"
+
+
+def _retry_after(error):
+    if error.response.status_code == 429:
+        return float(error.response.headers.get("Retry-After", 1))
+    return None
+
+
+class StreamingMessage:
+    def __init__(self, client, channel, thread_ts=None, interval=1.0, placeholder=PLACEHOLDER):
+        self.client = client
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.interval = interval
+        self.placeholder = placeholder
+        self.message = None
+        self.text = ""
+        self.shown = None
+        self.last_update = 0.0
+        self.updates = 0
+        self.skipped = 0
+
+    # post the placeholder
+    def start(self):
+        posted = self.client.chat_postMessage(channel=self.channel, text=self.placeholder, thread_ts=self.thread_ts)
+        self.message = posted['message']
+        self.last_update = time.monotonic()
+        return self
+
+    # read the answer as it arrives, updating the message every so often
+    def consume(self, tokens):
+        for delta in tokens:
+            self.text += delta
+            if self._due():
+                self._update(self.text + CURSOR, final=False)
+        return self.text
+
+    # whether it's time to show what we have: straight away for the first words,
+    # rather than an interval after the placeholder, then every interval
+    def _due(self):
+        if self.shown is None:
+            return bool(self.text.strip())
+        return time.monotonic() - self.last_update >= self.interval
+
+    # show the whole answer; returns the message as it now is
+    def finish(self, text):
+        self.text = text
+        self._update(text, final=True)
+        return dict(self.message, text=text)
+
+    # a partial answer can wait until chat.update has room, and be replaced by a newer one meanwhile
+    def _deferred(self, text, final):
+        if final or not hasattr(self.client, "defer"):
+            return False
+        self.client.defer("chat_update", channel=self.channel, ts=self.message['ts'], text=text)
+        self.shown = text
+        self.updates += 1
+        self.last_update = time.monotonic()
+        return True
+
+    def _update(self, text, final):
+        if text == self.shown:
+            return
+        if self._deferred(text, final):
+            return
+        for attempt in range(3):
+            try:
+                self.client.chat_update(channel=self.channel, ts=self.message['ts'], text=text)
+                break
+            except SlackApiError as e:
+                retry_after = _retry_after(e)
+                # a partial answer can wait for the next one; the last update has to get through
+                if retry_after is None or not final or attempt == 2:
+                    if final:
+                        raise
+                    self.skipped += 1
+                    return
+                time.sleep(retry_after)
+        self.shown = text
+        self.updates += 1
+        self.last_update = time.monotonic()
+
+
+# the same for an AsyncWebClient; the tokens still come from a normal iterator,
+# which we read on a worker thread so waiting for the LLM doesn't block the event loop
+class AsyncStreamingMessage(StreamingMessage):
+    async def start(self):
+        posted = await self.client.chat_postMessage(channel=self.channel, text=self.placeholder, thread_ts=self.thread_ts)
+        self.message = posted['message']
+        self.last_update = time.monotonic()
+        return self
+
+    async def consume(self, tokens):
+        tokens = iter(tokens)
+        while True:
+            delta = await asyncio.to_thread(next, tokens, None)
+            if delta is None:
+                return self.text
+            self.text += delta
+            if self._due():
+                await self._update(self.text + CURSOR, final=False)
+
+    async def finish(self, text):
+        self.text = text
+        await self._update(text, final=True)
+        return dict(self.message, text=text)
+
+    async def _update(self, text, final):
+        if text == self.shown:
+            return
+        if self._deferred(text, final):
+            return
+        for attempt in range(3):
+            try:
+                await self.client.chat_update(channel=self.channel, ts=self.message['ts'], text=text)
+                break
+            except SlackApiError as e:
+                retry_after = _retry_after(e)
+                if retry_after is None or not final or attempt == 2:
+                    if final:
+                        raise
+                    self.skipped += 1
+                    return
+                await asyncio.sleep(retry_after)
+        self.shown = text
+        self.updates += 1
+        self.last_update = time.monotonic()
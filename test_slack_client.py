@@ -0,0 +1,257 @@
+# tests for PacedWebClient and PacedAsyncWebClient, against fake_slack.py
+# the fake answers 429 (with Retry-After) when a method goes over the limit we
+# give it, and counts the calls and connections that reach it, which is what we
+# check here. A minute is SPEEDUP times shorter than usual, for the fake and the
+# clients alike, so each test takes a second or two
+#
+#   python -m pytest test_slack_client.py
+import asyncio, threading, time
+import pytest
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+from fake_slack import FakeSlack, synthetic_workspace
+from slack_client import METHOD_TIERS, TIER_LIMITS, PacedAsyncWebClient, PacedWebClient
+
+SPEEDUP = 60
+# people in the fake workspace, not counting the bot
+USERS = 20
+
+
+@pytest.fixture
+def workspace():
+    return synthetic_workspace(channels=2, messages_per_channel=20, users=USERS)
+
+
+# starts a fake Slack with the given settings; stopped after the test
+@pytest.fixture
+def fake_slack(workspace):
+    fakes = []
+
+    def start(**kwargs):
+        fake = FakeSlack(workspace, **kwargs).start()
+        fakes.append(fake)
+        return fake
+    yield start
+    for fake in fakes:
+        fake.stop()
+
+
+# a fake that enforces the real tier limits, on a SPEEDUP times shorter minute
+@pytest.fixture
+def tiered_slack(fake_slack):
+    limits = {method: TIER_LIMITS[tier] for method, tier in METHOD_TIERS.items()}
+    return fake_slack(rate_limits=limits, rate_window=60 / SPEEDUP)
+
+
+def user_ids(workspace):
+    return [user["id"] for user in workspace["users"]]
+
+
+# make calls from threads at once, all starting together; returns what each one returned
+def at_once(calls):
+    barrier = threading.Barrier(len(calls))
+    results = [None] * len(calls)
+
+    def run(i):
+        barrier.wait()
+        results[i] = calls[i]()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def in_loop(coroutine_function):
+    async def run():
+        client = await coroutine_function()
+        # PacedAsyncWebClient opens a session of its own; close it before the loop goes
+        await client.session.close()
+    asyncio.run(run())
+
+
+# pacing under the tier limits
+
+def test_a_plain_client_goes_over_the_limit(tiered_slack, workspace):
+    client = WebClient(token="xoxb-fake", base_url=tiered_slack.base_url)
+    with pytest.raises(SlackApiError) as error:
+        for _ in range(TIER_LIMITS[METHOD_TIERS["conversations.join"]] + 1):
+            client.conversations_join(channel=workspace["channels"][0]["id"])
+    assert error.value.response.status_code == 429
+
+
+# conversations.join isn't a read, so none of these calls are coalesced
+def test_paces_calls_under_the_tier_limit(tiered_slack, workspace):
+    client = PacedWebClient(token="xoxb-fake", base_url=tiered_slack.base_url, limit_scale=SPEEDUP)
+    channel = workspace["channels"][0]["id"]
+    # twice what the fake allows in a window, from eight threads at once
+    calls = 2 * TIER_LIMITS[METHOD_TIERS["conversations.join"]]
+    at_once([lambda: [client.conversations_join(channel=channel) for _ in range(calls // 8)]] * 8)
+    assert tiered_slack.calls["conversations.join"] == calls // 8 * 8
+    assert tiered_slack.rate_limited["conversations.join"] == 0
+    assert client.stats()["rate_limited"] == 0
+    assert client.stats()["waits"] > 0
+
+
+def test_async_paces_calls_under_the_tier_limit(tiered_slack, workspace):
+    channel = workspace["channels"][0]["id"]
+    calls = 2 * TIER_LIMITS[METHOD_TIERS["conversations.join"]]
+
+    async def run():
+        client = PacedAsyncWebClient(token="xoxb-fake", base_url=tiered_slack.base_url, limit_scale=SPEEDUP)
+        await asyncio.gather(*(client.conversations_join(channel=channel) for _ in range(calls)))
+        assert client.stats()["rate_limited"] == 0
+        assert client.stats()["waits"] > 0
+        return client
+    in_loop(run)
+    assert tiered_slack.calls["conversations.join"] == calls
+    assert tiered_slack.rate_limited["conversations.join"] == 0
+
+
+# Retry-After on a 429
+
+# the fake allows two calls a second; the clients think they can make far more
+@pytest.fixture
+def strict_slack(fake_slack):
+    return fake_slack(rate_limits={"conversations.info": 2}, rate_window=1)
+
+
+def test_waits_for_retry_after(strict_slack, workspace):
+    client = PacedWebClient(token="xoxb-fake", base_url=strict_slack.base_url, limit_scale=1000)
+    channel = workspace["channels"][0]["id"]
+    started = time.monotonic()
+    for _ in range(3):
+        assert client.conversations_info(channel=channel)["ok"]
+    # the third call was told to wait a second, and did, once
+    assert time.monotonic() - started >= 1
+    assert strict_slack.rate_limited["conversations.info"] == 1
+    assert client.stats()["rate_limited"] == 1
+    assert strict_slack.calls["conversations.info"] == 4
+
+
+def test_retry_after_holds_every_call_to_the_method(strict_slack, workspace):
+    client = PacedWebClient(token="xoxb-fake", base_url=strict_slack.base_url, limit_scale=1000)
+    channels = [channel["id"] for channel in workspace["channels"]]
+    for _ in range(2):
+        client.conversations_info(channel=channels[0])
+    # both threads are over the limit; the one that gets the 429 holds the other back too
+    results = at_once([lambda channel=channel: client.conversations_info(channel=channel) for channel in channels])
+    assert all(result["ok"] for result in results)
+    assert strict_slack.rate_limited["conversations.info"] <= 2
+    assert client.stats()["rate_limited"] == strict_slack.rate_limited["conversations.info"]
+
+
+def test_gives_up_after_max_retries(strict_slack, workspace):
+    client = PacedWebClient(token="xoxb-fake", base_url=strict_slack.base_url, limit_scale=1000, max_retries=0)
+    channel = workspace["channels"][0]["id"]
+    for _ in range(2):
+        client.conversations_info(channel=channel)
+    with pytest.raises(SlackApiError) as error:
+        client.conversations_info(channel=channel)
+    assert error.value.response.status_code == 429
+
+
+def test_async_waits_for_retry_after(strict_slack, workspace):
+    channel = workspace["channels"][0]["id"]
+
+    async def run():
+        client = PacedAsyncWebClient(token="xoxb-fake", base_url=strict_slack.base_url, limit_scale=1000)
+        started = time.monotonic()
+        for _ in range(3):
+            assert (await client.conversations_info(channel=channel))["ok"]
+        assert time.monotonic() - started >= 1
+        assert client.stats()["rate_limited"] == 1
+        return client
+    in_loop(run)
+    assert strict_slack.rate_limited["conversations.info"] == 1
+
+
+# coalescing identical reads
+
+def test_coalesces_identical_reads(fake_slack, workspace):
+    # slow enough that every call arrives while the first is still out
+    fake = fake_slack(latency=0.2)
+    client = PacedWebClient(token="xoxb-fake", base_url=fake.base_url, limit_scale=1000)
+    user = user_ids(workspace)[1]
+    results = at_once([lambda: client.users_info(user=user)] * 10)
+    assert fake.calls["users.info"] == 1
+    assert client.stats()["coalesced"] == 9
+    assert all(result["user"]["id"] == user for result in results)
+
+
+def test_only_coalesces_the_same_call(fake_slack, workspace):
+    fake = fake_slack(latency=0.2)
+    client = PacedWebClient(token="xoxb-fake", base_url=fake.base_url, limit_scale=1000)
+    users = user_ids(workspace)[1:3]
+    results = at_once([lambda user=user: client.users_info(user=user) for user in users * 5])
+    assert fake.calls["users.info"] == 2
+    assert [result["user"]["id"] for result in results] == users * 5
+
+
+def test_doesnt_coalesce_writes(fake_slack, workspace):
+    fake = fake_slack(latency=0.2)
+    client = PacedWebClient(token="xoxb-fake", base_url=fake.base_url, limit_scale=1000)
+    channel = workspace["channels"][0]["id"]
+    at_once([lambda: client.chat_postMessage(channel=channel, text="hello")] * 3)
+    assert fake.calls["chat.postMessage"] == 3
+    assert client.stats()["coalesced"] == 0
+
+
+def test_async_coalesces_identical_reads(fake_slack, workspace):
+    fake = fake_slack(latency=0.2)
+    user = user_ids(workspace)[1]
+
+    async def run():
+        client = PacedAsyncWebClient(token="xoxb-fake", base_url=fake.base_url, limit_scale=1000)
+        results = await asyncio.gather(*(client.users_info(user=user) for _ in range(10)))
+        assert all(result["user"]["id"] == user for result in results)
+        assert client.stats()["coalesced"] == 9
+        return client
+    in_loop(run)
+    assert fake.calls["users.info"] == 1
+
+
+# connection reuse
+
+def test_reuses_its_connection(fake_slack, workspace):
+    fake = fake_slack()
+    client = PacedWebClient(token="xoxb-fake", base_url=fake.base_url, limit_scale=1000)
+    for user in user_ids(workspace):
+        client.users_info(user=user)
+    assert fake.calls["users.info"] == USERS + 1
+    assert fake.connections == 1
+    assert client.stats()["connections"] == 1
+
+
+def test_opens_no_more_connections_than_calls_at_once(fake_slack, workspace):
+    fake = fake_slack(latency=0.05)
+    client = PacedWebClient(token="xoxb-fake", base_url=fake.base_url, limit_scale=1000, pool_size=4)
+    users = user_ids(workspace)
+    at_once([lambda i=i: [client.users_info(user=users[i * 5 + j]) for j in range(5)] for i in range(4)])
+    assert fake.calls["users.info"] == 20
+    assert fake.connections <= 4
+    assert client.stats()["connections"] == fake.connections
+
+
+def test_a_plain_client_connects_for_every_call(fake_slack, workspace):
+    fake = fake_slack()
+    client = WebClient(token="xoxb-fake", base_url=fake.base_url)
+    for user in user_ids(workspace)[:5]:
+        client.users_info(user=user)
+    assert fake.connections == 5
+
+
+def test_async_reuses_its_connection(fake_slack, workspace):
+    fake = fake_slack()
+
+    async def run():
+        client = PacedAsyncWebClient(token="xoxb-fake", base_url=fake.base_url, limit_scale=1000)
+        for user in user_ids(workspace):
+            await client.users_info(user=user)
+        assert client.stats()["connections"] == 1
+        return client
+    in_loop(run)
+    assert fake.calls["users.info"] == USERS + 1
+    assert fake.connections == 1
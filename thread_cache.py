@@ -0,0 +1,107 @@
+# remembers the replies in threads the bot is talking in
+# the first follow-up in a thread fetches its history from Slack once; after that
+# new replies are appended as their message events arrive, so later follow-ups
+# don't refetch the whole thread. Only the most recent replies that fit in a
+# token budget are handed to the prompt
+import collections, threading
+
+
+class ThreadCache:
+    def __init__(self, max_threads=500, max_replies=200, count_tokens=None):
+        self.max_threads = max_threads
+        self.max_replies = max_replies
+        # a rough count is fine if we aren't given a real tokenizer
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4 + 1)
+        self.lock = threading.Lock()
+        # (channel, thread_ts) -> {ts: message}, least recently used thread first
+        self.threads = collections.OrderedDict()
+        self.hits = 0
+        self.seeds = 0
+
+    # the cached replies for a thread, fetching them with fetch() the first time
+    def get_or_seed(self, channel, thread_ts, fetch):
+        cached = self._cached(channel, thread_ts)
+        if cached is not None:
+            return cached
+        return self._seed(channel, thread_ts, fetch())
+
+    # the same, where fetch is a coroutine function
+    async def aget_or_seed(self, channel, thread_ts, fetch):
+        cached = self._cached(channel, thread_ts)
+        if cached is not None:
+            return cached
+        return self._seed(channel, thread_ts, await fetch())
+
+    def _cached(self, channel, thread_ts):
+        key = (channel, thread_ts)
+        with self.lock:
+            if key in self.threads:
+                self.threads.move_to_end(key)
+                self.hits += 1
+                return self._sorted(self.threads[key])
+        return None
+
+    def _seed(self, channel, thread_ts, messages):
+        key = (channel, thread_ts)
+        with self.lock:
+            self.seeds += 1
+            replies = self.threads.setdefault(key, {})
+            for message in messages:
+                replies[message.get('ts')] = message
+            self._trim(key)
+            return self._sorted(replies)
+
+    # add a new reply to a thread we already have; threads we don't have are
+    # left alone, they'll be fetched in full if anyone asks about them
+    def append(self, channel, message):
+        key = (channel, message.get('thread_ts'))
+        with self.lock:
+            replies = self.threads.get(key)
+            if replies is None:
+                return False
+            replies[message.get('ts')] = message
+            self._trim(key)
+            return True
+
+    # a reply was deleted; an edited one just needs append() again
+    def remove(self, channel, thread_ts, ts):
+        with self.lock:
+            replies = self.threads.get((channel, thread_ts))
+            if replies is None:
+                return False
+            return replies.pop(ts, None) is not None
+
+    # the newest replies, oldest first, whose rendered lines fit in max_tokens
+    def tail(self, replies, render, max_tokens):
+        lines = []
+        used = 0
+        for message in reversed(replies):
+            line = render(message)
+            tokens = self.count_tokens(line)
+            if used + tokens > max_tokens:
+                break
+            lines.append(line)
+            used += tokens
+        lines.reverse()
+        return lines
+
+    def _sorted(self, replies):
+        return [replies[ts] for ts in sorted(replies, key=float)]
+
+    def _trim(self, key):
+        replies = self.threads[key]
+        # the thread's parent message is the oldest, so it goes first; that's fine,
+        # only the tail ends up in the prompt anyway
+        for ts in sorted(replies, key=float)[:max(0, len(replies) - self.max_replies)]:
+            del replies[ts]
+        self.threads.move_to_end(key)
+        while len(self.threads) > self.max_threads:
+            self.threads.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "threads": len(self.threads),
+                "hits": self.hits,
+                "seeds": self.seeds,
+            }
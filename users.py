@@ -0,0 +1,109 @@
+# a cache of Slack users, so looking up a name doesn't cost a Slack API call
+# it warms itself with every user in the workspace using users.list, entries
+# expire after a while, and the user_change event keeps it up to date in between
+import collections, threading, time
+
+
+# the name a message from a bot or an integration was posted under; those have no user
+def bot_name(message):
+    return message.get('username') or (message.get('bot_profile') or {}).get('name') or "a bot"
+
+
+class UserDirectory:
+    def __init__(self, client, ttl=3600, max_size=10000):
+        self.client = client
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # user id -> (expiry time, user name, display name), least recently used first
+        self.users = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # a user's username and display name from their user id
+    def get(self, user_id):
+        cached = self._cached(user_id)
+        if cached is not None:
+            return cached
+        user_info = self.client.users_info(user=user_id)
+        return self.update(user_info['user'])
+
+    # the username and display name a message was sent under
+    def author(self, message):
+        if not message.get('user'):
+            return bot_name(message), ""
+        return self.get(message['user'])
+
+    def _cached(self, user_id):
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is not None and entry[0] > time.time():
+                self.users.move_to_end(user_id)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+            return None
+
+    # store a user object as returned by users.info, users.list or a user_change event
+    def update(self, user):
+        user_name = user['name']
+        user_display_name = user.get('profile', {}).get('display_name', "")
+        with self.lock:
+            self.users[user['id']] = (time.time() + self.ttl, user_name, user_display_name)
+            self.users.move_to_end(user['id'])
+            while len(self.users) > self.max_size:
+                self.users.popitem(last=False)
+        return user_name, user_display_name
+
+    # load every user in the workspace, one page at a time
+    def warm(self, page_size=200):
+        cursor = None
+        count = 0
+        while True:
+            response = self.client.users_list(limit=page_size, cursor=cursor)
+            count += self._load_page(response)
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+        print(f"Loaded {count} users into the user directory")
+        return count
+
+    def _load_page(self, response):
+        for user in response['members']:
+            self.update(user)
+        return len(response['members'])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.users),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# the same cache for an AsyncWebClient; get and warm are coroutines
+class AsyncUserDirectory(UserDirectory):
+    async def get(self, user_id):
+        cached = self._cached(user_id)
+        if cached is not None:
+            return cached
+        user_info = await self.client.users_info(user=user_id)
+        return self.update(user_info['user'])
+
+    async def author(self, message):
+        if not message.get('user'):
+            return bot_name(message), ""
+        return await self.get(message['user'])
+
+    async def warm(self, page_size=200):
+        cursor = None
+        count = 0
+        while True:
+            response = await self.client.users_list(limit=page_size, cursor=cursor)
+            count += self._load_page(response)
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+        print(f"Loaded {count} users into the user directory")
+        return count
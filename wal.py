@@ -0,0 +1,448 @@
+# a write-ahead log for messages on their way into the index
+# the ingest buffer keeps messages in memory until they're stored, so if the bot
+# died, or the embedding API was down when a batch was flushed, those messages were
+# gone for good. With WAL_DIR set, the bots write each message (and each edit and
+# delete) to a log on disk from a Bolt middleware, which runs before Bolt acks the
+# event, so once Slack has its ack the message is on disk. A consumer thread reads
+# the log, stores what it finds, and records how far it got in a checkpoint. After
+# a restart it picks up from the checkpoint; after an outage it retries until the
+# messages are stored, then catches up in big batches.
+#
+# Only one process can have a log open, so each process claims its own log in
+# WAL_DIR/0, WAL_DIR/1 and so on (see claim_log): the first one nobody else has.
+# A worker that restarts takes over the log of the one it replaced, and logs left
+# by workers that aren't coming back are stored by drain_abandoned.
+#
+# The log is a directory of segment files, named after the offset of their first
+# record. Each record is its length, a CRC32 and a line of JSON. Appends are
+# written straight away and fsynced together: appends that arrive while one fsync
+# is running all wait for the next one, so a burst of messages costs a handful of
+# fsyncs rather than one each (fsync_interval waits a little longer to gather more,
+# which only helps on disks where fsync is slow). append returns once the fsync
+# that covers its record is done. Segments the consumer is done with are deleted.
+# A record half written when the process died fails its CRC and is cut off when
+# the log is opened again.
+#
+# Storing the same message twice is a harmless upsert (node ids come from the
+# channel and timestamp), so a crash between storing a batch and checkpointing it
+# just means storing it again
+import bisect, fcntl, itertools, json, os, struct, threading, time, zlib
+
+from ingest import Deletion
+
+HEADER = struct.Struct(">II")
+
+
+# another process has the log open
+class LogInUse(RuntimeError):
+    pass
+
+
+class WriteAheadLog:
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync_interval=0.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        # two processes appending to one log would corrupt it
+        self.lock_file = open(os.path.join(directory, "lock"), "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            raise LogInUse(f"{directory} is in use by another process")
+        self.lock = threading.Lock()
+        # notified whenever records become durable
+        self.synced = threading.Condition(self.lock)
+        self.dirty = threading.Event()
+        self.checkpoint = self._read_checkpoint()
+        # first offset of each segment, oldest first
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".wal"))
+        if not self.segments:
+            self.segments = [self.checkpoint + 1]
+        self.next_offset = self.segments[-1] + self._recover(self.segments[-1])
+        self.durable = self.next_offset - 1
+        self.file = open(self._path(self.segments[-1]), "ab")
+        self.segment_size = self.file.tell()
+        # where the consumer's last read stopped: (next offset, segment, byte position)
+        self.read_position = None
+        self.appended = 0
+        self.fsyncs = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._sync_loop, name="wal-sync", daemon=True)
+        self.thread.start()
+
+    def _path(self, first_offset):
+        return os.path.join(self.directory, f"{first_offset:020d}.wal")
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, "checkpoint")) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    # count the good records in a segment, cutting off a half-written one at the end
+    def _recover(self, first_offset):
+        path = self._path(first_offset)
+        count, position = 0, 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for _, end in _records(f):
+                    count, position = count + 1, end
+            if position < os.path.getsize(path):
+                print(f"Cutting off a half-written record at the end of {path}")
+                with open(path, "r+b") as f:
+                    f.truncate(position)
+                    os.fsync(f.fileno())
+        return count
+
+    # add a record (anything JSON can hold); returns its offset
+    # with wait (the default), returns once the record is on disk
+    def append(self, record, wait=True):
+        data = json.dumps(record, separators=(",", ":")).encode()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("WriteAheadLog is closed")
+            if self.segment_size >= self.segment_bytes:
+                self._rotate()
+            self.file.write(HEADER.pack(len(data), zlib.crc32(data)) + data)
+            self.segment_size += HEADER.size + len(data)
+            offset = self.next_offset
+            self.next_offset += 1
+            self.appended += 1
+        self.dirty.set()
+        if wait:
+            self.wait_for(offset)
+        return offset
+
+    # wait until the record at offset is on disk, or timeout seconds; returns whether it is
+    def wait_for(self, offset, timeout=None):
+        with self.synced:
+            return self.synced.wait_for(lambda: self.durable >= offset or self.closed, timeout) and self.durable >= offset
+
+    def _rotate(self):
+        self._sync()
+        self.file.close()
+        self.segments.append(self.next_offset)
+        self.file = open(self._path(self.next_offset), "ab")
+        self.segment_size = 0
+
+    # called with the lock held
+    def _sync(self):
+        if self.durable >= self.next_offset - 1:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.durable = self.next_offset - 1
+        self.fsyncs += 1
+        self.synced.notify_all()
+
+    def _sync_loop(self):
+        while not self.closed:
+            self.dirty.wait()
+            # give other appends a moment to arrive, so they share the fsync
+            time.sleep(self.fsync_interval)
+            self.dirty.clear()
+            with self.lock:
+                if not self.closed:
+                    self._sync()
+
+    # up to limit (offset, record) pairs, starting at offset start; only records already on disk
+    def read(self, start, limit):
+        with self.lock:
+            end = min(self.durable, start + limit - 1)
+            segments = list(self.segments)
+            position = self.read_position
+        records = []
+        offset = start
+        while offset <= end:
+            index = bisect.bisect_right(segments, offset) - 1
+            if index < 0:
+                # the segment holding it has been deleted; skip ahead to the oldest one left
+                offset = segments[0]
+                continue
+            first = segments[index]
+            with open(self._path(first), "rb") as f:
+                if position is not None and position[0] == offset and position[1] == first:
+                    f.seek(position[2])
+                    current = offset
+                else:
+                    current = first
+                for data, end_position in _records(f):
+                    if current >= offset:
+                        records.append((current, json.loads(data)))
+                        position = (current + 1, first, end_position)
+                    current += 1
+                    if current > end:
+                        break
+            if current <= offset:
+                # nothing more in this segment (a damaged record cuts it short), so move on to the next one
+                next_segments = segments[index + 1:]
+                if not next_segments:
+                    break
+                print(f"Skipping records {current} to {next_segments[0] - 1} in {self._path(first)}, which can't be read")
+                offset = next_segments[0]
+                continue
+            offset = current
+        with self.lock:
+            self.read_position = position
+        return records
+
+    # everything up to offset has been stored: remember that, and delete the segments we're done with
+    def commit(self, offset):
+        path = os.path.join(self.directory, "checkpoint")
+        with open(path + ".tmp", "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        with self.lock:
+            self.checkpoint = offset
+            finished = []
+            while len(self.segments) > 1 and self.segments[1] <= offset + 1:
+                finished.append(self.segments.pop(0))
+        for first in finished:
+            os.remove(self._path(first))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "appended": self.appended,
+                "fsyncs": self.fsyncs,
+                "segments": len(self.segments),
+                "last_offset": self.next_offset - 1,
+                "checkpoint": self.checkpoint,
+                "lag": self.durable - self.checkpoint,
+            }
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self._sync()
+            self.closed = True
+            self.file.close()
+            self.synced.notify_all()
+        self.dirty.set()
+        self.lock_file.close()
+
+
+# (record, position after it) for each good record from where f is, stopping at the first bad one
+def _records(f):
+    while True:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        length, crc = HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) < length or zlib.crc32(data) != crc:
+            return
+        yield data, f.tell()
+
+
+# reads the log from its checkpoint and hands batches of records to apply
+# apply(records) gets a list of (offset, record); if it raises, it's called again
+# with the same records a little later, backing off, until it succeeds.
+#
+# A record that can never be stored would hold up the log forever, so once a batch
+# has failed max_attempts times, its records (and any logged since) are tried one at
+# a time. If some go through, the ones that don't are set aside in the log's
+# quarantine file (a line of JSON each, with the error) and the log moves on. If
+# none do, it's an outage rather than a bad record, and we keep waiting
+class LogConsumer:
+    def __init__(self, log, apply, batch_size=256, max_delay=2.0, retry_delay=1.0, max_retry_delay=60.0, max_attempts=8):
+        self.log = log
+        self.apply = apply
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.records = 0
+        self.failures = 0
+        self.quarantined = 0
+        self.last_error = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="wal-consumer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        waiting_since = None
+        while True:
+            start = self.log.checkpoint + 1
+            if not self.log.wait_for(start, timeout=0 if self.stopping.is_set() else 1.0):
+                if self.stopping.is_set():
+                    return
+                continue
+            # a full batch goes straight away, so catching up after an outage goes at bulk
+            # speed; otherwise the first record waits up to max_delay for the batch to fill
+            if not self.stopping.is_set() and not self.log.wait_for(start + self.batch_size - 1, timeout=0):
+                waiting_since = waiting_since or time.monotonic()
+                remaining = waiting_since + self.max_delay - time.monotonic()
+                if remaining > 0:
+                    self.log.wait_for(start + self.batch_size - 1, timeout=min(remaining, 1.0))
+                    continue
+            waiting_since = None
+            records = self.log.read(start, self.batch_size)
+            if records and not self._apply(records):
+                return
+
+    # returns False if we're stopping and they couldn't be stored
+    def _apply(self, records):
+        delay = self.retry_delay
+        attempts = 0
+        while True:
+            try:
+                self.apply(records)
+                break
+            except Exception as e:
+                self._failed(e)
+                attempts += 1
+                print(f"Could not store {len(records)} logged messages, trying again in {delay:.1f}s:", repr(e))
+            if attempts >= self.max_attempts:
+                records = self.log.read(records[0][0], self.batch_size)
+                if self._apply_singly(records):
+                    break
+            # if we're stopping, they're still in the log for the next start to pick up
+            if self.stopping.wait(delay):
+                return False
+            delay = min(delay * 2, self.max_retry_delay)
+        self.log.commit(records[-1][0])
+        with self.lock:
+            self.batches += 1
+            self.records += len(records)
+        return True
+
+    def _failed(self, error):
+        with self.lock:
+            self.failures += 1
+            self.last_error = repr(error)
+
+    # apply records one at a time; returns False (having stored nothing) if every one of
+    # them failed, otherwise quarantines the ones that did
+    def _apply_singly(self, records):
+        failed = []
+        for offset, record in records:
+            try:
+                self.apply([(offset, record)])
+            except Exception as e:
+                self._failed(e)
+                failed.append((offset, record, repr(e)))
+        if len(failed) == len(records):
+            return False
+        with open(os.path.join(self.log.directory, "quarantine"), "a") as f:
+            for offset, record, error in failed:
+                print(f"Setting aside logged record {offset}, which can't be stored:", error)
+                f.write(json.dumps({"offset": offset, "record": record, "error": error}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        with self.lock:
+            self.quarantined += len(failed)
+        return True
+
+    def stats(self):
+        with self.lock:
+            return dict(self.log.stats(), batches=self.batches, records=self.records,
+                        failures=self.failures, quarantined=self.quarantined, last_error=self.last_error)
+
+    # store what's in the log now, then stop
+    def close(self, timeout=30.0):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        self.log.close()
+
+
+# this process's own log: the first of directory/0, directory/1, ... that no other process has open
+def claim_log(directory, **kwargs):
+    for slot in itertools.count():
+        try:
+            return WriteAheadLog(os.path.join(directory, str(slot)), **kwargs)
+        except LogInUse:
+            continue
+
+
+# store what's left in the logs of workers that are gone for good, on a background thread
+# with `workers` workers, their logs are slots 0 to workers - 1, and a restarted worker
+# takes its predecessor's; a log in a higher slot was left when there used to be more
+# workers. make_apply() makes an apply for each log (see EventReplay)
+def drain_abandoned(directory, workers, make_apply, **kwargs):
+    def drain():
+        slots = sorted(int(name) for name in os.listdir(directory) if name.isdigit())
+        for slot in slots:
+            if slot < workers:
+                continue
+            try:
+                log = WriteAheadLog(os.path.join(directory, str(slot)))
+            except LogInUse:
+                continue
+            lag = log.stats()["lag"]
+            if lag:
+                print(f"Storing {lag} messages left in {log.directory}")
+            # closing it stores everything in it first
+            LogConsumer(log, make_apply(), **kwargs).start().close(timeout=None)
+
+    thread = threading.Thread(target=drain, name="wal-abandoned", daemon=True)
+    thread.start()
+    return thread
+
+
+# collects what applying events would put in the ingest buffer, so it can be stored as one batch
+class NodeBatch:
+    def __init__(self):
+        self.items = []
+
+    def add(self, node):
+        self.items.append(node)
+        return True
+
+    def delete(self, node_ids):
+        self.items.extend(Deletion(node_id) for node_id in node_ids)
+        return True
+
+
+# the bots' apply for LogConsumer: turns logged messages, edits and deletes into stored nodes
+# it's safe to call again with the same records after a failure: records already
+# applied to the conversation windows aren't applied twice, and the nodes they made
+# are kept until they're stored
+class EventReplay:
+    def __init__(self, windows, message_sync, ingest_buffer, author_name, forget_sources, batch_size=256):
+        self.windows = windows
+        self.message_sync = message_sync
+        self.ingest_buffer = ingest_buffer
+        # message -> the name of whoever sent it (a bot's message has no user)
+        self.author_name = author_name
+        # called with the ids of nodes an edit or delete changed, to drop answers built from them
+        self.forget_sources = forget_sources
+        # a whole batch from the log goes to the embedding API at once
+        if ingest_buffer.embed_model.embed_batch_size < batch_size:
+            ingest_buffer.embed_model.embed_batch_size = batch_size
+        self.applied = 0
+        self.unstored = NodeBatch()
+
+    def __call__(self, records):
+        for offset, event in records:
+            if offset <= self.applied:
+                continue
+            kind, message = event["kind"], event["message"]
+            if kind == "message":
+                for node in self.windows.add(message, self.author_name(message)):
+                    self.unstored.add(node)
+            else:
+                # edits and deletes look at what's stored, so store everything before them first
+                self._store()
+                sync = self.message_sync.edit if kind == "edit" else self.message_sync.delete
+                self.forget_sources(sync(message, sink=self.unstored))
+            self.applied = offset
+        self._store()
+
+    def _store(self):
+        if self.unstored.items:
+            self.ingest_buffer.store(self.unstored.items)
+            self.unstored = NodeBatch()
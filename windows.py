@@ -0,0 +1,285 @@
+# groups messages into conversation windows before they're stored
+# a single "lol" or "+1" doesn't embed into anything useful, and storing every
+# message on its own means a vector per message. With windows, each channel
+# (and each thread) is stored as a run of overlapping chunks of `size` messages.
+# A chunk ends when it's full or the conversation goes quiet for max_gap_seconds,
+# and the next one starts with the last `overlap` messages of the one before, so
+# a question and its answer don't get split apart.
+#
+# While a window is filling up, each new message re-stores it under the same id,
+# so a message is searchable as soon as it arrives. Windows are linked to the
+# ones before and after them (PREVIOUS and NEXT), which NeighborExpander follows
+# at query time to pull in the surrounding conversation.
+#
+# With size=1 every message is its own node, exactly like message_to_node, but
+# still linked to the messages around it.
+#
+# A window is one line per message, and keeps the timestamps of its messages in
+# message_ts, so edit_node and remove_from_node can change one message in it when
+# it's edited or deleted in Slack
+import collections, threading, uuid
+from typing import Any, List, Optional
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import NodeRelationship, NodeWithScore, QueryBundle, RelatedNodeInfo, TextNode
+from llama_index.vector_stores.utils import metadata_dict_to_node
+
+from slack_nodes import HIDDEN_METADATA, SLACK_NAMESPACE, format_ts, message_to_node, node_id_for
+
+
+def window_id_for(channel, thread_ts, first_ts):
+    return str(uuid.uuid5(SLACK_NAMESPACE, f"window:{channel}:{thread_ts or ''}:{first_ts}"))
+
+
+# the conversation a message belongs to: a thread, or the channel itself
+def conversation_for(message):
+    thread_ts = message.get('thread_ts')
+    # the message that starts a thread is part of the channel's conversation
+    if thread_ts == message.get('ts'):
+        thread_ts = None
+    return (message.get('channel'), thread_ts)
+
+
+# one message's line in a window; newlines would throw off which line is which message
+def window_line(user_name, text):
+    return f"{user_name}: " + " ".join((text or "").splitlines())
+
+
+# whether a node (a window, or a single message) has the message sent at ts in it
+def node_contains(node, channel, ts):
+    return ts in (node.metadata.get("message_ts") or []) or node.node_id == node_id_for(channel, ts)
+
+
+# a copy of a node with the message sent at ts changed to text
+def edit_node(node, ts, text):
+    node = node.copy(deep=True)
+    message_ts = node.metadata.get("message_ts")
+    if not message_ts:
+        # a single message
+        node.text = text
+        return node
+    lines = node.text.split("\n")
+    i = message_ts.index(ts)
+    lines[i] = window_line(lines[i].split(": ", 1)[0], text)
+    node.text = "\n".join(lines)
+    return node
+
+
+# a copy of a node without the message sent at ts, or None if that was all it had
+def remove_from_node(node, ts):
+    message_ts = node.metadata.get("message_ts")
+    if not message_ts or message_ts == [ts]:
+        return None
+    node = node.copy(deep=True)
+    i = message_ts.index(ts)
+    lines = node.text.split("\n")
+    del lines[i]
+    message_ts = message_ts[:i] + message_ts[i + 1:]
+    node.text = "\n".join(lines)
+    node.metadata.update({
+        "who": ", ".join(dict.fromkeys(line.split(": ", 1)[0] for line in lines)),
+        "when": format_ts(message_ts[0]),
+        "when_ts": float(message_ts[-1]),
+        "message_ts": message_ts,
+    })
+    return node
+
+
+# a copy of node with its links to removed (a node that's gone) pointing past it instead,
+# or None if it didn't link to removed
+def unlink(node, removed):
+    copy = None
+    for relationship in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT):
+        related = node.relationships.get(relationship)
+        if related is not None and related.node_id == removed.node_id:
+            copy = copy or node.copy(deep=True)
+            past = removed.relationships.get(relationship)
+            if past is None:
+                del copy.relationships[relationship]
+            else:
+                copy.relationships[relationship] = past
+    return copy
+
+
+class Conversation:
+    def __init__(self):
+        # (message, user name) pairs in the window we're filling
+        self.lines = []
+        # the first message of the window we're filling, which its id comes from
+        self.window_ts = None
+        self.node = None
+        self.previous = None
+
+
+class ConversationWindows:
+    def __init__(self, size=6, overlap=2, max_gap_seconds=900, max_conversations=1000):
+        if not 0 <= overlap < size:
+            raise ValueError("overlap has to be smaller than size")
+        self.size = size
+        self.overlap = overlap
+        self.max_gap_seconds = max_gap_seconds
+        self.max_conversations = max_conversations
+        self.lock = threading.Lock()
+        # (channel, thread_ts) -> Conversation, least recently active first
+        self.conversations = collections.OrderedDict()
+        self.messages = 0
+        self.windows = 0
+
+    # add a message; returns the nodes to store for it (its window, and the window before
+    # it when that has just gained a NEXT link)
+    def add(self, message, user_name):
+        key = conversation_for(message)
+        ts = float(message.get('ts'))
+        with self.lock:
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                conversation = self.conversations[key] = Conversation()
+                while len(self.conversations) > self.max_conversations:
+                    self.conversations.popitem(last=False)
+            self.conversations.move_to_end(key)
+            self.messages += 1
+            store = []
+            if conversation.lines:
+                gap = ts - float(conversation.lines[-1][0].get('ts'))
+                if len(conversation.lines) >= self.size or gap > self.max_gap_seconds:
+                    # after a long quiet spell the new window starts fresh
+                    carry = self.overlap if gap <= self.max_gap_seconds else 0
+                    conversation.previous = conversation.node
+                    conversation.lines = conversation.lines[len(conversation.lines) - carry:]
+                    conversation.window_ts = None
+            conversation.lines.append((message, user_name))
+            if conversation.window_ts is None:
+                conversation.window_ts = conversation.lines[0][0].get('ts')
+            node = self._node(key, conversation.lines, conversation.window_ts)
+            if conversation.previous is not None:
+                node.relationships[NodeRelationship.PREVIOUS] = RelatedNodeInfo(node_id=conversation.previous.node_id)
+                if NodeRelationship.NEXT not in conversation.previous.relationships:
+                    # its text hasn't changed, so storing it again costs no new embedding
+                    conversation.previous.relationships[NodeRelationship.NEXT] = RelatedNodeInfo(node_id=node.node_id)
+                    store.append(conversation.previous)
+            if conversation.node is None or conversation.node.node_id != node.node_id:
+                self.windows += 1
+            conversation.node = node
+            store.append(node)
+            return store
+
+    def _node(self, key, lines, window_ts):
+        channel, thread_ts = key
+        if self.size == 1:
+            message, user_name = lines[0]
+            return message_to_node(dict(message, channel=channel), user_name)
+        first, last = lines[0][0], lines[-1][0]
+        speakers = list(dict.fromkeys(user_name for _, user_name in lines))
+        return TextNode(
+            id_=window_id_for(channel, thread_ts, window_ts),
+            text="\n".join(window_line(user_name, message.get('text')) for message, user_name in lines),
+            metadata={
+                "who": ", ".join(speakers),
+                "when": format_ts(first.get('ts')),
+                # the newest message, so recency works the same as for single messages
+                "when_ts": float(last.get('ts')),
+                "channel_id": channel,
+                "team_id": first.get('team'),
+                "message_ts": [message.get('ts') for message, _ in lines]
+            },
+            excluded_embed_metadata_keys=HIDDEN_METADATA,
+            excluded_llm_metadata_keys=HIDDEN_METADATA
+        )
+
+    # a message we may still be holding was edited; returns the nodes that changed
+    def edit(self, message):
+        channel, ts, text = message.get('channel'), message.get('ts'), message.get('text')
+        with self.lock:
+            conversation = self.conversations.get(conversation_for(message))
+            if conversation is None:
+                return []
+            conversation.lines = [(dict(m, text=text) if m.get('ts') == ts else m, user_name)
+                                  for m, user_name in conversation.lines]
+            changed = []
+            for attr in ("previous", "node"):
+                node = getattr(conversation, attr)
+                if node is not None and node_contains(node, channel, ts):
+                    node = edit_node(node, ts, text)
+                    setattr(conversation, attr, node)
+                    changed.append(node)
+            return changed
+
+    # a message we may still be holding was deleted; returns the nodes that changed
+    # and the ids of the ones that are now empty
+    def remove(self, message):
+        channel, ts = message.get('channel'), message.get('ts')
+        with self.lock:
+            conversation = self.conversations.get(conversation_for(message))
+            if conversation is None:
+                return [], []
+            conversation.lines = [(m, user_name) for m, user_name in conversation.lines if m.get('ts') != ts]
+            changed, removed = {}, []
+            for attr in ("previous", "node"):
+                node = getattr(conversation, attr)
+                if node is not None and node_contains(node, channel, ts):
+                    new = remove_from_node(node, ts)
+                    if new is None:
+                        removed.append(node)
+                    else:
+                        changed[new.node_id] = new
+                    setattr(conversation, attr, new)
+            # whatever linked to an empty window now links past it
+            for gone in removed:
+                for attr in ("previous", "node"):
+                    node = getattr(conversation, attr)
+                    relinked = unlink(node, gone) if node is not None else None
+                    if relinked is not None:
+                        setattr(conversation, attr, relinked)
+                        changed[relinked.node_id] = relinked
+            if conversation.node is None:
+                # the next message starts a fresh window
+                conversation.window_ts = None
+            return list(changed.values()), [node.node_id for node in removed]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "conversations": len(self.conversations),
+                "messages": self.messages,
+                "windows": self.windows,
+                "messages_per_window": self.messages / self.windows if self.windows else 0.0,
+            }
+
+
+# adds the nodes before and after each result, following PREVIOUS and NEXT links
+# neighbors score a little lower than the node that led us to them, so the
+# ContextPacker still prefers the direct matches when space is short
+class NeighborExpander(BaseNodePostprocessor):
+    hops: int = Field(default=1, description="How many links to follow in each direction.")
+    score_decay: float = Field(default=0.9, description="A neighbor's score is this times the score of the node next to it.")
+    _client: Any = PrivateAttr()
+    _collection_name: str = PrivateAttr()
+
+    def __init__(self, client, collection_name, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._client = client
+        self._collection_name = collection_name
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NeighborExpander"
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        results = {node.node.node_id: node for node in nodes}
+        frontier = list(nodes)
+        for _ in range(self.hops):
+            # neighbor id -> the best score of a node that points at it
+            wanted = {}
+            for node in frontier:
+                for related in (node.node.prev_node, node.node.next_node):
+                    if related is not None and related.node_id not in results:
+                        wanted[related.node_id] = max(wanted.get(related.node_id, 0.0), (node.score or 0.0) * self.score_decay)
+            if not wanted:
+                break
+            points = self._client.retrieve(self._collection_name, ids=list(wanted), with_payload=True)
+            frontier = []
+            for point in points:
+                neighbor = NodeWithScore(node=metadata_dict_to_node(point.payload), score=wanted[str(point.id)])
+                results[neighbor.node.node_id] = neighbor
+                frontier.append(neighbor)
+        return list(results.values())